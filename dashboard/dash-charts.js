@@ -200,3 +200,19 @@ function trimData(dataset, maxAge) {
         }
     });
 }
+
+function fetchHistory(url, seconds, points, seriesList, callback) {
+    // Replaces the contents of each dataset with downsampled history, so chart size is bounded by points
+    $.getJSON(url, {'seconds': seconds, 'points': points}, function(history) {
+        seriesList.forEach(entry => {
+            let [data, sensor, metric] = entry;
+            data.length = 0;
+            if(history['series'].hasOwnProperty(sensor) && history['series'][sensor].hasOwnProperty(metric)) {
+                history['series'][sensor][metric].forEach(point => {
+                    data.push({'x': point[0], 'y': point[1]});
+                });
+            }
+        });
+        callback();
+    });
+}
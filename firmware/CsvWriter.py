@@ -7,44 +7,145 @@ CSV writer helper class
 
 from DesignSpark.ESDK import AppLogger
 import csv
-import copy
+import gzip
+import os
+import shutil
+import threading
+import time
 from datetime import datetime
 
+# Rows are held in a buffer of this many bytes between flushes
+WRITE_BUFFER_SIZE = 65536
+
 class CsvWriter:
-    def __init__(self, friendlyName='', debug=False, hwid=0, loggingLevel='full'):
+    """ Writes sensor readings to CSV files through a long-lived, buffered file handle.
+
+    Rows are written out every flushRows rows or flushInterval seconds, whichever comes first, and are
+    also synced to the SD card at each flush if fsync is enabled. A new file is started each UTC day,
+    or once a file reaches maxSize bytes, and finished files may be gzip compressed.
+
+    :param directory: Directory CSV files are written to
+    :type directory: str, optional
+    :param flushRows: Rows buffered before a flush, defaults to 10
+    :type flushRows: int, optional
+    :param flushInterval: Longest time in seconds a row is buffered, defaults to 300
+    :type flushInterval: int, optional
+    :param fsync: Whether each flush is synced to disk, defaults to True
+    :type fsync: bool, optional
+    :param rotate: "daily", "size" or "none", defaults to "daily"
+    :type rotate: str, optional
+    :param maxSize: File size in bytes at which a new file is started when rotating by size, defaults to 10 MiB
+    :type maxSize: int, optional
+    :param compress: Whether finished files are gzip compressed, defaults to False
+    :type compress: bool, optional
+    """
+    def __init__(self, friendlyName='', debug=False, hwid=0, loggingLevel='full', directory='/aq/data/csv/', \
+        flushRows=10, flushInterval=300, fsync=True, rotate="daily", maxSize=10 * 1024 * 1024, compress=False):
         self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
-        #self.logger = AppLogger.getLogger("CsvWriter", debug, loggingLevel)
         self.hardwareId = hwid
         self.friendlyName = friendlyName
-        self.csvFilename = "/aq/data/csv/{fn}_{hwid}_{ts}.csv".format(fn=self.friendlyName, \
-            hwid=self.hardwareId, \
-            ts=datetime.utcnow().strftime("%Y_%m_%d-%H_%M_%S"))
+        self.directory = directory
+        self.flushRows = flushRows
+        self.flushInterval = flushInterval
+        self.fsync = fsync
+        self.rotate = rotate
+        self.maxSize = maxSize
+        self.compress = compress
+        self.lock = threading.Lock()
 
         # Should more sensors be added, this should be updated to reflect available values
         self.csvColumns = ['timestamp', 'temperature', 'humidity', 'vocIndex', 'co2', 'pm1.0', 'pm2.5', 'pm4.0', 'pm10', 'cps', 'cpm', 'totalCounts', 'no2', 'formaldehyde']
 
-        with open(self.csvFilename, 'w') as fh:
-            csvWriter = csv.DictWriter(fh, fieldnames=self.csvColumns)
-            csvWriter.writeheader()
+        os.makedirs(self.directory, exist_ok=True)
+        self.fh = None
+        self.__open(datetime.utcnow())
+
+    def __open(self, now):
+        self.csvFilename = os.path.join(self.directory, "{fn}_{hwid}_{ts}.csv".format(fn=self.friendlyName, \
+            hwid=self.hardwareId, \
+            ts=now.strftime("%Y_%m_%d-%H_%M_%S")))
+        # Names only go down to the second, so never overwrite a file started in the same second
+        suffix = 1
+        baseName = self.csvFilename[:-len(".csv")]
+        while os.path.exists(self.csvFilename) or os.path.exists(self.csvFilename + ".gz"):
+            self.csvFilename = "{}-{}.csv".format(baseName, suffix)
+            suffix += 1
+        self.fileDate = now.date()
+
+        self.fh = open(self.csvFilename, 'w', newline='', buffering=WRITE_BUFFER_SIZE)
+        self.csvWriter = csv.DictWriter(self.fh, fieldnames=self.csvColumns)
+        self.csvWriter.writeheader()
+        self.pendingRows = 0
+        self.lastFlush = time.monotonic()
+        self.logger.debug("Writing to {}".format(self.csvFilename))
+
+    def __flush(self):
+        self.fh.flush()
+        if self.fsync:
+            os.fsync(self.fh.fileno())
+        self.pendingRows = 0
+        self.lastFlush = time.monotonic()
+
+    def __close(self):
+        """ Flush and close the current file, compressing it if enabled """
+        try:
+            self.__flush()
+        finally:
+            self.fh.close()
+            self.fh = None
+
+        if self.compress:
+            with open(self.csvFilename, 'rb') as source, gzip.open(self.csvFilename + ".gz.tmp", 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+            os.replace(self.csvFilename + ".gz.tmp", self.csvFilename + ".gz")
+            os.remove(self.csvFilename)
+
+    def __isRotationDue(self, now):
+        if self.rotate == "daily":
+            return now.date() != self.fileDate
+        if self.rotate == "size":
+            # Text file positions are found by flushing, whereas the binary buffer's position costs no write
+            return self.fh.buffer.tell() >= self.maxSize
+        return False
 
     def addRow(self, sensorData):
-        sensorDataArray = copy.deepcopy(sensorData)
+        """ Append a row built from a read-only sensor data dictionary """
         try:
-            # Strip other keys so all we're left with is sensor data to iterate over
-            location = sensorDataArray.pop("geohash", None)
-            hwid = sensorDataArray.pop("hardwareId", None)
+            now = datetime.utcnow()
+            csvSensorDataArray = {'timestamp': int(now.timestamp())}
 
-            csvSensorDataArray = {'timestamp': int(datetime.utcnow().timestamp())}
+            for sensorType, sd in sensorData.items():
+                # Skip other keys so all we're left with is sensor data to iterate over
+                if sensorType in ("geohash", "hardwareId"):
+                    continue
 
-            for sensorType, sd in sensorDataArray.items():
-                sd.pop("sensor", None) # Remove sensor type from data array
-                csvSensorDataArray.update(sd)
+                # Skip sensor type, not a CSV column
+                csvSensorDataArray.update((metric, value) for metric, value in sd.items() if metric != "sensor")
 
             self.logger.debug("CSV data dict {}".format(csvSensorDataArray))
 
-            with open(self.csvFilename, 'a') as fh:
-                csvWriter = csv.DictWriter(fh, fieldnames=self.csvColumns)
-                csvWriter.writerow(csvSensorDataArray)
+            with self.lock:
+                if self.fh is None:
+                    return
+
+                if self.__isRotationDue(now):
+                    # Should the old file fail to be written out or compressed, rows still go to the new one
+                    try:
+                        self.__close()
+                    finally:
+                        self.__open(now)
+
+                self.csvWriter.writerow(csvSensorDataArray)
+                self.pendingRows += 1
+
+                if self.pendingRows >= self.flushRows or time.monotonic() - self.lastFlush >= self.flushInterval:
+                    self.__flush()
 
         except Exception as e:
-            self.logger.error("Could not write CSV data, reason {}".format(e))
\ No newline at end of file
+            self.logger.error("Could not write CSV data, reason {}".format(e))
+
+    def close(self):
+        """ Write out any buffered rows and close the file """
+        with self.lock:
+            if self.fh is not None:
+                self.__close()
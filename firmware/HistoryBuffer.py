@@ -0,0 +1,157 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Sensor history ring buffer
+'''
+
+import array
+import math
+import threading
+
+class HistoryBuffer:
+    """ Fixed size, columnar ring buffer of recent sensor readings.
+
+    Timestamps are held in one column and each sensor metric in another, all sharing the same write
+    position. Metrics missing from a reading are stored as NaN, so memory use is fixed at creation
+    plus one column per metric first seen.
+
+    :param capacity: Number of readings retained, defaults to 86400 (24 hours at 1 second)
+    :type capacity: int, optional
+    """
+    def __init__(self, capacity=86400):
+        self.capacity = capacity
+        self.timestamps = array.array('d', bytes(8 * capacity))
+        self.columns = {}
+        self.head = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, sensorData):
+        """ Add a reading, overwriting the oldest once full
+
+        :param timestamp: Reading time in seconds since the epoch
+        :type timestamp: float
+        :param sensorData: Sensor data dictionary as found in a snapshot
+        :type sensorData: dict
+        """
+        with self.lock:
+            index = self.head
+            self.timestamps[index] = timestamp
+
+            written = set()
+            for sensor, sd in sensorData.items():
+                # Skip other keys such as geohash and hardwareId, leaving only sensor data
+                if not isinstance(sd, dict):
+                    continue
+
+                for metric, value in sd.items():
+                    if metric == "sensor":
+                        continue
+
+                    key = (sensor, metric)
+                    column = self.columns.get(key)
+                    if column is None:
+                        column = array.array('f', [math.nan]) * self.capacity
+                        self.columns[key] = column
+
+                    try:
+                        column[index] = value
+                    except TypeError:
+                        column[index] = math.nan
+                    written.add(key)
+
+            # Metrics not present in this reading are marked as missing
+            for key, column in self.columns.items():
+                if key not in written:
+                    column[index] = math.nan
+
+            self.head = (index + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def _physicalIndex(self, logicalIndex):
+        """ Convert a logical index, where 0 is the oldest reading, to an array index """
+        return (self.head - self.count + logicalIndex) % self.capacity
+
+    def _lowerBound(self, timestamp):
+        """ Returns the logical index of the first reading at or after timestamp """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[self._physicalIndex(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def getOldestTimestamp(self):
+        """ Returns the time of the oldest reading held, or None if empty """
+        with self.lock:
+            return self.timestamps[self._physicalIndex(0)] if self.count else None
+
+    def getWindow(self, start=None, end=None, step=0):
+        """ Returns readings between two times, optionally thinned out to at most one per step seconds
+
+        :return: A tuple of a timestamp list and a dictionary of value lists keyed on (sensor, metric)
+        :rtype: tuple
+        """
+        with self.lock:
+            first = 0 if start is None else self._lowerBound(start)
+            last = self.count if end is None else self._lowerBound(end)
+
+            indices = []
+            nextTimestamp = None
+            for logicalIndex in range(first, last):
+                index = self._physicalIndex(logicalIndex)
+                timestamp = self.timestamps[index]
+                if nextTimestamp is None or timestamp >= nextTimestamp:
+                    indices.append(index)
+                    nextTimestamp = timestamp + step
+
+            timestamps = [self.timestamps[index] for index in indices]
+            series = {key: [column[index] for index in indices] for key, column in self.columns.items()}
+
+        return timestamps, series
+
+def downsampleLttb(timestamps, values, threshold):
+    """ Reduce a series to at most threshold points using Largest-Triangle-Three-Buckets.
+
+    Missing (NaN) values are dropped first, the first and last points are always kept.
+
+    :return: A list of (timestamp, value) tuples
+    :rtype: list
+    """
+    points = [(timestamp, value) for timestamp, value in zip(timestamps, values) if not math.isnan(value)]
+    if threshold >= len(points) or threshold < 3:
+        return points
+
+    sampled = [points[0]]
+    bucketSize = (len(points) - 2) / (threshold - 2)
+    previous = points[0]
+
+    for bucket in range(threshold - 2):
+        bucketStart = int(bucket * bucketSize) + 1
+        bucketEnd = int((bucket + 1) * bucketSize) + 1
+
+        # Average of the next bucket is the third point of the triangle
+        nextStart = bucketEnd
+        nextEnd = min(int((bucket + 2) * bucketSize) + 1, len(points))
+        nextBucket = points[nextStart:nextEnd]
+        averageX = sum(point[0] for point in nextBucket) / len(nextBucket)
+        averageY = sum(point[1] for point in nextBucket) / len(nextBucket)
+
+        # Keep the point in this bucket forming the largest triangle
+        largestArea = -1
+        selected = None
+        for point in points[bucketStart:bucketEnd]:
+            area = abs((previous[0] - averageX) * (point[1] - previous[1]) - \
+                (previous[0] - point[0]) * (averageY - previous[1]))
+            if area > largestArea:
+                largestArea = area
+                selected = point
+
+        sampled.append(selected)
+        previous = selected
+
+    sampled.append(points[-1])
+    return sampled
@@ -0,0 +1,90 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Housekeeping probe cache
+'''
+
+from DesignSpark.ESDK import AppLogger
+import geohash
+import math
+import threading
+import time
+
+EARTH_RADIUS = 6371000
+
+class Housekeeping:
+    """ Caches the results of slow status probes, each refreshed no more often than its own TTL.
+
+    Probes are run by calling refresh() on a background cadence, readers only ever see cached values
+    and never wait on a probe.
+
+    :param geohashThreshold: Distance in metres the location must move before its geohash is recomputed, defaults to 10
+    :type geohashThreshold: float, optional
+    """
+    def __init__(self, debug=False, loggingLevel='full', geohashThreshold=10):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.lock = threading.Lock()
+        self.probes = {}
+        self.geohashThreshold = geohashThreshold
+        self.geohashLocation = None
+        self.geohash = None
+
+    def addProbe(self, name, func, ttl, default=None):
+        """ Register a probe
+
+        :param name: Name the result is retrieved with
+        :type name: str
+        :param func: Callable taking no arguments, run on the thread calling refresh()
+        :type func: function
+        :param ttl: Seconds a result remains valid for
+        :type ttl: float
+        :param default: Value returned until the probe first succeeds
+        """
+        with self.lock:
+            self.probes[name] = {'func': func, 'ttl': ttl, 'expires': 0, 'value': default}
+
+    def refresh(self):
+        """ Run every probe whose result has expired, a failed probe keeps its previous value
+
+        :return: A list of the names of probes that were run
+        :rtype: list
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = [(name, probe) for name, probe in self.probes.items() if probe['expires'] <= now]
+
+        refreshed = []
+        for name, probe in due:
+            probe['expires'] = now + probe['ttl']
+            try:
+                value = probe['func']()
+            except Exception as e:
+                self.logger.error("Housekeeping probe {} failed, reason {}".format(name, e))
+                continue
+
+            with self.lock:
+                probe['value'] = value
+            refreshed.append(name)
+
+        return refreshed
+
+    def get(self, name):
+        with self.lock:
+            return self.probes[name]['value']
+
+    def getGeohash(self, lat, lon):
+        """ Returns the geohash of a location, only recomputed once it has moved beyond the threshold """
+        if self.geohashLocation is None or \
+            _distance(self.geohashLocation, (lat, lon)) > self.geohashThreshold:
+            self.geohash = geohash.encode(lat, lon)
+            self.geohashLocation = (lat, lon)
+        return self.geohash
+
+def _distance(first, second):
+    """ Approximate distance in metres between two (lat, lon) pairs, accurate at the scale of the threshold """
+    lat1, lon1 = map(math.radians, first)
+    lat2, lon2 = map(math.radians, second)
+    x = (lon2 - lon1) * math.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+    return math.hypot(x, y) * EARTH_RADIUS
@@ -0,0 +1,137 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Pooled HTTP transport helper class
+'''
+
+from DesignSpark.ESDK import AppLogger
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+import base64
+import requests
+import threading
+import time
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+_transports = []
+_transportsLock = threading.Lock()
+
+class HttpTransport:
+    """ Keep-alive HTTP client for a single endpoint.
+
+    Connections are pooled by a session of their own and reused between posts, so TCP and TLS handshakes
+    are only paid when a connection is first opened or has been dropped by the server. Credentials are
+    encoded into an Authorization header once, and every request has connect and read timeouts.
+
+    :param url: Endpoint URL
+    :type url: str
+    :param username: Basic authentication username, defaults to None for no authentication
+    :type username: str, optional
+    :param password: Basic authentication password
+    :type password: str, optional
+    :param headers: Headers sent with every request
+    :type headers: dict, optional
+    :param poolSize: Maximum number of connections kept open, defaults to 2
+    :type poolSize: int, optional
+    """
+    def __init__(self, url, username=None, password=None, debug=False, loggingLevel='full', headers=None, \
+        connectTimeout=CONNECT_TIMEOUT, readTimeout=READ_TIMEOUT, poolSize=2):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.url = url
+        self.name = urlparse(url).netloc
+        self.timeout = (connectTimeout, readTimeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if headers:
+            self.session.headers.update(headers)
+        if username is not None:
+            credentials = base64.b64encode("{}:{}".format(username, password).encode()).decode()
+            self.session.headers["Authorization"] = "Basic {}".format(credentials)
+
+        self.statsLock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "bytesSent": 0,
+            "lastLatency": 0,
+            "totalLatency": 0
+        }
+
+        with _transportsLock:
+            _transports.append(self)
+
+    def post(self, data, headers=None):
+        """ Post data to the endpoint, exceptions such as timeouts are counted as errors and raised
+
+        :return: The response, whatever its status code
+        :rtype: requests.Response
+        """
+        start = time.monotonic()
+        try:
+            response = self.session.post(self.url, data=data, headers=headers, timeout=self.timeout)
+        except Exception:
+            self.__record(start, 0, True)
+            raise
+
+        self.__record(start, len(data), not 200 <= response.status_code <= 299)
+        return response
+
+    def __record(self, start, sent, error):
+        latency = round(time.monotonic() - start, 3)
+        with self.statsLock:
+            self.stats["requests"] += 1
+            self.stats["bytesSent"] += sent
+            self.stats["lastLatency"] = latency
+            self.stats["totalLatency"] = round(self.stats["totalLatency"] + latency, 3)
+            if error:
+                self.stats["errors"] += 1
+
+    def getStats(self):
+        """ Returns a copy of the request, error, byte and latency counters """
+        with self.statsLock:
+            return dict(self.stats)
+
+    def close(self):
+        with _transportsLock:
+            if self in _transports:
+                _transports.remove(self)
+        self.session.close()
+
+def getTransportStats():
+    """ Returns the counters of every open transport, keyed on endpoint host
+
+    :return: A dictionary containing:
+
+    .. code-block:: text
+
+        {
+            "prometheus-prod-01-eu-west-0.grafana.net":{
+                "requests":12,
+                "errors":0,
+                "bytesSent":10240,
+                "lastLatency":0.182,
+                "totalLatency":2.61
+            }
+        }
+
+    :rtype: dict
+    """
+    with _transportsLock:
+        transports = list(_transports)
+
+    stats = {}
+    for transport in transports:
+        # Endpoints on the same host, such as a Prometheus and Loki pair, are summed
+        entry = stats.setdefault(transport.name, {})
+        for key, value in transport.getStats().items():
+            if key == "lastLatency":
+                entry[key] = max(entry.get(key, 0), value)
+            else:
+                entry[key] = round(entry.get(key, 0) + value, 3)
+    return stats
@@ -0,0 +1,163 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Per-interval aggregation of sensor readings
+'''
+
+import math
+
+# Aggregates reported for each series, in the order they are exported
+STATISTICS = ("count", "min", "max", "mean", "last", "p95")
+
+class IntervalAggregator:
+    """ Keeps count, minimum, maximum, mean, last value and an estimated 95th percentile for each series.
+
+    Every sample is added in constant time and memory, and collect() returns the aggregates since it
+    was last called before starting a new interval.
+    """
+    def __init__(self):
+        self.series = {}
+
+    def add(self, key, timestamp, value):
+        """ Add a sample to the current interval of a series
+
+        :param key: Series key
+        :param timestamp: Sample time in milliseconds
+        :type timestamp: int
+        :param value: Sample value
+        :type value: float
+        """
+        if math.isnan(value):
+            return
+
+        aggregate = self.series.get(key)
+        if aggregate is None:
+            aggregate = _Aggregate()
+            self.series[key] = aggregate
+        aggregate.add(timestamp, value)
+
+    def collect(self):
+        """ Returns the aggregates of the interval just ended and starts the next
+
+        :return: A dictionary of (timestamp of the last sample, {statistic: value}) tuples keyed on series key
+        :rtype: dict
+        """
+        series = self.series
+        self.series = {}
+        return {key: (aggregate.timestamp, aggregate.getStatistics()) for key, aggregate in series.items()}
+
+class _Aggregate:
+    def __init__(self):
+        self.count = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.total = 0.0
+        self.last = None
+        self.timestamp = None
+        self.p95 = P2Quantile(0.95)
+
+    def add(self, timestamp, value):
+        self.count += 1
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        self.total += value
+        self.last = value
+        self.timestamp = timestamp
+        self.p95.add(value)
+
+    def getStatistics(self):
+        return {
+            "count": self.count,
+            "min": self.minimum,
+            "max": self.maximum,
+            "mean": self.total / self.count,
+            "last": self.last,
+            "p95": self.p95.getValue()
+        }
+
+class P2Quantile:
+    """ Streaming quantile estimate using the P-squared algorithm of Jain and Chlamtac.
+
+    Five markers track the minimum, maximum, target quantile and points either side of it. Marker heights
+    are adjusted with piecewise-parabolic interpolation as samples arrive, so no samples are retained.
+    Until five samples have been seen the quantile of those held is returned.
+
+    :param quantile: Target quantile between 0 and 1
+    :type quantile: float
+    """
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        # Find the cell the sample falls in, extending the extremes if needed
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        positions = self.positions
+        for index in range(cell + 1, 5):
+            positions[index] += 1
+        for index in range(5):
+            self.desired[index] += self.increments[index]
+
+        # Adjust the three middle markers should they be a position or more from where they ought to be
+        for index in range(1, 4):
+            offset = self.desired[index] - positions[index]
+            if (offset >= 1 and positions[index + 1] - positions[index] > 1) or \
+                (offset <= -1 and positions[index - 1] - positions[index] < -1):
+                step = 1 if offset > 0 else -1
+                height = self.__parabolic(index, step)
+                if not heights[index - 1] < height < heights[index + 1]:
+                    height = self.__linear(index, step)
+                heights[index] = height
+                positions[index] += step
+
+    def __parabolic(self, index, step):
+        heights = self.heights
+        positions = self.positions
+        return heights[index] + step / (positions[index + 1] - positions[index - 1]) * ( \
+            (positions[index] - positions[index - 1] + step) * (heights[index + 1] - heights[index]) / \
+                (positions[index + 1] - positions[index]) + \
+            (positions[index + 1] - positions[index] - step) * (heights[index] - heights[index - 1]) / \
+                (positions[index] - positions[index - 1]))
+
+    def __linear(self, index, step):
+        heights = self.heights
+        positions = self.positions
+        return heights[index] + step * (heights[index + step] - heights[index]) / (positions[index + step] - positions[index])
+
+    def getValue(self):
+        """ Returns the current estimate, or None before any samples have been added.
+
+        The estimate is interpolated between the markers either side of the quantile's position, which
+        is the middle marker once enough samples have been seen for it to reach its desired position.
+        """
+        heights = self.heights
+        if not heights:
+            return None
+
+        positions = self.positions[:len(heights)]
+        target = 1 + (positions[-1] - 1) * self.quantile
+        for index in range(1, len(heights)):
+            if positions[index] >= target:
+                return heights[index - 1] + (heights[index] - heights[index - 1]) * \
+                    (target - positions[index - 1]) / (positions[index] - positions[index - 1])
+        return heights[0]
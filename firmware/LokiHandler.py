@@ -1,25 +1,53 @@
 import json
-import os
 import calendar
-import requests
+import gzip
 from DesignSpark.ESDK import AppLogger
-from datetime import datetime
-from urllib.parse import urlparse, quote_plus
+import HttpTransport
+import LokiSpool
+
+# Records read from the spool at a time while uploading
+UPLOAD_READ_SIZE = 1000
+
+# Uncompressed push request size limit in bytes
+UPLOAD_MAX_PAYLOAD = 1048576
+
+# Stream labels taken from spooled readings, and the names they are given
+STREAM_LABELS = (("friendlyname", "friendlyname"), ("hardwareId", "hwid"), ("location", "location"), \
+    ("project", "project"), ("tag", "tag"))
 
 class LokiHandler:
-    def __init__(self, path, debug=False, loggingLevel='full'):
+    def __init__(self, path, debug=False, loggingLevel='full', segmentSize=1024 * 1024, segmentAge=3600, compress=False):
         self.dataDirectory = path
         self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.debug = debug
+        self.loggingLevel = loggingLevel
+        self.transports = {}
+        self.spool = LokiSpool.LokiSpool(path, \
+            debug=debug, \
+            loggingLevel=loggingLevel, \
+            segmentSize=segmentSize, \
+            segmentAge=segmentAge, \
+            compress=compress)
+
+    def __getTransport(self, instance, key, url):
+        """ Returns a pooled transport for an endpoint and credentials, created on first use """
+        transport = self.transports.get((url, instance, key))
+        if transport is None:
+            transport = HttpTransport.HttpTransport(url, \
+                username=instance, \
+                password=key, \
+                debug=self.debug, \
+                loggingLevel=self.loggingLevel, \
+                headers={"Content-Type":"application/json", "Content-Encoding":"gzip"})
+            self.transports[(url, instance, key)] = transport
+        return transport
 
     def WriteLogFile(self, data, timestamp):
         try:
-            os.makedirs(self.dataDirectory, exist_ok=True)
-            builtpath = self.dataDirectory + str(timestamp) + ".json"
-            with open(builtpath, "w") as fh:
-                fh.write(json.dumps(data))
-            self.logger.debug("Written file {}".format(builtpath))
+            self.spool.append(timestamp, data)
+            self.logger.debug("Spooled data for {}".format(timestamp))
         except Exception as e:
-            self.logger.error("Could not write timestamp data file for Loki upload, reason {}".format(str(e)))
+            self.logger.error("Could not spool data for Loki upload, reason {}".format(str(e)))
 
     def dt2ts(self, dt):
         """Converts a datetime object to UTC timestamp
@@ -27,88 +55,120 @@ class LokiHandler:
         """
         return calendar.timegm(dt.utctimetuple())
 
-    def UploadLogFiles(self, instance, key, url='https://logs-prod-eu-west-0.grafana.net/loki/api/v1/push'):
-        """ Uploads log files found in the specified path to the Loki API endpoint """
-        totaluploaded = 0
-        totalfailed = 0
-
-        for filename in os.scandir(self.dataDirectory):
-            if filename.is_file():
-                self.logger.debug("Attempting to upload {}".format(filename))
-
-                # Filenames are timestamp.json, strip extension and then store for later use
-                ts = filename.name.strip('.json')
-
-                with open(filename, "r") as fh:
-                    datapoint = json.loads(fh.read())
-
-                datastruct = {
-                    "streams": [{
-                        "stream": {},
-                        "values": [],
-                    }]
-                }
-
-                # Stash away labels to be added to all data points
-                if 'friendlyname' in datapoint:
-                    datastruct['streams'][0]['stream']['friendlyname'] = datapoint.pop('friendlyname')
-                if 'hardwareId' in datapoint:
-                    datastruct['streams'][0]['stream']['hwid'] = datapoint.pop('hardwareId')
-                if 'location' in datapoint:
-                    datastruct['streams'][0]['stream']['location'] = datapoint.pop('location')
-                if 'project' in datapoint:
-                    datastruct['streams'][0]['stream']['project'] = datapoint.pop('project')
-                if 'geohash' in datapoint:
-                    geohash = datapoint.pop('geohash', None)
-
-                datastring = ""
-
-                # with labels removed all that should be left is dicts containing sensor data
-                for sensor, data in datapoint.items():
-                    # remove surplus "sensor" tag, not used due to multiple metrics being posted
-                    data.pop('sensor')
-
-                    for metric, value in data.items():
-                        datastring += "{}={} ".format(metric, value)
+    def UploadLogFiles(self, instance, key, url='https://logs-prod-eu-west-0.grafana.net/loki/api/v1/push', progress=None, cancelled=None, rateLimit=None):
+        """ Uploads spooled records to the Loki API endpoint, oldest first.
 
-                datastring += "geohash={}".format(geohash)
+        Records are grouped into streams by their labels and sent many to a gzip compressed request of up
+        to UPLOAD_MAX_PAYLOAD bytes, and are removed from the spool a request at a time once accepted.
+        Uploading stops at the first failure, leaving the remaining records for another time.
 
-                datastruct['streams'][0]['values'].append([ts, datastring])
-
-                jsonobject = json.dumps(datastruct)
-                self.logger.debug("Built JSON object of {}".format(jsonobject))
-
-                keysanitised = quote_plus(key)
-                baseurl = url
-                spliturl = urlparse(baseurl)
-
-                # Rebuild URL
-                completeurl = "{scheme}://{user}:{password}@{url}{path}".format(scheme=spliturl.scheme, \
-                user=instance, \
-                password=keysanitised, \
-                url=spliturl.netloc, \
-                path=spliturl.path)
+        :param progress: Called with the counts so far, bytes sent and records remaining after each request
+        :type progress: function, optional
+        :param cancelled: Event checked before each request, uploading stops once it is set
+        :type cancelled: threading.Event, optional
+        :param rateLimit: Limit on compressed bytes sent, waited on after each request
+        :type rateLimit: TokenBucket.TokenBucket, optional
+        """
+        totaluploaded = 0
+        totalfailed = 0
+        totalbytes = 0
+        transport = self.__getTransport(instance, key, url)
+
+        while True:
+            records = self.spool.read(UPLOAD_READ_SIZE)
+            if not records:
+                break
+
+            for streams, position, count in self.__buildRequests(records):
+                if cancelled is not None and cancelled.is_set():
+                    return {'success':totaluploaded, 'fail':totalfailed, 'bytes':totalbytes}
+
+                # Requests of only unreadable records have nothing to send
+                if streams:
+                    jsonobject = json.dumps({"streams": [{"stream": dict(labels), "values": values} \
+                        for labels, values in streams.items()]})
+                    self.logger.debug("Built request of {} record(s), {} bytes".format(count, len(jsonobject)))
+
+                    payload = gzip.compress(jsonobject.encode('utf-8'))
+                    try:
+                        response = transport.post(payload)
+                    except Exception as e:
+                        totalfailed += count
+                        self.logger.error("Failed posting {} record(s) to Loki, reason {}".format(count, e))
+                        return {'success':totaluploaded, 'fail':totalfailed, 'bytes':totalbytes}
+
+                    if not 200 <= response.status_code <= 299:
+                        totalfailed += count
+                        self.logger.error("Failed posting {} record(s) to Loki, HTTP {}, reason {}"\
+                            .format(count, response.status_code, response.text))
+                        return {'success':totaluploaded, 'fail':totalfailed, 'bytes':totalbytes}
+
+                    totaluploaded += count
+                    totalbytes += len(payload)
+                    self.logger.debug("Successfully posted {} record(s) to Loki, HTTP {}, success count {}"\
+                        .format(count, response.status_code, totaluploaded))
+
+                self.spool.ack(position)
+                if progress is not None:
+                    progress({'success':totaluploaded, 'fail':totalfailed, 'bytes':totalbytes, \
+                        'remaining':self.spool.getStats()['records']})
+
+                # Records are acknowledged before waiting, so a crash while waiting does not send them again
+                if rateLimit is not None and streams:
+                    rateLimit.consume(len(payload), cancelled)
+
+        return {'success':totaluploaded, 'fail':totalfailed, 'bytes':totalbytes, 'remaining':0}
+
+    def __buildRequests(self, records):
+        """ Returns a list of (streams, position of the last record, record count) tuples for spooled records,
+        streams being a dictionary of value lists keyed on label tuples.
+        """
+        requests = []
+        streams = {}
+        size = 0
+        count = 0
+        for position, ts, datapoint in records:
+            # Unreadable records are skipped, but are still removed along with the rest
+            if datapoint is not None:
+                labels, line = self.__buildEntry(datapoint)
+
+                # Approximate JSON size of the value, and of the stream should it be the first value in it
+                entrySize = len(line) + 32
+                streamSize = sum(len(name) + len(value) + 8 for name, value in labels) + 32
+                if count and size + entrySize + (streamSize if labels not in streams else 0) > UPLOAD_MAX_PAYLOAD:
+                    requests.append((streams, previousPosition, count))
+                    streams = {}
+                    size = 0
+                    count = 0
+
+                if labels not in streams:
+                    streams[labels] = []
+                    size += streamSize
+                streams[labels].append([str(ts), line])
+                size += entrySize
+                count += 1
+            previousPosition = position
 
-                headers = {
-                    "Content-Type":"application/json"
-                }
+        requests.append((streams, previousPosition, count))
+        return requests
 
-                response = requests.post(completeurl, headers=headers, data=jsonobject)
+    def __buildEntry(self, datapoint):
+        """ Returns the stream labels and logfmt line for a spooled reading """
+        labels = tuple(sorted((label, str(datapoint[name])) for name, label in STREAM_LABELS if name in datapoint))
 
-                if 200 <= response.status_code <= 299:
-                    totaluploaded += 1
-                    self.logger.debug("Successfully posted {} to Loki, HTTP {}, response {}, success count {}".format(filename, response.status_code, response.text, totaluploaded))
-                    os.remove(filename)
-                else:
-                    totalfailed += 1
-                    self.logger.error("Failed posting {} to Loki, HTTP {}, reason {}, fail count {}"\
-                        .format(filename, response.status_code, response.text, totalfailed))
+        # Everything other than labels is a dictionary of sensor data, the "sensor" version is left out
+        fields = []
+        for sensor, data in datapoint.items():
+            if isinstance(data, dict):
+                fields.extend("{}={}".format(metric, value) for metric, value in data.items() if metric != 'sensor')
+        fields.append("geohash={}".format(datapoint.get('geohash', None)))
 
-        return {'success':totaluploaded, 'fail':totalfailed}
+        return labels, " ".join(fields)
 
     def GetFileCount(self):
-        count = 0
-        for path in os.scandir(self.dataDirectory):
-            if path.is_file():
-                count += 1
-        return {"filecount":count}
\ No newline at end of file
+        """ Returns the number of spooled records waiting to be uploaded, along with the size of the spool """
+        stats = self.spool.getStats()
+        return {"filecount":stats['records'], "bytes":stats['bytes'], "segments":stats['segments']}
+
+    def close(self):
+        self.spool.close()
@@ -0,0 +1,334 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Segmented spool for offline Loki data
+'''
+
+from DesignSpark.ESDK import AppLogger
+import gzip
+import json
+import os
+import threading
+
+SEGMENT_EXTENSION = ".jsonl"
+COMPRESSED_EXTENSION = ".jsonl.gz"
+CHECKPOINT_FILE = "checkpoint"
+
+# Files written one per sample by earlier firmware, named after their timestamp in nanoseconds
+LEGACY_EXTENSION = ".json"
+MIGRATION_BATCH = 1000
+
+class LokiSpool:
+    """ Append-only spool of timestamped readings, one JSON object per line.
+
+    Records are appended to numbered segment files, a new segment being started once the current one
+    reaches segmentSize bytes or holds data more than segmentAge seconds old. Finished segments may be
+    gzip compressed. The position of the oldest record not yet uploaded is kept in a checkpoint file,
+    which is replaced atomically, and segments are deleted once every record in them has been uploaded.
+
+    Record counts are kept per segment, so backlog statistics do not depend on the size of the backlog.
+    Files left by earlier firmware, one per reading, are moved into the spool when it is opened.
+
+    :param path: Spool directory
+    :type path: str
+    :param segmentSize: Size in bytes at which a new segment is started, defaults to 1 MiB
+    :type segmentSize: int, optional
+    :param segmentAge: Age in seconds of the oldest record at which a new segment is started, defaults to 1 hour
+    :type segmentAge: int, optional
+    :param compress: Whether finished segments are gzip compressed, defaults to False
+    :type compress: bool, optional
+    """
+    def __init__(self, path, debug=False, loggingLevel='full', segmentSize=1024 * 1024, segmentAge=3600, compress=False):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.path = path
+        self.segmentSize = segmentSize
+        self.segmentAge = segmentAge
+        self.compress = compress
+        self.lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Segment number to whether it is compressed
+        self.segments = {}
+        for filename in os.listdir(self.path):
+            for extension, compressed in ((COMPRESSED_EXTENSION, True), (SEGMENT_EXTENSION, False)):
+                if filename.endswith(extension) and filename[:-len(extension)].isdigit():
+                    self.segments[int(filename[:-len(extension)])] = compressed
+                    break
+
+        # Only an uncompressed last segment may be appended to
+        if not self.segments or self.segments[max(self.segments)]:
+            self.segments[max(self.segments, default=0) + 1] = False
+            open(self.__segmentPath(max(self.segments)), 'ab').close()
+        self.activeSegment = max(self.segments)
+        self.__recoverTail()
+
+        self.counts = {}
+        self.bytes = 0
+        for segment in self.segments:
+            self.counts[segment] = len(self.__readLines(segment))
+            self.bytes += os.path.getsize(self.__segmentPath(segment))
+
+        self.activeSince = None
+        lines = self.__readLines(self.activeSegment, limit=1)
+        if lines:
+            self.activeSince = json.loads(lines[0][2])["ts"] / 1000000000
+
+        self.readSegment, self.readOffset, self.readIndex = self.__readCheckpoint()
+        self.count = sum(count for segment, count in self.counts.items() if segment > self.readSegment) + \
+            self.counts[self.readSegment] - self.readIndex
+
+        self.fh = open(self.__segmentPath(self.activeSegment), 'ab')
+        self.__migrateLegacyFiles()
+
+        self.logger.debug("Opened spool {} with {} record(s) in {} segment(s)".format(self.path, self.count, len(self.segments)))
+
+    def __segmentPath(self, segment, compressed=None):
+        if compressed is None:
+            compressed = self.segments[segment]
+        return os.path.join(self.path, "{:08d}{}".format(segment, COMPRESSED_EXTENSION if compressed else SEGMENT_EXTENSION))
+
+    def __recoverTail(self):
+        """ Truncate a partly written line left at the end of the active segment """
+        path = self.__segmentPath(self.activeSegment)
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        validSize = data.rfind(b'\n') + 1
+        if validSize != len(data):
+            self.logger.warning("Truncating {} from {} to {} bytes".format(path, len(data), validSize))
+            os.truncate(path, validSize)
+
+    def __readLines(self, segment, offset=0, limit=None):
+        """ Returns a list of (offset after the line, index after the line, line) for complete lines from offset """
+        opener = gzip.open if self.segments[segment] else open
+        lines = []
+        with opener(self.__segmentPath(segment), 'rb') as fh:
+            fh.seek(offset)
+            for line in fh:
+                # A line still being written to the active segment is left for next time
+                if not line.endswith(b'\n') or (limit is not None and len(lines) >= limit):
+                    break
+                offset += len(line)
+                lines.append((offset, len(lines) + 1, line))
+        return lines
+
+    def __readCheckpoint(self):
+        try:
+            with open(os.path.join(self.path, CHECKPOINT_FILE), 'r') as fh:
+                checkpoint = json.load(fh)
+            if checkpoint['segment'] in self.segments:
+                return checkpoint['segment'], checkpoint['offset'], checkpoint['index']
+        except (OSError, ValueError, KeyError):
+            pass
+        return min(self.segments), 0, 0
+
+    def __writeCheckpoint(self):
+        temporaryPath = os.path.join(self.path, CHECKPOINT_FILE + ".tmp")
+        with open(temporaryPath, 'w') as fh:
+            json.dump({'segment': self.readSegment, 'offset': self.readOffset, 'index': self.readIndex}, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temporaryPath, os.path.join(self.path, CHECKPOINT_FILE))
+
+    def __migrateLegacyFiles(self):
+        """ Append files written one per reading by earlier firmware to the spool, oldest first """
+        legacyFiles = sorted((int(filename[:-len(LEGACY_EXTENSION)]), filename) for filename in os.listdir(self.path) \
+            if filename.endswith(LEGACY_EXTENSION) and filename[:-len(LEGACY_EXTENSION)].isdigit())
+        if not legacyFiles:
+            return
+
+        # Written in batches and synced once per batch, as a long offline period may have left many files
+        migrated = 0
+        for start in range(0, len(legacyFiles), MIGRATION_BATCH):
+            paths = []
+            with self.lock:
+                for timestamp, filename in legacyFiles[start:start + MIGRATION_BATCH]:
+                    path = os.path.join(self.path, filename)
+                    try:
+                        with open(path, 'r') as fh:
+                            data = json.load(fh)
+                    except (OSError, ValueError) as e:
+                        self.logger.error("Could not migrate {} to spool, reason {}".format(path, e))
+                        continue
+                    self.__write(timestamp, data)
+                    paths.append(path)
+                os.fsync(self.fh.fileno())
+
+            # Files are only removed once their data is on disk in the spool
+            for path in paths:
+                os.remove(path)
+            migrated += len(paths)
+        self.logger.info("Migrated {} offline data file(s) to spool".format(migrated))
+
+    def append(self, timestamp, data):
+        """ Append a reading, returning once it is on disk
+
+        :param timestamp: Reading time in nanoseconds since the epoch
+        :type timestamp: int
+        :param data: Reading to be spooled
+        :type data: dict
+        """
+        with self.lock:
+            self.__write(timestamp, data)
+            os.fsync(self.fh.fileno())
+
+    def __write(self, timestamp, data):
+        line = (json.dumps({"ts": timestamp, "data": data}) + "\n").encode('utf-8')
+        if self.activeSince is not None and (self.fh.tell() >= self.segmentSize or \
+            timestamp / 1000000000 - self.activeSince >= self.segmentAge):
+            self.__rotate()
+
+        self.fh.write(line)
+        self.fh.flush()
+
+        if self.activeSince is None:
+            self.activeSince = timestamp / 1000000000
+        self.counts[self.activeSegment] += 1
+        self.count += 1
+        self.bytes += len(line)
+
+    def __rotate(self):
+        """ Finish the active segment, compressing it if enabled, and start the next """
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+        finished = self.activeSegment
+        self.activeSegment += 1
+        self.segments[self.activeSegment] = False
+        self.counts[self.activeSegment] = 0
+        self.fh = open(self.__segmentPath(self.activeSegment), 'ab')
+        self.activeSince = None
+
+        if self.compress:
+            self.__compress(finished)
+
+        self.logger.debug("Started spool segment {}".format(self.__segmentPath(self.activeSegment)))
+
+    def __compress(self, segment):
+        """ Replace a finished segment with a gzip compressed copy """
+        # The checkpoint offset counts uncompressed bytes, so it is still valid once a segment is compressed
+        path = self.__segmentPath(segment)
+        compressedPath = self.__segmentPath(segment, compressed=True)
+        with open(path, 'rb') as source, gzip.open(compressedPath + ".tmp", 'wb') as destination:
+            destination.write(source.read())
+
+        # Keeping the modification time, the time of the newest data, leaves retention order unchanged
+        modified = os.path.getmtime(path)
+        os.utime(compressedPath + ".tmp", (modified, modified))
+        os.replace(compressedPath + ".tmp", compressedPath)
+        self.bytes += os.path.getsize(compressedPath) - os.path.getsize(path)
+        self.segments[segment] = True
+        os.remove(path)
+
+    def getFinishedSegments(self):
+        """ Returns a list of (segment, path, compressed) tuples for segments no longer written to, oldest first """
+        with self.lock:
+            return [(segment, self.__segmentPath(segment), self.segments[segment]) \
+                for segment in sorted(self.segments) if segment != self.activeSegment]
+
+    def compressSegment(self, segment):
+        """ Compress a finished segment, used by retention """
+        with self.lock:
+            if segment in self.segments and segment != self.activeSegment and not self.segments[segment]:
+                self.__compress(segment)
+
+    def removeSegment(self, segment):
+        """ Delete a finished segment whether or not it has been uploaded, used by retention
+
+        :return: The number of records not yet uploaded that were dropped
+        :rtype: int
+        """
+        with self.lock:
+            if segment not in self.segments or segment == self.activeSegment:
+                return 0
+
+            dropped = 0
+            if segment > self.readSegment:
+                dropped = self.counts[segment]
+            elif segment == self.readSegment:
+                dropped = self.counts[segment] - self.readIndex
+                self.readSegment, self.readOffset, self.readIndex = min(s for s in self.segments if s > segment), 0, 0
+                self.__writeCheckpoint()
+
+            self.count -= dropped
+            self.bytes -= os.path.getsize(self.__segmentPath(segment))
+            os.remove(self.__segmentPath(segment))
+            del self.segments[segment]
+            del self.counts[segment]
+            return dropped
+
+    def read(self, limit):
+        """ Returns up to limit of the oldest records not yet acknowledged
+
+        :return: A list of (position, timestamp, data) tuples, oldest first
+        :rtype: list
+        """
+        records = []
+        with self.lock:
+            segment, offset, index = self.readSegment, self.readOffset, self.readIndex
+            for segment in sorted(s for s in self.segments if s >= self.readSegment):
+                if segment != self.readSegment:
+                    offset, index = 0, 0
+                for lineOffset, lineIndex, line in self.__readLines(segment, offset, limit - len(records)):
+                    position = (segment, lineOffset, index + lineIndex)
+                    try:
+                        record = json.loads(line)
+                        records.append((position, record["ts"], record["data"]))
+                    except (ValueError, KeyError) as e:
+                        self.logger.error("Skipping unreadable spool record in segment {}, reason {}".format(segment, e))
+                        records.append((position, None, None))
+                if len(records) >= limit:
+                    break
+        return records
+
+    def ack(self, position):
+        """ Acknowledge every record up to and including that at position, deleting finished segments """
+        segment, offset, index = position
+        with self.lock:
+            # Retention may remove a segment while it is being uploaded, its records having been counted as
+            # dropped then, so acknowledge up to the start of the next segment instead
+            if segment not in self.segments:
+                segment, offset, index = min(s for s in self.segments if s > segment), 0, 0
+
+            # Nothing to do for records already acknowledged or removed
+            if (segment, index) <= (self.readSegment, self.readIndex):
+                return
+
+            if segment == self.readSegment:
+                self.count -= index - self.readIndex
+            else:
+                self.count -= self.counts[self.readSegment] - self.readIndex + index + \
+                    sum(self.counts[s] for s in self.segments if self.readSegment < s < segment)
+
+            self.readSegment, self.readOffset, self.readIndex = segment, offset, index
+
+            # Move on from a finished segment, so that it and any before it can go
+            if segment != self.activeSegment and index == self.counts[segment]:
+                self.readSegment, self.readOffset, self.readIndex = min(s for s in self.segments if s > segment), 0, 0
+
+            # Once everything is uploaded the active segment is emptied, the checkpoint going first so that
+            # a crash in between repeats an upload rather than losing data
+            emptied = segment == self.activeSegment and index == self.counts[segment]
+            if emptied:
+                self.readOffset, self.readIndex = 0, 0
+            self.__writeCheckpoint()
+
+            if emptied:
+                self.bytes -= self.fh.tell()
+                self.fh.truncate(0)
+                self.counts[segment] = 0
+                self.activeSince = None
+
+            for finished in [s for s in self.segments if s < self.readSegment]:
+                self.bytes -= os.path.getsize(self.__segmentPath(finished))
+                os.remove(self.__segmentPath(finished))
+                del self.segments[finished]
+                del self.counts[finished]
+
+    def getStats(self):
+        """ Returns the number of records waiting to be uploaded, along with the size and number of segments """
+        return {"records": self.count, "bytes": self.bytes, "segments": len(self.segments)}
+
+    def close(self):
+        with self.lock:
+            self.fh.close()
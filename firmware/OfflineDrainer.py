@@ -0,0 +1,82 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Automatic upload of the offline backlog
+'''
+
+from DesignSpark.ESDK import AppLogger
+import random
+import time
+
+# Remote writes must have succeeded this recently, in seconds, for the connection to count as healthy
+HEALTHY_AGE = 600
+
+# Delay in seconds before trying again after a failed upload, doubled on each further failure up to the maximum
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 3600
+
+class OfflineDrainer:
+    """ Starts uploads of spooled offline data once remote writes are succeeding again.
+
+    Remote write success and failure times are used as a measure of connectivity, so no requests are made
+    just to find out whether the network is back. Uploads are run as upload jobs, which the caller should
+    rate limit, and are cancelled should remote writes start failing. After a failed upload, further
+    attempts wait with exponential backoff.
+
+    :param uploadJobs: Upload job manager the uploads are run by
+    :type uploadJobs: UploadJobManager.UploadJobManager
+    :param upload: Upload function, as taken by UploadJobManager.start()
+    :type upload: function
+    :param getBacklog: Callable returning the number of records waiting to be uploaded
+    :type getBacklog: function
+    :param remoteWriteTimestamps: Dictionary of remoteWriteSuccess and remoteWriteFail times, updated by PrometheusWriter
+    :type remoteWriteTimestamps: dict
+    """
+    def __init__(self, uploadJobs, upload, getBacklog, remoteWriteTimestamps, debug=False, loggingLevel='full'):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.uploadJobs = uploadJobs
+        self.upload = upload
+        self.getBacklog = getBacklog
+        self.remoteWriteTimestamps = remoteWriteTimestamps
+        self.jobId = None
+        self.failures = 0
+        self.retryAt = 0
+
+    def isHealthy(self):
+        """ Returns whether the latest remote write succeeded, and did so recently """
+        success = self.remoteWriteTimestamps['remoteWriteSuccess']
+        return success > self.remoteWriteTimestamps['remoteWriteFail'] and time.time() - success <= HEALTHY_AGE
+
+    async def check(self):
+        """ Start, pause or follow up an upload, to be run periodically """
+        healthy = self.isHealthy()
+
+        if self.jobId is not None:
+            status = self.uploadJobs.getStatus(self.jobId)
+            if status['state'] in ("queued", "running"):
+                if not healthy:
+                    self.logger.info("Remote writes failing, pausing offline upload")
+                    self.uploadJobs.cancel(self.jobId)
+                return
+
+            self.jobId = None
+            if status['state'] == "failed":
+                self.__backoff()
+            elif status['state'] == "done":
+                self.failures = 0
+
+        if not healthy or time.monotonic() < self.retryAt or self.uploadJobs.getActiveJob() is not None:
+            return
+
+        backlog = self.getBacklog()
+        if backlog:
+            self.logger.info("Remote writes succeeding, uploading {} offline record(s)".format(backlog))
+            self.jobId = self.uploadJobs.start(None, self.upload)['id']
+
+    def __backoff(self):
+        self.failures += 1
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (self.failures - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.retryAt = time.monotonic() + delay
+        self.logger.warning("Offline upload failed, trying again in {:.0f}s".format(delay))
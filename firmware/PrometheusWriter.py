@@ -6,151 +6,171 @@ Prometheus writer helper class
 '''
 
 from DesignSpark.ESDK import AppLogger
-import requests
-import snappy
-import prometheus_pb2
-#from prometheus_pb2 import TimeSeries, Label, Labels, Sample, WriteRequest
+import HttpTransport
 from datetime import datetime
-from urllib.parse import urlparse, quote_plus
-import calendar
-import copy
+import WriteAheadQueue
+import random
+import threading
+import time
+
+# Default uncompressed request size limit in bytes
+MAX_PAYLOAD = 1048576
+
+# Delay in seconds before the first retry of a failed write, doubled on each further failure up to the maximum
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 600
+
+def getStaticLabels(friendlyName, hwid, additionalLabels={}):
+    """ Returns the labels common to every series, including any additional labels present in the dictionary """
+    labels = {"friendlyname": friendlyName, "hwid": hwid}
+    for name in ("location", "project", "tag"):
+        if name in additionalLabels:
+            labels[name] = additionalLabels[name]
+    return labels
+
+def getSeriesLabels(staticLabels, metric, sensorType, location):
+    """ Returns the labels of a series as a list of (name, value) tuples.
+
+    Labels are sorted by name as required by remote write, and empty labels are left out.
+    """
+    labels = dict(staticLabels)
+    labels.update({
+        "__name__": metric.replace('.', '_'),
+        "geohash": location,
+        "sensor": sensorType
+    })
+    return [(name, str(labels[name])) for name in sorted(labels) if labels[name]]
 
 class PrometheusWriter:
-    def __init__(self, configDict, debug=False, hwid=0, loggingLevel='full', additionalLabels={}, remoteWriteTimestamps=None):
+    def __init__(self, configDict, debug=False, hwid=0, loggingLevel='full', additionalLabels={}, remoteWriteTimestamps=None, queuePath=None):
         self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
         self.configDict = configDict
         self.hardwareId = hwid
         self.friendlyName = configDict["friendlyname"]
         self.remoteWriteTimestamps = remoteWriteTimestamps
 
-        # Add additional Prometheus labels from dictionary, if dictionary is not empty
-        if additionalLabels:
-            if "location" in additionalLabels:
-                self.locationLabel = additionalLabels["location"]
-
-            if "project" in additionalLabels:
-                self.projectLabel = additionalLabels["project"]
-
-            if "tag" in additionalLabels:
-                self.tagLabel = additionalLabels["tag"]
-
-    def __dt2ts(self, dt):
-        """Converts a datetime object to UTC timestamp
-        naive datetime will be considered UTC.
-        """
-        return calendar.timegm(dt.utctimetuple())
-
-    def writeData(self, sensorData):
-        """ Writes Prometheus data to a specified endpoint """
-        # Deep copy the dictionary as it's nested, and we need to pop bits out without affecting other running threads
-        sensorDataArray = copy.deepcopy(sensorData)
-
-        # Strip other keys so all we're left with is sensor data to iterate over
-        location = sensorDataArray.pop("geohash", None)
-        hwid = sensorDataArray.pop("hardwareId", None)
-
-        # Perform check to ensure sensor data exists in dict
-        if sensorDataArray:
-            writeRequest = prometheus_pb2.WriteRequest()
-            for sensor, sd in sensorDataArray.items():
-                self.logger.debug("PROM sensorData sensor {} dict {}".format(sensor, sd))
-                # Remove sensor type from rest of metrics
-                sensorType = sd.pop("sensor", None)
-
-                for metric, value in sd.items():
-                    metric = metric.replace('.', '_')
-                    series = writeRequest.timeseries.add()
-                    self.logger.debug("Metric {}, value {}".format(metric, value))
-
-                    # Name label is always required
-                    label = series.labels.add()
-                    label.name = "__name__"
-                    label.value = metric
-
-                    # Add location
-                    label = series.labels.add()
-                    label.name = "geohash"
-                    label.value = location
-
-                    # Add friendly name
-                    label = series.labels.add()
-                    label.name = "friendlyname"
-                    label.value = self.friendlyName
-
-                    # Add hardware ID
-                    label = series.labels.add()
-                    label.name = "hwid"
-                    label.value = self.hardwareId
-
-                    # Add sensor type
-                    label = series.labels.add()
-                    label.name = "sensor"
-                    label.value = sensorType
-
-                    # Attempt to add additional labels if they exist
-                    try:
-                        label = series.labels.add()
-                        label.name = "location"
-                        label.value = self.locationLabel
-                    except AttributeError:
-                        # self.locationLabel doesn't exist, don't add to Prometheus
-                        pass
-
-                    try:
-                        label = series.labels.add()
-                        label.name = "project"
-                        label.value = self.projectLabel
-                    except AttributeError:
-                        # self.projectLabel doesn't exist, don't add to Prometheus
-                        pass
-
-                    try:
-                        label = series.labels.add()
-                        label.name = "tag"
-                        label.value = self.tagLabel
-                    except AttributeError:
-                        # self.tagLabel doesn't exist, don't add to Prometheus
-                        pass
-
-                    # Add metric value
-                    sample = series.samples.add()
-                    sample.value = value
-                    sample.timestamp = self.__dt2ts(datetime.utcnow()) * 1000
-
-            uncompressed = writeRequest.SerializeToString()
-            compressed = snappy.compress(uncompressed)
-
-            username = self.configDict["instance"]
-            password = quote_plus(self.configDict["key"])
-            baseUrl = self.configDict["url"]
-            splitUrl = urlparse(baseUrl)
-
-            # Rebuild URL
-            url = "{scheme}://{user}:{password}@{url}{path}".format(scheme=splitUrl.scheme, \
-                user=username, \
-                password=password, \
-                url=splitUrl.netloc, \
-                path=splitUrl.path)
-
-            headers = {
+        # Connections to the endpoint are kept open between writes
+        self.transport = HttpTransport.HttpTransport(configDict["url"], \
+            username=configDict["instance"], \
+            password=configDict["key"], \
+            debug=debug, \
+            loggingLevel=loggingLevel, \
+            headers={
                 "Content-Encoding": "snappy",
                 "Content-Type": "application/x-protobuf",
                 "X-Prometheus-Remote-Write-Version": "0.1.0",
                 "User-Agent": "metrics-worker"
-            }
-
-            response = requests.post(url, headers=headers, data=compressed)
-
-            # Check for valid success code (not using response.ok as this includes 2xx and 3xx codes)
-            if 200 <= response.status_code <= 299:
-                self.logger.debug("Successfully posted Prometheus data, reponse {}".format(response.text))
-                if self.remoteWriteTimestamps:
-                    self.remoteWriteTimestamps['remoteWriteSuccess'] = int(datetime.now().timestamp())
-            else:
-                self.logger.error("Failed posting Prometheus data! Status code {}, response {}".format(response.status_code, response.text))
-                if self.remoteWriteTimestamps:
-                    self.remoteWriteTimestamps['remoteWriteFail'] = int(datetime.now().timestamp())
-                raise Exception("Failed posting Prometheus data. code {}, response {}".format(response.status_code, response.text))
-                #except Exception as e:
-                #    self.logger.error("Could not post Prometheus data, reason {}".format(e))
-            
\ No newline at end of file
+            })
+
+        self.staticLabels = getStaticLabels(self.friendlyName, self.hardwareId, additionalLabels)
+
+        # Uncompressed request size above which a batch is split across several requests
+        self.maxPayload = int(configDict.get("maxpayload", MAX_PAYLOAD))
+
+        # Whether per-interval aggregates are written alongside each reading
+        self.aggregates = bool(configDict.get("aggregates", False))
+
+        # Optional durable queue, writes are then retried until they succeed or reach the queue caps
+        self.queue = None
+        if queuePath is not None:
+            self.queue = WriteAheadQueue.WriteAheadQueue(queuePath, \
+                debug=debug, \
+                loggingLevel=loggingLevel, \
+                maxBytes=int(configDict.get("queuesize", 64)) * 1024 * 1024, \
+                maxAge=int(configDict.get("queueage", 24)) * 3600)
+        self.drainLock = threading.Lock()
+        self.failures = 0
+        self.retryAt = 0
+
+    def writePayloads(self, payloads, oldest):
+        """ Writes compressed requests, as encoded by RemoteWriteDispatcher, to a specified endpoint
+
+        :param payloads: Snappy compressed write requests, in time order
+        :type payloads: list
+        :param oldest: Timestamp in milliseconds of the oldest sample in the requests
+        :type oldest: int
+        """
+        # Queued payloads are on disk before any attempt to send them, and are sent in the order written
+        if self.queue is not None:
+            for payload in payloads:
+                self.queue.put(payload, oldest)
+            self.drain()
+        else:
+            for payload in payloads:
+                self.__post(payload)
+
+    def drain(self):
+        """ Send queued payloads oldest first, stopping at the first failure and backing off before trying again """
+        if self.queue is None or not self.drainLock.acquire(blocking=False):
+            return
+
+        try:
+            if time.monotonic() < self.retryAt:
+                return
+
+            while True:
+                record = self.queue.peek()
+                if record is None:
+                    break
+
+                position, timestamp, payload = record
+                try:
+                    self.__post(payload)
+                except RemoteWriteError as e:
+                    if e.retryable:
+                        self.__backoff()
+                        return
+                    # Retrying a request the endpoint has rejected would block the queue for good
+                    self.logger.error("Dropping queued payload from {} rejected by endpoint".format(timestamp))
+                except Exception as e:
+                    self.logger.error("Could not post Prometheus data, reason {}".format(e))
+                    self.__backoff()
+                    return
+
+                self.queue.ack(position)
+                self.failures = 0
+        finally:
+            self.drainLock.release()
+
+    def __backoff(self):
+        """ Exponential backoff with jitter, so that devices recovering from a shared outage spread out their retries """
+        self.failures += 1
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (self.failures - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.retryAt = time.monotonic() + delay
+        self.logger.warning("Retrying Prometheus write in {:.0f}s, {} payload(s) queued".format(delay, self.queue.getCount()))
+
+    def getQueuedCount(self):
+        return self.queue.getCount() if self.queue is not None else 0
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.close()
+
+    def __post(self, compressed):
+        """ Post a compressed write request, raising RemoteWriteError if it is not accepted """
+        try:
+            response = self.transport.post(compressed)
+        except Exception as e:
+            if self.remoteWriteTimestamps:
+                self.remoteWriteTimestamps['remoteWriteFail'] = int(datetime.now().timestamp())
+            raise RemoteWriteError("Could not post Prometheus data, reason {}".format(e), True)
+
+        # Check for valid success code (not using response.ok as this includes 2xx and 3xx codes)
+        if 200 <= response.status_code <= 299:
+            self.logger.debug("Successfully posted Prometheus data, reponse {}".format(response.text))
+            if self.remoteWriteTimestamps:
+                self.remoteWriteTimestamps['remoteWriteSuccess'] = int(datetime.now().timestamp())
+        else:
+            self.logger.error("Failed posting Prometheus data! Status code {}, response {}".format(response.status_code, response.text))
+            if self.remoteWriteTimestamps:
+                self.remoteWriteTimestamps['remoteWriteFail'] = int(datetime.now().timestamp())
+            # Client errors other than rate limiting will fail again however often they are retried
+            retryable = not 400 <= response.status_code <= 499 or response.status_code == 429
+            raise RemoteWriteError("Failed posting Prometheus data. code {}, response {}".format(response.status_code, response.text), retryable)
+
+class RemoteWriteError(Exception):
+    """ Raised when a write request is not accepted, retryable is False if the endpoint rejected it outright """
+    def __init__(self, message, retryable):
+        super().__init__(message)
+        self.retryable = retryable
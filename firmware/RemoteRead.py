@@ -0,0 +1,131 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Prometheus remote read handler
+'''
+
+from DesignSpark.ESDK import AppLogger
+import PrometheusWriter
+import RemoteWriteEncoder
+import prometheus_pb2
+import snappy
+import re
+import threading
+
+class RemoteReadHandler:
+    """ Answers Prometheus remote read requests from the local store.
+
+    Stored series are given the same labels as those written by PrometheusWriter, with the sensor type
+    and geohash taken from the latest reading. Series are selected through an inverted index of label
+    values, so equality matchers narrow the candidates before any other matcher is tested, and each
+    series is then read for just the requested range by the store's own time index.
+
+    :param store: Raw readings store
+    :type store: SeriesStore.SeriesStore
+    :param staticLabels: Labels common to every series, as returned by PrometheusWriter.getStaticLabels
+    :type staticLabels: dict
+    :param getSnapshot: Callable returning the latest snapshot
+    :type getSnapshot: function
+    """
+    def __init__(self, store, staticLabels, getSnapshot, debug=False, loggingLevel='full'):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.store = store
+        self.staticLabels = staticLabels
+        self.getSnapshot = getSnapshot
+        self.lock = threading.Lock()
+        self.indexKey = None
+        self.seriesLabels = {}
+        self.postings = {}
+        self.encoder = RemoteWriteEncoder.RemoteWriteEncoder()
+
+    def __refreshIndex(self):
+        """ Rebuild the index should the stored series or the labels taken from the latest reading change """
+        sensorData = self.getSnapshot().sensorData
+        location = sensorData.get("geohash", None)
+        sensorTypes = {sensor: sd.get("sensor", None) for sensor, sd in sensorData.items() if isinstance(sd, dict)}
+        names = tuple(sorted(self.store.getSeriesNames()))
+
+        indexKey = (names, location, tuple(sorted(sensorTypes.items())))
+        if indexKey == self.indexKey:
+            return
+
+        self.seriesLabels = {}
+        self.postings = {}
+        for name in names:
+            sensor, metric = name.split('.', 1)
+            labels = PrometheusWriter.getSeriesLabels(self.staticLabels, metric, sensorTypes.get(sensor), location)
+            self.seriesLabels[name] = dict(labels)
+            for label, value in labels:
+                self.postings.setdefault(label, {}).setdefault(value, set()).add(name)
+
+        self.indexKey = indexKey
+        self.logger.debug("Indexed {} series".format(len(names)))
+
+    def select(self, matchers):
+        """ Returns stored series matching every one of a list of LabelMatchers
+
+        :return: A list of (series name, labels) tuples, labels being a list of (name, value) tuples sorted by name
+        :rtype: list
+        """
+        with self.lock:
+            self.__refreshIndex()
+
+            # Equality matchers on a non-empty value are answered from the index
+            candidates = None
+            remaining = []
+            for matcher in matchers:
+                if matcher.type == prometheus_pb2.LabelMatcher.EQ and matcher.value:
+                    matched = self.postings.get(matcher.name, {}).get(matcher.value, set())
+                    candidates = matched if candidates is None else candidates & matched
+                else:
+                    remaining.append(matcher)
+
+            if candidates is None:
+                candidates = set(self.seriesLabels.keys())
+
+            # A label a series does not have compares as an empty value
+            tests = [_compileMatcher(matcher) for matcher in remaining]
+            return [(name, sorted(self.seriesLabels[name].items())) for name in sorted(candidates) \
+                if all(test(self.seriesLabels[name].get(label, "")) for label, test in tests)]
+
+    def handle(self, body):
+        """ Returns the snappy compressed ReadResponse for a snappy compressed ReadRequest
+
+        :raises ValueError: If the request cannot be decoded or has an invalid matcher
+        """
+        readRequest = prometheus_pb2.ReadRequest()
+        try:
+            readRequest.ParseFromString(snappy.decompress(body))
+        except Exception as e:
+            raise ValueError("Could not decode read request, reason {}".format(e))
+
+        results = []
+        for query in readRequest.queries:
+            batch = []
+            for name, labels in self.select(query.matchers):
+                # Remote read time ranges include the end timestamp
+                samples = self.store.query(name, query.start_timestamp_ms, query.end_timestamp_ms + 1)
+                if samples:
+                    batch.append((RemoteWriteEncoder.encodeLabels(labels), samples))
+            results.append(self.encoder.encode(batch))
+
+        self.logger.debug("Answered {} read queries".format(len(results)))
+        return snappy.compress(RemoteWriteEncoder.encodeReadResponse(results))
+
+def _compileMatcher(matcher):
+    """ Returns a (label name, test) pair, where test is a function of the label value """
+    if matcher.type == prometheus_pb2.LabelMatcher.EQ:
+        return matcher.name, lambda value: value == matcher.value
+    if matcher.type == prometheus_pb2.LabelMatcher.NEQ:
+        return matcher.name, lambda value: value != matcher.value
+
+    # Prometheus regular expressions are anchored at both ends
+    try:
+        pattern = re.compile(matcher.value)
+    except re.error as e:
+        raise ValueError("Invalid regular expression {}, reason {}".format(matcher.value, e))
+
+    if matcher.type == prometheus_pb2.LabelMatcher.RE:
+        return matcher.name, lambda value: pattern.fullmatch(value) is not None
+    return matcher.name, lambda value: pattern.fullmatch(value) is None
@@ -0,0 +1,237 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Prometheus remote write dispatcher
+'''
+
+from DesignSpark.ESDK import AppLogger
+import IntervalAggregator
+import PrometheusWriter
+import RemoteWriteEncoder
+import snappy
+import collections
+import functools
+import math
+import threading
+
+# Longest time in seconds between ticks, so that samples are encoded well before the buffer fills
+MAX_TICK_INTERVAL = 60
+
+# Samples held between ticks, one hour at the fastest sensor update interval
+MAX_BUFFERED_SAMPLES = 3600
+
+class RemoteWriteDispatcher:
+    """ Buffers readings once for every Prometheus endpoint and encodes them once per label set.
+
+    On each tick, buffered samples are encoded into a fragment for each group of endpoints sharing the
+    same labels. Fragments are serialised WriteRequests, which remain valid when concatenated, so each
+    endpoint collects the fragments since it last wrote and joins them into requests when it is next due.
+    Endpoints due at the same time with the same fragments also share the compressed requests.
+
+    Endpoints with aggregates enabled also keep per-interval statistics of every series, written when
+    they are due as extra series named after the metric and statistic, for example pm2_5_max.
+
+    Ticks must be run every getTickInterval() seconds, the greatest common divisor of endpoint intervals
+    and MAX_TICK_INTERVAL, so that however long the intervals no samples are dropped from the buffer.
+    """
+    def __init__(self, debug=False, loggingLevel='full'):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.endpoints = []
+
+        # Samples waiting to be encoded, keyed on (sensor, metric, sensor type, geohash)
+        self.buffer = {}
+        self.lastReadings = {}
+
+    def addEndpoint(self, name, writer, interval):
+        """ Add an endpoint written to every interval seconds, which must be a multiple of the tick interval """
+        labels = tuple(sorted(writer.staticLabels.items()))
+        group = self.groups.get(labels)
+        if group is None:
+            group = _LabelGroup(writer.staticLabels, self.logger)
+            self.groups[labels] = group
+        group.maxPayload = min(group.maxPayload, writer.maxPayload)
+
+        # Due on the first tick, so that the first reading is written straight away
+        endpoint = {'name': name, 'writer': writer, 'interval': interval, 'group': group, \
+            'fragments': [], 'oldest': None, 'elapsed': interval, \
+            'aggregator': IntervalAggregator.IntervalAggregator() if writer.aggregates else None}
+        self.endpoints.append(endpoint)
+
+    def getTickInterval(self):
+        return functools.reduce(math.gcd, [int(endpoint['interval']) for endpoint in self.endpoints], MAX_TICK_INTERVAL)
+
+    def addSamples(self, timestamp, sensorData):
+        """ Buffer a reading until the next tick, modules not read again since the last call are skipped
+
+        :param timestamp: Reading time in seconds since the epoch
+        :type timestamp: float
+        :param sensorData: Sensor data dictionary as found in a snapshot
+        :type sensorData: dict
+        """
+        timestampMs = int(timestamp * 1000)
+        location = sensorData.get("geohash", None)
+        aggregators = [endpoint['aggregator'] for endpoint in self.endpoints if endpoint['aggregator'] is not None]
+
+        with self.lock:
+            for sensor, sd in sensorData.items():
+                # Skip other keys such as geohash and hardwareId, leaving only sensor data
+                if not isinstance(sd, dict):
+                    continue
+
+                # Module readings are replaced on each read, so the same dictionary is the same reading
+                if self.lastReadings.get(sensor) is sd:
+                    continue
+                self.lastReadings[sensor] = sd
+
+                sensorType = sd.get("sensor", None)
+                for metric, value in sd.items():
+                    # Sensor type is a label rather than a metric
+                    if metric == "sensor" or not isinstance(value, (int, float)):
+                        continue
+
+                    key = (sensor, metric, sensorType, location)
+                    samples = self.buffer.get(key)
+                    if samples is None:
+                        samples = collections.deque(maxlen=MAX_BUFFERED_SAMPLES)
+                        self.buffer[key] = samples
+                    samples.append((timestampMs, value))
+
+                    for aggregator in aggregators:
+                        aggregator.add(key, timestampMs, value)
+
+    def tick(self):
+        """ Encode buffered samples and return the requests for endpoints now due
+
+        :return: A list of (name, writer, compressed requests, oldest timestamp in milliseconds) tuples
+        :rtype: list
+        """
+        with self.lock:
+            batch = list(self.buffer.items())
+            self.buffer = {}
+
+        tickInterval = self.getTickInterval()
+        if batch:
+            oldest = min(samples[0][0] for key, samples in batch)
+            for group in self.groups.values():
+                fragments = group.encode(batch)
+                for endpoint in self.endpoints:
+                    if endpoint['group'] is group:
+                        endpoint['fragments'].extend(fragments)
+                        if endpoint['oldest'] is None:
+                            endpoint['oldest'] = oldest
+
+        due = []
+        compressed = {}
+        for endpoint in self.endpoints:
+            endpoint['elapsed'] += tickInterval
+            if endpoint['elapsed'] < endpoint['interval']:
+                continue
+            endpoint['elapsed'] = 0
+
+            if endpoint['aggregator'] is not None:
+                self.__addAggregates(endpoint)
+
+            if not endpoint['fragments']:
+                continue
+
+            payloads = []
+            for request in _join(endpoint['fragments'], endpoint['writer'].maxPayload):
+                # Each entry holds its fragments, which keeps them alive for the rest of the tick so that their
+                # identities cannot be reused by fragments encoded later, such as aggregates
+                key = tuple(id(fragment) for fragment in request)
+                if key not in compressed:
+                    compressed[key] = (request, snappy.compress(b''.join(request)))
+                payloads.append(compressed[key][1])
+
+            due.append((endpoint['name'], endpoint['writer'], payloads, endpoint['oldest']))
+            endpoint['fragments'] = []
+            endpoint['oldest'] = None
+
+        self.logger.debug("Encoded {} series, {} endpoint(s) due, {} compressed request(s)".format( \
+            len(batch), len(due), len(compressed)))
+        return due
+
+    def __addAggregates(self, endpoint):
+        """ Encode the statistics of the interval an endpoint has just completed into fragments for it """
+        with self.lock:
+            aggregates = endpoint['aggregator'].collect()
+        if not aggregates:
+            return
+
+        # Each statistic is a series of its own, stamped with the time of the last sample in the interval
+        batch = []
+        for (sensor, metric, sensorType, location), (timestamp, statistics) in aggregates.items():
+            for statistic in IntervalAggregator.STATISTICS:
+                batch.append(((sensor, "{}_{}".format(metric, statistic), sensorType, location), \
+                    [(timestamp, statistics[statistic])]))
+
+        endpoint['fragments'].extend(endpoint['group'].encodeSeries(batch))
+        if endpoint['oldest'] is None:
+            endpoint['oldest'] = min(timestamp for timestamp, statistics in aggregates.values())
+
+def _join(fragments, maxPayload):
+    """ Group fragments into lists whose joined size is within maxPayload, keeping them in order """
+    requests = []
+    size = 0
+    for fragment in fragments:
+        if not requests or size + len(fragment) > maxPayload:
+            requests.append([])
+            size = 0
+        requests[-1].append(fragment)
+        size += len(fragment)
+    return requests
+
+class _LabelGroup:
+    """ Series templates and encoding for endpoints sharing the same labels """
+    def __init__(self, staticLabels, logger):
+        self.staticLabels = dict(staticLabels)
+        self.logger = logger
+        self.maxPayload = math.inf
+        self.templates = {}
+        self.encoder = RemoteWriteEncoder.RemoteWriteEncoder()
+
+    def getTemplate(self, key):
+        """ Returns the encoded labels for a (sensor, metric, sensor type, geohash) key """
+        template = self.templates.get(key)
+        if template is None:
+            sensor, metric, sensorType, location = key
+            template = RemoteWriteEncoder.encodeLabels(PrometheusWriter.getSeriesLabels(self.staticLabels, \
+                metric, sensorType, location))
+            self.templates[key] = template
+        return template
+
+    def encode(self, batch):
+        """ Returns a list of serialised write requests for a list of (key, samples) pairs.
+
+        A request larger than maxPayload is split in two at its middle timestamp, so that every request
+        covers a time range following on from the one before.
+        """
+        # Series no longer written have their templates dropped
+        written = set(key for key, samples in batch)
+        self.templates = {key: template for key, template in self.templates.items() if key in written}
+        return self.__encode(batch)
+
+    def encodeSeries(self, batch):
+        """ Returns a list of serialised write requests as encode(), without dropping unused templates """
+        return self.__encode(batch)
+
+    def __encode(self, batch):
+        request = self.encoder.encode([(self.getTemplate(key), samples) for key, samples in batch])
+        if len(request) <= self.maxPayload:
+            return [request]
+
+        timestamps = sorted(set(timestamp for key, samples in batch for timestamp, value in samples))
+        if len(timestamps) > 1:
+            middle = timestamps[len(timestamps) // 2]
+            earlier = [(key, [sample for sample in samples if sample[0] < middle]) for key, samples in batch]
+            later = [(key, [sample for sample in samples if sample[0] >= middle]) for key, samples in batch]
+            return self.__encode([pair for pair in earlier if pair[1]]) + self.__encode([pair for pair in later if pair[1]])
+
+        if len(batch) > 1:
+            return self.__encode(batch[:len(batch) // 2]) + self.__encode(batch[len(batch) // 2:])
+
+        self.logger.warning("Single series of {} bytes exceeds maximum payload".format(len(request)))
+        return [request]
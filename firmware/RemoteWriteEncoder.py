@@ -0,0 +1,113 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Prometheus remote write request encoder
+'''
+
+import prometheus_pb2
+import struct
+
+# Field keys, (field number << 3) | wire type, for the messages in prometheus.proto
+_WRITEREQUEST_TIMESERIES = b'\x0a'
+_TIMESERIES_LABELS = b'\x0a'
+_TIMESERIES_SAMPLES = b'\x12'
+_READRESPONSE_RESULTS = b'\x0a'
+_LABEL_NAME = b'\x0a'
+_LABEL_VALUE = b'\x12'
+_SAMPLE_VALUE = b'\x09'
+_SAMPLE_TIMESTAMP = 0x10
+
+_DOUBLE = struct.Struct('<d')
+_ZERO_DOUBLE = _DOUBLE.pack(0.0)
+
+# Proto3 leaves out fields holding their default value, protobuf backends differ on whether that includes -0.0
+_ENCODES_NEGATIVE_ZERO = prometheus_pb2.Sample(value=-0.0).SerializeToString() != b''
+
+def _varint(value):
+    """ Returns value as a protobuf varint, negative values are encoded as 64-bit two's complement """
+    if value < 0:
+        value += 1 << 64
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def _lengthDelimited(key, data):
+    return key + _varint(len(data)) + data
+
+def encodeLabels(labels):
+    """ Returns the encoded labels field of a TimeSeries, to be built once per series and reused
+
+    :param labels: List of (name, value) tuples, already sorted by name
+    :type labels: list
+    """
+    encoded = bytearray()
+    for name, value in labels:
+        label = b''
+        if name:
+            label += _lengthDelimited(_LABEL_NAME, name.encode('utf-8'))
+        if value:
+            label += _lengthDelimited(_LABEL_VALUE, value.encode('utf-8'))
+        encoded += _lengthDelimited(_TIMESERIES_LABELS, label)
+    return bytes(encoded)
+
+def encodeSample(value, timestamp):
+    """ Returns an encoded Sample message, without its field key or length """
+    sample = bytearray()
+    packed = _DOUBLE.pack(value)
+    if packed != _ZERO_DOUBLE and (value != 0 or _ENCODES_NEGATIVE_ZERO):
+        sample += _SAMPLE_VALUE
+        sample += packed
+    if timestamp:
+        sample.append(_SAMPLE_TIMESTAMP)
+        sample += _varint(timestamp)
+    return sample
+
+def encodeReadResponse(results):
+    """ Returns an encoded ReadResponse
+
+    :param results: Encoded QueryResult messages, which share their layout with WriteRequest so may be
+        encoded by RemoteWriteEncoder
+    :type results: list
+    """
+    return b''.join(_lengthDelimited(_READRESPONSE_RESULTS, result) for result in results)
+
+class RemoteWriteEncoder:
+    """ Encodes WriteRequest messages directly to bytes.
+
+    Only the fixed WriteRequest, TimeSeries, Label and Sample schema from prometheus.proto is supported,
+    which avoids building message objects through the generic protobuf API. Output is byte for byte the
+    same as prometheus_pb2.WriteRequest.SerializeToString(), fields holding default values are left out.
+    """
+    def __init__(self):
+        self.request = bytearray()
+        self.series = bytearray()
+
+    def encode(self, batch):
+        """ Returns an encoded WriteRequest
+
+        :param batch: List of (encoded labels, samples) pairs, samples being a list of (timestamp, value) tuples
+        :type batch: list
+        :rtype: bytes
+        """
+        request = self.request
+        series = self.series
+        del request[:]
+
+        for labels, samples in batch:
+            del series[:]
+            series += labels
+            for timestamp, value in samples:
+                sample = encodeSample(value, timestamp)
+                series += _TIMESERIES_SAMPLES
+                series += _varint(len(sample))
+                series += sample
+
+            request += _WRITEREQUEST_TIMESERIES
+            request += _varint(len(series))
+            request += series
+
+        return bytes(request)
@@ -0,0 +1,244 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Disk budget retention for local data
+'''
+
+from DesignSpark.ESDK import AppLogger
+import gzip
+import os
+import shutil
+import time
+
+# Files modified more recently than this, in seconds, may still be being written to and are left alone
+ACTIVE_FILE_AGE = 600
+
+# Files compressed and segments dropped or evicted on each check, so that no check holds up the executor for long
+COMPRESSIONS_PER_CHECK = 1
+EVICTIONS_PER_CHECK = 10
+
+class RetentionManager:
+    """ Keeps local data within a disk budget, a little at a time.
+
+    Each check does a bounded amount of work, in order of preference:
+
+    #. Older CSV files and offline spool segments are gzip compressed.
+    #. Raw store segments older than the raw retention period are dropped, their data remaining in
+       the rollups at reduced resolution.
+    #. Should the filesystem still be over budget, the oldest CSV files, offline spool segments, raw store
+       segments and 1 minute rollup segments are evicted, oldest first, until it is back within budget.
+
+    Filesystem usage is found with a single statvfs call. Store and spool segments are listed from their
+    own in-memory indexes, and the CSV directory is only listed again once its modification time changes.
+    The newest CSV file is taken to be the one being written to, so is never compressed or evicted.
+
+    :param path: Filesystem the budget applies to
+    :type path: str
+    :param budget: Highest percentage of the filesystem that may be used
+    :type budget: float
+    :param compressAfter: Age in seconds after which files are compressed
+    :type compressAfter: int
+    :param rawRetention: Age in seconds after which raw store data is dropped in favour of rollups
+    :type rawRetention: int
+    :param csvDirectory: Directory of CSV files, or None
+    :type csvDirectory: str, optional
+    :param spool: Offline data spool, or None
+    :type spool: LokiSpool.LokiSpool, optional
+    :param store: Raw readings store, or None
+    :type store: SeriesStore.SeriesStore, optional
+    :param rollups: Rollups of the raw readings store, or None
+    :type rollups: Rollups.Rollups, optional
+    """
+    def __init__(self, path, budget, compressAfter, rawRetention, csvDirectory=None, spool=None, store=None, rollups=None, \
+        debug=False, loggingLevel='full'):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.path = path
+        self.budget = budget
+        self.compressAfter = compressAfter
+        self.rawRetention = rawRetention
+        self.csvDirectory = csvDirectory
+        self.spool = spool
+        self.store = store
+        self.rollups = rollups
+
+        # CSV file paths, refreshed when the directory changes. Appending to a file leaves the directory's
+        # modification time alone, so those of the files themselves are looked up on each check
+        self.csvFiles = set()
+        self.csvDirectoryTime = None
+        # Files that could not be compressed, so are not tried again
+        self.skipped = set()
+        self.exhausted = False
+
+    def check(self):
+        """ Do the next piece of retention work, to be run periodically on an executor
+
+        :return: Counts of files compressed, raw segments dropped and files evicted
+        :rtype: dict
+        """
+        now = time.time()
+        self.__refreshCsvFiles()
+
+        result = {"compressed": self.__compress(now), "downsampled": self.__downsample(now), "evicted": 0}
+
+        for _ in range(EVICTIONS_PER_CHECK):
+            if self.getUsedPercentage() <= self.budget or not self.__evictOldest(now):
+                break
+            result['evicted'] += 1
+
+        if any(result.values()):
+            self.logger.info("Retention compressed {compressed}, downsampled {downsampled} and evicted {evicted} file(s)"\
+                .format(**result))
+        return result
+
+    def getUsedPercentage(self):
+        usage = shutil.disk_usage(self.path)
+        return usage.used / usage.total * 100
+
+    def __refreshCsvFiles(self):
+        if self.csvDirectory is None:
+            return
+        try:
+            directoryTime = os.stat(self.csvDirectory).st_mtime_ns
+        except OSError:
+            return
+        if directoryTime == self.csvDirectoryTime:
+            return
+
+        self.csvFiles = set()
+        for entry in os.scandir(self.csvDirectory):
+            if entry.is_file() and (entry.name.endswith(".csv") or entry.name.endswith(".csv.gz")):
+                self.csvFiles.add(entry.path)
+        self.csvDirectoryTime = directoryTime
+
+    def __getCsvFiles(self):
+        """ Returns a list of (modification time, path, compressed) for CSV files, oldest first, leaving out the
+        newest uncompressed file as it may still be being written to """
+        csvFiles = []
+        for path in list(self.csvFiles):
+            try:
+                csvFiles.append((os.path.getmtime(path), path, path.endswith(".gz")))
+            except OSError:
+                # Removed by something else since the directory was listed
+                self.csvFiles.discard(path)
+        csvFiles.sort()
+
+        uncompressed = [csvFile for csvFile in csvFiles if not csvFile[2]]
+        if uncompressed:
+            csvFiles.remove(uncompressed[-1])
+        return csvFiles
+
+    def __compress(self, now):
+        """ Compress the oldest uncompressed files past compressAfter """
+        compressed = 0
+        cutoff = now - max(self.compressAfter, ACTIVE_FILE_AGE)
+
+        for modified, path, isCompressed in self.__getCsvFiles():
+            if compressed >= COMPRESSIONS_PER_CHECK or modified > cutoff:
+                break
+            if not isCompressed and path not in self.skipped and self.__compressFile(path, modified):
+                compressed += 1
+
+        if self.spool is not None:
+            for segment, path, isCompressed in self.spool.getFinishedSegments():
+                if compressed >= COMPRESSIONS_PER_CHECK:
+                    break
+                if not isCompressed and os.path.getmtime(path) <= cutoff:
+                    self.spool.compressSegment(segment)
+                    compressed += 1
+
+        return compressed
+
+    def __compressFile(self, path, modified):
+        """ Replace a file with a gzip compressed copy, keeping its modification time so it keeps its place in eviction order
+
+        :return: Whether the file was compressed
+        :rtype: bool
+        """
+        compressedPath = path + ".gz"
+        if os.path.exists(compressedPath):
+            self.logger.warning("Not compressing {}, {} already exists".format(path, compressedPath))
+            self.skipped.add(path)
+            return False
+
+        with open(path, 'rb') as source, gzip.open(compressedPath + ".tmp", 'wb') as destination:
+            shutil.copyfileobj(source, destination)
+        os.utime(compressedPath + ".tmp", (modified, modified))
+        os.replace(compressedPath + ".tmp", compressedPath)
+        os.remove(path)
+
+        self.csvFiles.discard(path)
+        self.csvFiles.add(compressedPath)
+        self.logger.debug("Compressed {}".format(path))
+        return True
+
+    def __downsample(self, now):
+        """ Drop raw segments whose every record is older than rawRetention """
+        if self.store is None or self.rollups is None:
+            return 0
+
+        dropped = 0
+        cutoff = int((now - self.rawRetention) * 1000)
+        for name in self.store.getSeriesNames():
+            segments = self.store.getSegments(name)
+            # A segment ends where the next one starts, so the newest sealed segment is left until later
+            for (first, path), (nextFirst, nextPath) in zip(segments, segments[1:]):
+                if nextFirst > cutoff or dropped >= EVICTIONS_PER_CHECK:
+                    break
+                self.store.removeSegment(name, path)
+                dropped += 1
+        return dropped
+
+    def __getEvictionCandidates(self, now):
+        """ Returns a list of (modification time, path, remove function) for everything that may be evicted """
+        candidates = []
+        for modified, path, isCompressed in self.__getCsvFiles():
+            if modified <= now - ACTIVE_FILE_AGE:
+                candidates.append((modified, path, lambda path=path: self.__removeCsvFile(path)))
+
+        if self.spool is not None:
+            for segment, path, isCompressed in self.spool.getFinishedSegments():
+                candidates.append((os.path.getmtime(path), path, \
+                    lambda segment=segment: self.__removeSpoolSegment(segment)))
+
+        # Everything is ordered by modification time, the time of its newest data, and only the oldest
+        # segment of each store series can be the oldest overall
+        stores = []
+        if self.store is not None:
+            stores.append(self.store)
+        if self.rollups is not None:
+            stores.append(self.rollups.getStore(self.rollups.getTierNames()[0]))
+        for store in stores:
+            for name in store.getSeriesNames():
+                segments = store.getSegments(name)
+                if segments:
+                    first, path = segments[0]
+                    candidates.append((os.path.getmtime(path), path, \
+                        lambda store=store, name=name, path=path: store.removeSegment(name, path)))
+
+        return candidates
+
+    def __evictOldest(self, now):
+        candidates = self.__getEvictionCandidates(now)
+        if not candidates:
+            # Warn once, rather than on every check for as long as other files keep usage over budget
+            if not self.exhausted:
+                self.logger.warning("Over disk budget of {}% with nothing left to evict".format(self.budget))
+            self.exhausted = True
+            return False
+
+        self.exhausted = False
+        modified, path, remove = min(candidates, key=lambda candidate: candidate[0])
+        self.logger.warning("Over disk budget of {}%, evicting {}".format(self.budget, path))
+        remove()
+        return True
+
+    def __removeCsvFile(self, path):
+        os.remove(path)
+        self.csvFiles.discard(path)
+        self.skipped.discard(path)
+
+    def __removeSpoolSegment(self, segment):
+        dropped = self.spool.removeSegment(segment)
+        if dropped:
+            self.logger.warning("Dropped {} offline record(s) not yet uploaded".format(dropped))
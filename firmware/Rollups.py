@@ -0,0 +1,152 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Multi-resolution rollups of sensor readings
+'''
+
+from DesignSpark.ESDK import AppLogger
+import SeriesStore
+import math
+import os
+import struct
+import threading
+
+# Bucket start in milliseconds, minimum, maximum, mean and sample count
+ROLLUP_RECORD = struct.Struct('<qffdI4x')
+
+# Tier name and bucket width in seconds, finest first
+TIERS = (("1m", 60), ("15m", 900), ("1h", 3600))
+
+class Rollups:
+    """ Maintains min, max, mean and count rollups of every series at several resolutions.
+
+    Samples are accumulated into an open one minute bucket, when a bucket closes it is written out and
+    merged into the open bucket of the next tier up, so each tier only ever sees rows from the one below.
+    Closed buckets are persisted as fixed width records in a SeriesStore per tier.
+
+    :param path: Rollup directory, each tier is stored in a subdirectory
+    :type path: str
+    """
+    def __init__(self, path, debug=False, loggingLevel='full'):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.lock = threading.Lock()
+        self.tiers = []
+        for name, resolution in TIERS:
+            store = SeriesStore.SeriesStore(os.path.join(path, name), debug=debug, \
+                loggingLevel=loggingLevel, record=ROLLUP_RECORD)
+            self.tiers.append((name, resolution * 1000, store))
+
+        # Open [bucket start, min, max, total, count] per series, one entry per tier
+        self.buckets = {}
+
+    def getTierNames(self):
+        return [name for name, resolution, store in self.tiers]
+
+    def getTierResolution(self, tier):
+        """ Returns the bucket width of a tier in seconds """
+        return self.tiers[self._tierIndex(tier)][1] // 1000
+
+    def selectTier(self, start, end, points):
+        """ Returns the name of the finest tier giving no more than points rows between start and end seconds """
+        for name, resolution, store in self.tiers:
+            if (end - start) * 1000 / resolution <= points:
+                return name
+        return self.tiers[-1][0]
+
+    def appendReadings(self, timestamp, sensorData):
+        """ Add a module reading, each must only be added once so that counts and means are not skewed
+
+        :param timestamp: Reading time in seconds since the epoch
+        :type timestamp: float
+        :param sensorData: Sensor data dictionary as returned by a module read
+        :type sensorData: dict
+        """
+        timestampMs = int(timestamp * 1000)
+        with self.lock:
+            for sensor, sd in sensorData.items():
+                # Skip other keys such as geohash and hardwareId, leaving only sensor data
+                if not isinstance(sd, dict):
+                    continue
+
+                for metric, value in sd.items():
+                    if metric == "sensor" or not isinstance(value, (int, float)) or math.isnan(value):
+                        continue
+                    self._merge(0, "{}.{}".format(sensor, metric), timestampMs, value, value, value, 1)
+
+    def _merge(self, level, name, timestampMs, low, high, total, count):
+        resolution = self.tiers[level][1]
+        bucketStart = timestampMs - timestampMs % resolution
+
+        buckets = self.buckets.setdefault(name, [None] * len(self.tiers))
+        bucket = buckets[level]
+        if bucket is not None and bucketStart != bucket[0]:
+            # Late samples for a bucket already written out are dropped
+            if bucketStart < bucket[0]:
+                return
+            self._close(level, name, bucket)
+            bucket = None
+
+        if bucket is None:
+            buckets[level] = [bucketStart, low, high, total, count]
+        else:
+            bucket[1] = min(bucket[1], low)
+            bucket[2] = max(bucket[2], high)
+            bucket[3] += total
+            bucket[4] += count
+
+    def _close(self, level, name, bucket):
+        bucketStart, low, high, total, count = bucket
+        self.buckets[name][level] = None
+        self.tiers[level][2].append(name, bucketStart, low, high, total / count, count)
+        if level + 1 < len(self.tiers):
+            self._merge(level + 1, name, bucketStart, low, high, total, count)
+
+    def query(self, name, start, end, tier):
+        """ Returns rollup rows for a series with start <= bucket start < end, in milliseconds
+
+        :return: A list of (bucket start, min, max, mean, count) tuples, including the open bucket
+        :rtype: list
+        """
+        level = self._tierIndex(tier)
+        with self.lock:
+            rows = self.tiers[level][2].query(name, start, end)
+            bucket = self.buckets.get(name, [None] * len(self.tiers))[level]
+            if bucket is not None and start <= bucket[0] < end:
+                rows.append((bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4], bucket[4]))
+
+        # A bucket open at shutdown is written out partially, and completed by a second row after restarting
+        merged = []
+        for row in rows:
+            if merged and merged[-1][0] == row[0]:
+                previous = merged[-1]
+                count = previous[4] + row[4]
+                merged[-1] = (row[0], min(previous[1], row[1]), max(previous[2], row[2]), \
+                    (previous[3] * previous[4] + row[3] * row[4]) / count, count)
+            else:
+                merged.append(row)
+        return merged
+
+    def getSeriesNames(self):
+        with self.lock:
+            return sorted(set(self.tiers[0][2].getSeriesNames()) | set(self.buckets.keys()))
+
+    def getStore(self, tier):
+        return self.tiers[self._tierIndex(tier)][2]
+
+    def _tierIndex(self, tier):
+        for index, (name, resolution, store) in enumerate(self.tiers):
+            if name == tier:
+                return index
+        raise ValueError("Unknown resolution {}".format(tier))
+
+    def close(self):
+        """ Write out open buckets, finest first so that they carry up into coarser tiers, then close the stores """
+        with self.lock:
+            for name, buckets in self.buckets.items():
+                for level in range(len(self.tiers)):
+                    if buckets[level] is not None:
+                        self._close(level, name, buckets[level])
+
+            for name, resolution, store in self.tiers:
+                store.close()
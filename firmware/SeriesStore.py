@@ -0,0 +1,314 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Append-only time series store
+'''
+
+from DesignSpark.ESDK import AppLogger
+import os
+import mmap
+import struct
+import threading
+import time
+
+# Every record starts with a signed 64-bit millisecond timestamp
+RAW_RECORD = struct.Struct('<qd')
+
+BLOCK_SIZE = 4096
+SEGMENT_SIZE = 256 * BLOCK_SIZE
+SEGMENT_EXTENSION = ".seg"
+
+# Seconds between writing out filled blocks, followed by a single sync for every series
+SYNC_INTERVAL = 60
+
+class SeriesStore:
+    """ On-disk store of fixed width records, one directory per series.
+
+    Each series is made up of append-only segment files named after the timestamp of their first
+    record. Records never straddle a block as the record size must divide the block size, and segments
+    are rotated on a block boundary. Writes are buffered and only whole blocks are written out, every
+    SYNC_INTERVAL seconds and with one sync for all series, so that each block is written once. A partial
+    block is only written out once its oldest record has been held for flushInterval seconds, or on close,
+    and the write that follows fills the rest of that block. Reads memory-map segments and binary search on
+    the timestamp, segments themselves are found using an in-memory index of first timestamps.
+
+    On opening, any torn or zeroed records left at the tail of a segment by a crash are truncated away.
+
+    :param path: Store directory
+    :type path: str
+    :param record: Record layout, the first field must be a millisecond timestamp, defaults to timestamp and double value
+    :type record: struct.Struct, optional
+    :param flushInterval: Longest time in seconds a record is held in memory, defaults to 1800
+    :type flushInterval: int, optional
+    """
+    def __init__(self, path, debug=False, loggingLevel='full', record=RAW_RECORD, segmentSize=SEGMENT_SIZE, flushInterval=1800):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        if BLOCK_SIZE % record.size or segmentSize % BLOCK_SIZE:
+            raise ValueError("Record size must divide block size, and segment size must be a multiple of it")
+
+        self.path = path
+        self.record = record
+        self.segmentSize = segmentSize
+        self.flushInterval = flushInterval
+        self.lock = threading.Lock()
+        self.series = {}
+        self.lastSync = time.monotonic()
+
+        os.makedirs(self.path, exist_ok=True)
+        for name in sorted(os.listdir(self.path)):
+            if os.path.isdir(os.path.join(self.path, name)):
+                self.series[name] = _Series(os.path.join(self.path, name), self.record, self.segmentSize, self.logger)
+
+        self.logger.debug("Opened store {} with series {}".format(self.path, list(self.series.keys())))
+
+    def append(self, name, timestamp, *values):
+        """ Append a record to a series, timestamps must not go backwards within a series """
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                series = _Series(os.path.join(self.path, name), self.record, self.segmentSize, self.logger)
+                self.series[name] = series
+            series.append(timestamp, self.record.pack(timestamp, *values))
+
+            if time.monotonic() - self.lastSync >= SYNC_INTERVAL:
+                self._flush()
+
+    def appendReadings(self, timestamp, sensorData):
+        """ Append every metric in a sensor data dictionary as series named sensor.metric
+
+        :param timestamp: Reading time in seconds since the epoch
+        :type timestamp: float
+        """
+        timestampMs = int(timestamp * 1000)
+        for sensor, sd in sensorData.items():
+            # Skip other keys such as geohash and hardwareId, leaving only sensor data
+            if not isinstance(sd, dict):
+                continue
+
+            for metric, value in sd.items():
+                if metric == "sensor" or not isinstance(value, (int, float)):
+                    continue
+                self.append("{}.{}".format(sensor, metric), timestampMs, value)
+
+    def query(self, name, start, end):
+        """ Returns a list of record tuples for a series with start <= timestamp < end, in milliseconds """
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                return []
+            return series.query(start, end)
+
+    def getSeriesNames(self):
+        return list(self.series.keys())
+
+    def getSegments(self, name):
+        """ Returns a list of (first timestamp, path) tuples for the sealed segments of a series, oldest first """
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                return []
+            return [(first, path) for first, path in series.segments[:-1]]
+
+    def removeSegment(self, name, path):
+        """ Delete a sealed segment, used by retention """
+        with self.lock:
+            series = self.series.get(name)
+            if series is not None:
+                series.removeSegment(path)
+
+    def flush(self):
+        """ Write out all buffered records, including partial blocks """
+        with self.lock:
+            self._flush(partial=True)
+
+    def _flush(self, partial=False):
+        """ Write out filled blocks, and partial blocks if asked to or held for longer than flushInterval """
+        now = time.monotonic()
+        written = 0
+        for series in self.series.values():
+            written += series.flush(partial or (series.pendingSince is not None and now - series.pendingSince >= self.flushInterval))
+
+        # Every series is synced at once rather than each file on its own
+        if written:
+            os.sync()
+        self.lastSync = now
+
+    def close(self):
+        with self.lock:
+            self._flush(partial=True)
+            for series in self.series.values():
+                series.close()
+
+class _Series:
+    """ Segment files for a single series, with its index and write buffer """
+    def __init__(self, path, record, segmentSize, logger):
+        self.path = path
+        self.record = record
+        self.segmentSize = segmentSize
+        self.logger = logger
+        self.pending = bytearray()
+        self.pendingFirst = None
+        self.pendingSince = None
+        self.fh = None
+        self.activeSize = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.segments = []
+        for filename in os.listdir(self.path):
+            if filename.endswith(SEGMENT_EXTENSION):
+                self.segments.append((int(filename[:-len(SEGMENT_EXTENSION)]), os.path.join(self.path, filename)))
+        self.segments.sort()
+
+        self.lastTimestamp = None
+        if self.segments:
+            self._recoverTail(self.segments[-1][1])
+
+    def _recoverTail(self, path):
+        """ Truncate a torn final record, and any trailing records that are zeroed or out of order """
+        size = os.path.getsize(path)
+        recordSize = self.record.size
+        validSize = size - (size % recordSize)
+
+        with open(path, 'rb') as fh:
+            data = fh.read(validSize)
+
+        count = validSize // recordSize
+        previous = None
+        good = 0
+        for index in range(count):
+            timestamp = struct.unpack_from('<q', data, index * recordSize)[0]
+            if timestamp <= 0 or (previous is not None and timestamp < previous):
+                break
+            previous = timestamp
+            good = index + 1
+
+        if good * recordSize != size:
+            self.logger.warning("Truncating {} from {} to {} bytes".format(path, size, good * recordSize))
+            os.truncate(path, good * recordSize)
+
+        if good == 0:
+            os.remove(path)
+            self.segments.pop()
+            if self.segments:
+                self.lastTimestamp = self._readLastTimestamp(self.segments[-1][1])
+                self.activeSize = os.path.getsize(self.segments[-1][1])
+            return
+
+        self.lastTimestamp = previous
+        self.activeSize = good * recordSize
+
+    def _readLastTimestamp(self, path):
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fh:
+            fh.seek(size - self.record.size)
+            return struct.unpack('<q', fh.read(8))[0]
+
+    def append(self, timestamp, packed):
+        if self.lastTimestamp is not None and timestamp < self.lastTimestamp:
+            return
+        self.lastTimestamp = timestamp
+
+        if self.pendingFirst is None:
+            self.pendingFirst = timestamp
+            self.pendingSince = time.monotonic()
+        self.pending += packed
+
+    def flush(self, partial=False):
+        """ Write out buffered records up to the last block boundary, or all of them if partial is set
+
+        :return: Number of bytes written
+        :rtype: int
+        """
+        if partial:
+            toWrite = len(self.pending)
+        else:
+            # Segments start on a block boundary, so a block boundary in the file is one in the segment
+            toWrite = (self.activeSize + len(self.pending)) // BLOCK_SIZE * BLOCK_SIZE - self.activeSize
+        written = 0
+
+        while written < toWrite:
+            if self.fh is None:
+                if self.segments and self.activeSize < self.segmentSize:
+                    self.fh = open(self.segments[-1][1], 'ab')
+                else:
+                    segmentPath = os.path.join(self.path, "{}{}".format(self.pendingFirst, SEGMENT_EXTENSION))
+                    self.fh = open(segmentPath, 'ab')
+                    self.segments.append((self.pendingFirst, segmentPath))
+                    self.activeSize = 0
+
+            # Never write past the end of the segment, the remainder goes to the next one
+            length = min(toWrite - written, self.segmentSize - self.activeSize)
+            self.fh.write(self.pending[:length])
+            self.fh.flush()
+            del self.pending[:length]
+            self.activeSize += length
+            written += length
+
+            if self.activeSize >= self.segmentSize:
+                self.fh.close()
+                self.fh = None
+
+            if self.pending:
+                self.pendingFirst = struct.unpack_from('<q', self.pending, 0)[0]
+
+        if not self.pending:
+            self.pendingFirst = None
+            self.pendingSince = None
+        elif written:
+            # Records left over arrived after the last block filled, so at most since the last flush
+            self.pendingSince = time.monotonic()
+        return written
+
+    def query(self, start, end):
+        results = []
+        for index, (first, path) in enumerate(self.segments):
+            # Skip segments that end before the range, or start after it
+            if index + 1 < len(self.segments) and self.segments[index + 1][0] <= start:
+                continue
+            if first >= end:
+                break
+            results.extend(self._querySegment(path, start, end))
+
+        # Include records not yet written out
+        results.extend(record for record in self.record.iter_unpack(bytes(self.pending)) if start <= record[0] < end)
+        return results
+
+    def _querySegment(self, path, start, end):
+        size = os.path.getsize(path)
+        size -= size % self.record.size
+        if size == 0:
+            return []
+
+        with open(path, 'rb') as fh, mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+            recordSize = self.record.size
+            count = size // recordSize
+
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if struct.unpack_from('<q', mapped, middle * recordSize)[0] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            results = []
+            for index in range(low, count):
+                record = self.record.unpack_from(mapped, index * recordSize)
+                if record[0] >= end:
+                    break
+                results.append(record)
+            return results
+
+    def removeSegment(self, path):
+        # The active segment is never removed
+        for index, (first, segmentPath) in enumerate(self.segments[:-1]):
+            if segmentPath == path:
+                os.remove(path)
+                self.segments.pop(index)
+                return
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
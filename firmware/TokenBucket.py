@@ -0,0 +1,52 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Token bucket rate limiter
+'''
+
+import threading
+import time
+
+class TokenBucket:
+    """ Limits the average rate of some quantity, such as bytes sent, while allowing short bursts.
+
+    Tokens are added at rate per second up to capacity. Consuming more tokens than are available leaves
+    the bucket in debt and waits until it is repaid, so amounts larger than the capacity are still allowed
+    and the average rate is kept whatever their size.
+
+    :param rate: Tokens added per second
+    :type rate: float
+    :param capacity: Most tokens that may be saved up for a burst
+    :type capacity: float
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount, cancelled=None):
+        """ Take tokens from the bucket, waiting for as long as the bucket is in debt
+
+        :param amount: Tokens to take
+        :type amount: float
+        :param cancelled: Event that ends the wait early once set
+        :type cancelled: threading.Event, optional
+        """
+        with self.lock:
+            self.__refill()
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay > 0:
+            if cancelled is not None:
+                cancelled.wait(delay)
+            else:
+                time.sleep(delay)
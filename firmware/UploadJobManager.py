@@ -0,0 +1,198 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Background upload job helper class
+'''
+
+import asyncio
+import functools
+import json
+import threading
+import time
+import websockets
+from DesignSpark.ESDK import AppLogger
+
+# Finished jobs kept so that clients may still attach to them
+MAX_FINISHED_JOBS = 10
+
+class UploadJobManager:
+    """ Runs uploads as background jobs on an executor, streaming their progress to websocket clients.
+
+    Each job is given an ID and is sent progress events as a JSON object under a "job" key, which any
+    number of clients may attach to. Jobs wait on a semaphore so that no more than maxRunning run at once,
+    and may be cancelled, taking effect between requests.
+
+    Upload functions take progress and cancelled keyword arguments, calling progress with a dictionary of
+    success and fail counts, bytes sent and records remaining after each request, and checking the
+    threading.Event cancelled before each request. They return a dictionary of final counts.
+
+    :param eventLoop: Event loop jobs and clients are run on
+    :type eventLoop: asyncio.AbstractEventLoop
+    :param executor: Executor upload functions are run on
+    :type executor: concurrent.futures.Executor
+    :param maxRunning: Number of jobs that may run at once, defaults to 1
+    :type maxRunning: int, optional
+    """
+    def __init__(self, eventLoop, executor, debug=False, loggingLevel='full', maxRunning=1):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.eventLoop = eventLoop
+        self.executor = executor
+        self.semaphore = asyncio.Semaphore(maxRunning)
+        self.jobs = {}
+        self.nextId = 1
+
+    def start(self, websocket, func, *args):
+        """ Start a job running func(*args) with the client attached, or attach it to the job already active.
+        The client may be None for jobs started by the application itself.
+
+        :return: The job status
+        :rtype: dict
+        """
+        job = self.getActiveJob()
+        if job is not None:
+            self.logger.debug("Upload job {} already active".format(job.status['id']))
+            if websocket is None:
+                return dict(job.status)
+            return self.attach(websocket, job.status['id'])
+
+        job = _UploadJob(self.nextId)
+        self.nextId += 1
+        self.jobs[job.status['id']] = job
+        if websocket is not None:
+            job.subscribers.add(websocket)
+        asyncio.ensure_future(self.__run(job, func, *args))
+
+        # Forget the oldest finished jobs
+        finished = [jobId for jobId, j in self.jobs.items() if j.isFinished()]
+        for jobId in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[jobId]
+
+        self.logger.info("Started upload job {}".format(job.status['id']))
+        return dict(job.status)
+
+    async def __run(self, job, func, *args):
+        async with self.semaphore:
+            if job.cancelled.is_set():
+                self.__publish(job, state="cancelled")
+                return
+
+            self.__publish(job, state="running")
+            job.started = time.monotonic()
+
+            # Progress is reported from the executor, so is passed back to the event loop
+            def progress(result):
+                self.eventLoop.call_soon_threadsafe(self.__progress, job, result)
+
+            try:
+                result = await self.eventLoop.run_in_executor(self.executor, \
+                    functools.partial(func, *args, progress=progress, cancelled=job.cancelled))
+            except Exception as e:
+                self.logger.error("Upload job {} failed, reason {}".format(job.status['id'], e))
+                self.__publish(job, state="failed", error=str(e))
+                return
+
+            if job.cancelled.is_set():
+                state = "cancelled"
+            elif result['fail']:
+                state = "failed"
+            else:
+                state = "done"
+            self.__progress(job, result, state)
+            self.logger.info("Upload job {} {}, {} sent, {} failed".format(job.status['id'], state, \
+                result['success'], result['fail']))
+
+    def __progress(self, job, result, state=None):
+        """ Publish counts from an upload, estimating the time remaining from the rate so far """
+        eta = None
+        elapsed = time.monotonic() - job.started
+        if result.get('remaining') is not None and result['success'] and elapsed > 0:
+            eta = round(result['remaining'] / (result['success'] / elapsed))
+
+        update = {"sent": result['success'], "failed": result['fail'], "bytes": result.get('bytes', 0), "eta": eta}
+        if 'remaining' in result:
+            update['remaining'] = result['remaining']
+        if state is not None:
+            update['state'] = state
+        self.__publish(job, **update)
+
+    def __publish(self, job, **update):
+        job.status.update(update)
+        message = json.dumps({"job": job.status})
+        for websocket in list(job.subscribers):
+            asyncio.ensure_future(self.__send(job, websocket, message))
+
+    async def __send(self, job, websocket, message):
+        try:
+            await websocket.send(message)
+        except websockets.ConnectionClosed:
+            job.subscribers.discard(websocket)
+
+    def attach(self, websocket, jobId=None):
+        """ Subscribe a client to the progress of a job, by default the active or most recent one
+
+        :return: The job status
+        :rtype: dict
+        :raises ValueError: If there is no such job
+        """
+        job = self.__getJob(jobId)
+        if not job.isFinished():
+            job.subscribers.add(websocket)
+        return dict(job.status)
+
+    def cancel(self, jobId=None):
+        """ Ask a job, by default the active one, to stop after its current request
+
+        :return: The job status
+        :rtype: dict
+        :raises ValueError: If there is no such job
+        """
+        job = self.__getJob(jobId)
+        if not job.isFinished():
+            job.cancelled.set()
+            self.logger.info("Cancelling upload job {}".format(job.status['id']))
+        return dict(job.status)
+
+    def detach(self, websocket):
+        """ Unsubscribe a client from every job, called once it disconnects """
+        for job in self.jobs.values():
+            job.subscribers.discard(websocket)
+
+    def getActiveJob(self):
+        """ Returns the queued or running job, or None """
+        for job in self.jobs.values():
+            if not job.isFinished():
+                return job
+        return None
+
+    def getStatus(self, jobId=None):
+        """ Returns the status of a job, by default the active or most recent one
+
+        :raises ValueError: If there is no such job
+        """
+        return dict(self.__getJob(jobId).status)
+
+    def getJobs(self):
+        """ Returns the status of every job kept, oldest first """
+        return [dict(job.status) for job in self.jobs.values()]
+
+    def __getJob(self, jobId):
+        if jobId is None:
+            job = self.getActiveJob()
+            if job is None and self.jobs:
+                job = self.jobs[max(self.jobs)]
+        else:
+            job = self.jobs.get(int(jobId))
+        if job is None:
+            raise ValueError("No upload job {}".format(jobId if jobId is not None else "found"))
+        return job
+
+class _UploadJob:
+    def __init__(self, jobId):
+        self.status = {"id": jobId, "state": "queued", "sent": 0, "failed": 0, "bytes": 0, "remaining": None, "eta": None}
+        self.subscribers = set()
+        self.cancelled = threading.Event()
+        self.started = None
+
+    def isFinished(self):
+        return self.status['state'] in ("done", "failed", "cancelled")
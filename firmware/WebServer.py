@@ -7,18 +7,321 @@ Web server helper class
 
 from twisted.web.server import Site
 from twisted.web.static import File
-from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.internet import asyncioreactor
 from twisted.internet import endpoints
+from twisted.web.server import NOT_DONE_YET
 from DesignSpark.ESDK import AppLogger
+import HistoryBuffer
+import PrometheusWriter
+import fnmatch
+import json
+import math
+import time
+
+HISTORY_DEFAULT_POINTS = 500
+HISTORY_MAX_POINTS = 5000
+
+# Readings considered per requested point before downsampling, bounds the work done on long ranges
+HISTORY_OVERSAMPLE = 8
+
+QUERY_DEFAULT_POINTS = 500
 
 class WebServer:
-	def __init__(self, debug=False, loggingLevel='full', port=8080):
+	def __init__(self, debug=False, loggingLevel='full', port=8080, eventLoop=None, history=None, \
+		rollups=None, store=None, executor=None, snapshots=None, metricsLabels=None, remoteRead=None):
 		self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+
+		# Twisted runs on top of the application asyncio event loop rather than a thread of its own,
+		# the reactor must be installed before it is first imported
+		asyncioreactor.install(eventLoop)
+		from twisted.internet import reactor
+		self.reactor = reactor
+
 		self.resource = File('../dashboard')
+		if history is not None:
+			self.resource.putChild(b'history', HistoryResource(history))
+		if rollups is not None:
+			self.resource.putChild(b'query', QueryResource(rollups, store, eventLoop, executor, self.logger))
+		if snapshots is not None:
+			self.resource.putChild(b'metrics', MetricsResource(snapshots, metricsLabels or {}))
+		if remoteRead is not None:
+			api = Resource()
+			version = Resource()
+			api.putChild(b'v1', version)
+			version.putChild(b'read', RemoteReadResource(remoteRead, eventLoop, executor, self.logger))
+			self.resource.putChild(b'api', api)
 		self.factory = Site(self.resource)
-		self.endpoint = endpoints.TCP4ServerEndpoint(reactor, port)
+		self.endpoint = endpoints.TCP4ServerEndpoint(self.reactor, port)
+		self.port = None
 
-	def run(self):
+	def start(self):
+		""" Start listening, requests are then served by the running event loop """
 		self.logger.debug("Starting web server")
-		self.endpoint.listen(self.factory)
-		reactor.run(installSignalHandlers=False)
\ No newline at end of file
+		self.reactor.startRunning(installSignalHandlers=False)
+		listening = self.endpoint.listen(self.factory)
+		listening.addCallbacks(self.__onListening, self.__onListenFailed)
+
+	def stop(self):
+		""" Stop listening, the event loop itself is left running """
+		if self.port is not None:
+			self.logger.debug("Stopping web server")
+			self.port.stopListening()
+			self.port = None
+
+	def __onListening(self, port):
+		self.port = port
+		self.logger.debug("Web server listening on {}".format(port.getHost()))
+
+	def __onListenFailed(self, failure):
+		self.logger.error("Web server could not listen, reason {}".format(failure.getErrorMessage()))
+
+class HistoryResource(Resource):
+	""" Serves downsampled sensor history as JSON.
+
+	Query arguments, all optional:
+
+	* ``start`` and ``end`` in milliseconds since the epoch, or ``seconds`` back from now, by default everything held
+	* ``points`` maximum number of points returned per series
+	* ``series`` comma separated ``sensor/metric`` names, e.g. ``thv/temperature,pm/pm2.5``
+
+	Responds with:
+
+	.. code-block:: text
+
+		{
+			"series":{
+				"thv":{
+					"temperature":[[1672531200000, 21.2], ...]
+				}
+			}
+		}
+	"""
+	isLeaf = True
+
+	def __init__(self, history):
+		super().__init__()
+		self.history = history
+
+	def render_GET(self, request):
+		try:
+			end = _getArgument(request, b'end', float, time.time() * 1000) / 1000
+			if b'seconds' in request.args:
+				start = end - _getArgument(request, b'seconds', float, 0)
+			else:
+				start = _getArgument(request, b'start', float, 0) / 1000
+			points = min(_getArgument(request, b'points', int, HISTORY_DEFAULT_POINTS), HISTORY_MAX_POINTS)
+			if points < 3:
+				raise ValueError("points must be at least 3")
+			selected = None
+			if b'series' in request.args:
+				selected = set(tuple(name.split('/', 1)) for name in request.args[b'series'][0].decode().split(','))
+		except ValueError as e:
+			request.setResponseCode(400)
+			return json.dumps({"error": str(e)}).encode()
+
+		# Ranges reaching back past the buffer are cut to what it holds, so that the step is not
+		# stretched by time with no readings in it
+		oldest = self.history.getOldestTimestamp()
+		if oldest is not None:
+			start = max(start, oldest)
+
+		# Thin out long ranges before downsampling so the cost is bounded by points rather than range
+		step = max(end - start, 0) / (points * HISTORY_OVERSAMPLE)
+		timestamps, series = self.history.getWindow(start=start, end=end, step=step)
+		timestamps = [int(timestamp * 1000) for timestamp in timestamps]
+
+		response = {"series": {}}
+		for (sensor, metric), values in series.items():
+			if selected is not None and (sensor, metric) not in selected:
+				continue
+			response["series"].setdefault(sensor, {})[metric] = \
+				[[timestamp, round(value, 3)] for timestamp, value in HistoryBuffer.downsampleLttb(timestamps, values, points)]
+
+		request.setHeader(b'Content-Type', b'application/json')
+		request.setHeader(b'Cache-Control', b'no-store')
+		return json.dumps(response).encode()
+
+class QueryResource(Resource):
+	""" Serves stored readings and rollups as JSON.
+
+	Query arguments:
+
+	* ``metric`` comma separated series names, which may contain wildcards, e.g. ``pm.pm2.5,thv.*``
+	* ``start`` and ``end`` in milliseconds since the epoch, or ``seconds`` back from now, optional
+	* ``resolution`` one of ``raw``, ``1m``, ``15m`` or ``1h``, optional
+	* ``points`` when no resolution is given, the finest resolution returning no more rows than this is used
+
+	Rows are bucket start in milliseconds, minimum, maximum, mean and count. Raw readings are returned in
+	the same form with a count of one.
+
+	.. code-block:: text
+
+		{
+			"resolution":"1h",
+			"series":{
+				"pm.pm2.5":[[1672531200000, 1.2, 8.4, 3.1, 720], ...]
+			}
+		}
+
+	Stores are read on the executor, so long ranges do not hold up the event loop.
+	"""
+	isLeaf = True
+
+	def __init__(self, rollups, store, eventLoop, executor, logger):
+		super().__init__()
+		self.rollups = rollups
+		self.store = store
+		self.eventLoop = eventLoop
+		self.executor = executor
+		self.logger = logger
+
+	def render_GET(self, request):
+		try:
+			if b'metric' not in request.args:
+				raise ValueError("metric is required")
+			patterns = request.args[b'metric'][0].decode().split(',')
+			end = _getArgument(request, b'end', float, time.time() * 1000) / 1000
+			if b'seconds' in request.args:
+				start = end - _getArgument(request, b'seconds', float, 0)
+			else:
+				start = _getArgument(request, b'start', float, 0) / 1000
+			if end <= start:
+				raise ValueError("end must be after start")
+			points = _getArgument(request, b'points', int, QUERY_DEFAULT_POINTS)
+			resolution = _getArgument(request, b'resolution', str, None)
+			if resolution is None:
+				resolution = self.rollups.selectTier(start, end, points)
+			elif resolution == "raw":
+				if self.store is None:
+					raise ValueError("Raw readings are not stored")
+			elif resolution not in self.rollups.getTierNames():
+				raise ValueError("resolution must be one of raw, {}".format(", ".join(self.rollups.getTierNames())))
+		except ValueError as e:
+			request.setResponseCode(400)
+			return json.dumps({"error": str(e)}).encode()
+
+		return _renderInExecutor(request, self.eventLoop, self.executor, self.logger, \
+			{b'Content-Type': b'application/json', b'Cache-Control': b'no-store'}, \
+			self.__query, patterns, int(start * 1000), int(end * 1000), resolution)
+
+	def __query(self, patterns, start, end, resolution):
+		names = self.rollups.getSeriesNames()
+		selected = [name for name in names if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)]
+
+		response = {"resolution": resolution, "series": {}}
+		for name in selected:
+			if resolution == "raw":
+				rows = [(timestamp, value, value, value, 1) for timestamp, value in self.store.query(name, start, end)]
+			else:
+				rows = self.rollups.query(name, start, end, resolution)
+			response["series"][name] = [[row[0], round(row[1], 3), round(row[2], 3), round(row[3], 3), row[4]] for row in rows]
+		return json.dumps(response).encode()
+
+class MetricsResource(Resource):
+	""" Serves the latest reading in Prometheus text exposition format, for scraping by a local Prometheus.
+
+	Series carry the same labels as those written by PrometheusWriter. Output is rendered once per
+	snapshot, so scrapes in between cost no more than sending the cached text.
+	"""
+	isLeaf = True
+
+	def __init__(self, snapshots, staticLabels):
+		super().__init__()
+		self.snapshots = snapshots
+		self.staticLabels = staticLabels
+		self.cache = (None, b'')
+
+	def render_GET(self, request):
+		snapshot = self.snapshots.latest()
+		if self.cache[0] != snapshot.version:
+			self.cache = (snapshot.version, self.__render(snapshot.sensorData))
+
+		request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+		return self.cache[1]
+
+	def __render(self, sensorData):
+		location = sensorData.get("geohash", None)
+
+		series = {}
+		for sensor, sd in sensorData.items():
+			# Skip other keys such as geohash and hardwareId, leaving only sensor data
+			if not isinstance(sd, dict):
+				continue
+
+			sensorType = sd.get("sensor", None)
+			for metric, value in sd.items():
+				# Sensor type is a label rather than a metric
+				if metric == "sensor" or not isinstance(value, (int, float)):
+					continue
+
+				labels = PrometheusWriter.getSeriesLabels(self.staticLabels, metric, sensorType, location)
+				name = dict(labels)["__name__"]
+				labelText = ",".join('{}="{}"'.format(label, _escapeLabelValue(labelValue)) \
+					for label, labelValue in labels if label != "__name__")
+				series.setdefault(name, []).append("{}{{{}}} {}".format(name, labelText, _formatValue(value)))
+
+		lines = []
+		for name in sorted(series):
+			lines.append("# TYPE {} gauge".format(name))
+			lines.extend(series[name])
+		return ("\n".join(lines) + "\n").encode('utf-8')
+
+class RemoteReadResource(Resource):
+	""" Serves the Prometheus remote read protocol at /api/v1/read, see RemoteRead.RemoteReadHandler """
+	isLeaf = True
+
+	def __init__(self, handler, eventLoop, executor, logger):
+		super().__init__()
+		self.handler = handler
+		self.eventLoop = eventLoop
+		self.executor = executor
+		self.logger = logger
+
+	def render_POST(self, request):
+		return _renderInExecutor(request, self.eventLoop, self.executor, self.logger, \
+			{b'Content-Type': b'application/x-protobuf', b'Content-Encoding': b'snappy'}, \
+			self.handler.handle, request.content.read())
+
+def _renderInExecutor(request, eventLoop, executor, logger, headers, func, *args):
+	""" Respond with the bytes returned by func, run on the executor so that slow reads do not hold up the event loop """
+	future = eventLoop.run_in_executor(executor, func, *args)
+	future.add_done_callback(lambda f: _finish(request, f, headers, logger))
+	request.notifyFinish().addErrback(lambda failure: future.cancel())
+	return NOT_DONE_YET
+
+def _finish(request, future, headers, logger):
+	if future.cancelled():
+		return
+
+	try:
+		body = future.result()
+		for name, value in headers.items():
+			request.setHeader(name, value)
+	except ValueError as e:
+		request.setResponseCode(400)
+		body = json.dumps({"error": str(e)}).encode()
+	except Exception as e:
+		logger.error("Request for {} failed, reason {}".format(request.path.decode(), e))
+		request.setResponseCode(500)
+		body = json.dumps({"error": "Request failed"}).encode()
+
+	request.write(body)
+	request.finish()
+
+def _escapeLabelValue(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _formatValue(value):
+	value = float(value)
+	if math.isnan(value):
+		return "NaN"
+	if math.isinf(value):
+		return "+Inf" if value > 0 else "-Inf"
+	return repr(value)
+
+def _getArgument(request, name, convert, default):
+	""" Returns a converted query argument, or default if not present """
+	if name in request.args:
+		return convert(request.args[name][0].decode())
+	return default
@@ -0,0 +1,62 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Websocket broadcast helper class
+'''
+
+import asyncio
+import websockets
+from DesignSpark.ESDK import AppLogger
+
+class WebsocketBroadcaster:
+    """ Fans a single pre-encoded message out to every connected websocket client.
+
+    Each client has a bounded queue, clients that fall behind far enough to fill it are dropped.
+    """
+    def __init__(self, debug=False, loggingLevel='full', queueSize=4):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.queueSize = queueSize
+        self.subscribers = {}
+        self.lastMessage = None
+
+    async def handler(self, websocket, path=None):
+        """ Websocket connection handler, forwards broadcast messages until the client goes away """
+        self.logger.debug("Websocket connection from {}".format(websocket.remote_address))
+        queue = asyncio.Queue(maxsize=self.queueSize)
+
+        # Send the most recent message straight away rather than waiting for the next update
+        if self.lastMessage is not None:
+            queue.put_nowait(self.lastMessage)
+
+        self.subscribers[websocket] = queue
+        sender = asyncio.ensure_future(self._sender(websocket, queue))
+        try:
+            await websocket.wait_closed()
+            self.logger.debug("Websocket connection from {} closed".format(websocket.remote_address))
+        finally:
+            sender.cancel()
+            self.subscribers.pop(websocket, None)
+
+    async def _sender(self, websocket, queue):
+        """ Drain a subscriber queue into its websocket """
+        try:
+            while True:
+                message = await queue.get()
+                await websocket.send(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    def broadcast(self, message):
+        """ Queue an already encoded message for every subscriber """
+        self.lastMessage = message
+        for websocket, queue in list(self.subscribers.items()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.logger.warning("Dropping slow websocket client {}".format(websocket.remote_address))
+                self.subscribers.pop(websocket, None)
+                asyncio.ensure_future(websocket.close(code=1008, reason="Client too slow"))
+
+    def getSubscriberCount(self):
+        return len(self.subscribers)
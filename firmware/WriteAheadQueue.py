@@ -0,0 +1,213 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Durable write-ahead queue
+'''
+
+from DesignSpark.ESDK import AppLogger
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Payload length, CRC32 of the payload and timestamp in milliseconds of the oldest data in it
+RECORD_HEADER = struct.Struct('<IIq')
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+SEGMENT_EXTENSION = ".wal"
+CHECKPOINT_FILE = "checkpoint"
+
+class WriteAheadQueue:
+    """ First in, first out queue of opaque payloads persisted to disk before they are sent.
+
+    Records are appended to numbered segment files and read back in the order they were written. The
+    position of the oldest unacknowledged record is kept in a checkpoint file, which is replaced
+    atomically, and segments are deleted once every record in them has been acknowledged. A record torn
+    by a crash is detected by its length or CRC and truncated on opening.
+
+    When the queue grows beyond maxBytes the oldest segments are dropped, and records older than maxAge
+    are skipped when read.
+
+    :param path: Queue directory
+    :type path: str
+    :param maxBytes: Size cap in bytes, defaults to 64 MiB
+    :type maxBytes: int, optional
+    :param maxAge: Age cap in seconds, defaults to 24 hours
+    :type maxAge: int, optional
+    """
+    def __init__(self, path, debug=False, loggingLevel='full', maxBytes=64 * 1024 * 1024, maxAge=86400):
+        self.logger = AppLogger.getLogger(__name__, debug, loggingLevel)
+        self.path = path
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+        self.segments = sorted(int(filename[:-len(SEGMENT_EXTENSION)]) for filename in os.listdir(self.path) \
+            if filename.endswith(SEGMENT_EXTENSION))
+
+        if self.segments:
+            self.__recoverTail(self.segments[-1])
+        else:
+            self.segments.append(1)
+            open(self.__segmentPath(1), 'ab').close()
+
+        self.readSegment, self.readOffset = self.__readCheckpoint()
+        self.fh = open(self.__segmentPath(self.segments[-1]), 'ab')
+
+        self.count = 0
+        for segment in self.segments:
+            if segment >= self.readSegment:
+                self.count += len(self.__scan(segment, self.readOffset if segment == self.readSegment else 0))
+
+        self.logger.debug("Opened queue {} with {} record(s)".format(self.path, self.count))
+
+    def __segmentPath(self, segment):
+        return os.path.join(self.path, "{:08d}{}".format(segment, SEGMENT_EXTENSION))
+
+    def __scan(self, segment, offset=0):
+        """ Returns a list of (offset, length, crc, timestamp) for the valid records in a segment from offset """
+        records = []
+        with open(self.__segmentPath(segment), 'rb') as fh:
+            data = fh.read()
+
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc, timestamp = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + length
+            if end > len(data) or zlib.crc32(data[offset + RECORD_HEADER.size:end]) != crc:
+                break
+            records.append((offset, length, crc, timestamp))
+            offset = end
+        return records
+
+    def __recoverTail(self, segment):
+        """ Truncate a torn record left at the end of the last segment """
+        records = self.__scan(segment)
+        validSize = records[-1][0] + RECORD_HEADER.size + records[-1][1] if records else 0
+        size = os.path.getsize(self.__segmentPath(segment))
+        if validSize != size:
+            self.logger.warning("Truncating {} from {} to {} bytes".format(self.__segmentPath(segment), size, validSize))
+            os.truncate(self.__segmentPath(segment), validSize)
+
+    def __readCheckpoint(self):
+        try:
+            with open(os.path.join(self.path, CHECKPOINT_FILE), 'r') as fh:
+                checkpoint = json.load(fh)
+            if checkpoint['segment'] in self.segments:
+                return checkpoint['segment'], checkpoint['offset']
+        except (OSError, ValueError, KeyError):
+            pass
+        return self.segments[0], 0
+
+    def __writeCheckpoint(self):
+        temporaryPath = os.path.join(self.path, CHECKPOINT_FILE + ".tmp")
+        with open(temporaryPath, 'w') as fh:
+            json.dump({'segment': self.readSegment, 'offset': self.readOffset}, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temporaryPath, os.path.join(self.path, CHECKPOINT_FILE))
+
+    def put(self, payload, timestamp):
+        """ Append a payload, returning once it is on disk
+
+        :param payload: Data to be queued
+        :type payload: bytes
+        :param timestamp: Time in milliseconds of the oldest data in the payload, used for the age cap
+        :type timestamp: int
+        """
+        with self.lock:
+            if self.fh.tell() >= SEGMENT_SIZE:
+                self.fh.close()
+                self.segments.append(self.segments[-1] + 1)
+                self.fh = open(self.__segmentPath(self.segments[-1]), 'ab')
+
+            self.fh.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload), timestamp) + payload)
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            self.count += 1
+
+            self.__enforceSizeCap()
+
+    def __enforceSizeCap(self):
+        """ Drop the oldest segments, never the one being written to, until the queue fits within maxBytes """
+        size = sum(os.path.getsize(self.__segmentPath(segment)) for segment in self.segments)
+        while size > self.maxBytes and len(self.segments) > 1:
+            segment = self.segments[0]
+            dropped = len(self.__scan(segment, self.readOffset if segment == self.readSegment else 0)) \
+                if segment >= self.readSegment else 0
+            size -= os.path.getsize(self.__segmentPath(segment))
+            self.logger.warning("Queue {} over {} bytes, dropping {} record(s)".format(self.path, self.maxBytes, dropped))
+            self.count -= dropped
+            self.__removeSegment(segment)
+
+    def __removeSegment(self, segment):
+        os.remove(self.__segmentPath(segment))
+        self.segments.remove(segment)
+        if self.readSegment <= segment:
+            self.readSegment, self.readOffset = self.segments[0], 0
+            self.__writeCheckpoint()
+
+    def peek(self):
+        """ Returns the oldest unacknowledged record, skipping any past the age cap
+
+        :return: A tuple of position, timestamp and payload, or None when the queue is empty
+        :rtype: tuple
+        """
+        with self.lock:
+            oldest = int((time.time() - self.maxAge) * 1000)
+            while True:
+                record = self.__read()
+                if record is None:
+                    return None
+
+                position, timestamp, payload = record
+                if timestamp >= oldest:
+                    return record
+
+                self.logger.warning("Dropping queued record from {} as it is over {}s old".format(timestamp, self.maxAge))
+                self.__advance(position)
+
+    def __read(self):
+        while True:
+            path = self.__segmentPath(self.readSegment)
+            with open(path, 'rb') as fh:
+                fh.seek(self.readOffset)
+                header = fh.read(RECORD_HEADER.size)
+                if len(header) == RECORD_HEADER.size:
+                    length, crc, timestamp = RECORD_HEADER.unpack(header)
+                    payload = fh.read(length)
+                    if len(payload) == length and zlib.crc32(payload) == crc:
+                        position = (self.readSegment, self.readOffset + RECORD_HEADER.size + length)
+                        return position, timestamp, payload
+
+            # Nothing more to read in the segment being written to
+            if self.readSegment == self.segments[-1]:
+                return None
+
+            # Every record in an older segment has been read, so it can go
+            finished = self.readSegment
+            self.readSegment, self.readOffset = self.segments[self.segments.index(finished) + 1], 0
+            self.__writeCheckpoint()
+            os.remove(path)
+            self.segments.remove(finished)
+
+    def ack(self, position):
+        """ Acknowledge the record returned by peek() at position, so it is not returned again """
+        with self.lock:
+            self.__advance(position)
+
+    def __advance(self, position):
+        self.readSegment, self.readOffset = position
+        self.count = max(self.count - 1, 0)
+        self.__writeCheckpoint()
+
+    def getCount(self):
+        """ Returns the number of records waiting to be acknowledged """
+        return self.count
+
+    def close(self):
+        with self.lock:
+            self.fh.close()
@@ -13,65 +13,181 @@ import threading
 import logging
 import toml
 import subprocess
-import copy
-import geohash
+import collections
+import functools
+import os
+import signal
 import re
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import RPi.GPIO as GPIO
 from datetime import datetime
 from DesignSpark.ESDK import MAIN, THV, CO2, PM2, NO2, NRD, FDH, AppLogger
-import PrometheusWriter, CsvWriter, MQTT, WebServer, LokiHandler
+import PrometheusWriter, CsvWriter, MQTT, WebServer, LokiHandler, WebsocketBroadcaster, HistoryBuffer, SeriesStore, Rollups, Housekeeping, HttpTransport, RemoteWriteDispatcher, RemoteRead, UploadJobManager, OfflineDrainer, TokenBucket, RetentionManager
 
 configFile='/boot/aq/aq.toml'
 lokiDataDirectory='/aq/data/offline/'
+storeDataDirectory='/aq/data/store/'
+rollupDataDirectory='/aq/data/rollup/'
+queueDataDirectory='/aq/data/wal/'
+csvDataDirectory='/aq/data/csv/'
 debugEnabled = False
 
 loggingButton = 19
+LOGGING_BUTTON_DEBOUNCE_MS = 200
 
 sensorData = {}
 debugData = {}
 csvLoggingEnabledState = False
 
+# Plugin reads are serialised on a single worker and each sensor module has a worker of its own, so that a
+# hung module only holds up itself. Network, file I/O and housekeeping probes share a small pool
+hardwareExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hardware")
+moduleExecutors = {}
+moduleReads = {}
+ioExecutor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="io")
+eventLoop = None
+uploadJobs = None
+
+SENSOR_UPDATE_INTERVAL = 1
 WEBSOCKET_UPDATE_INTERVAL = 5
 CSV_UPDATE_INTERVAL = 30
 PROMETHEUS_MIN_UPDATE_INTERVAL = 120
+STORE_DEFAULT_UPDATE_INTERVAL = 5
+
+# Default module polling intervals in seconds, based on how often each sensor produces a new reading.
+# May be overridden with interval and timeout keys in a section named after the module, e.g. [CO2]
+MODULE_DEFAULT_INTERVALS = {'THV': 1, 'CO2': 5, 'PM2': 1, 'NO2': 2, 'NRD': 1, 'FDH': 2}
+MODULE_DEFAULT_TIMEOUT = 5
+
+# Housekeeping probes are checked every interval and each rerun once its TTL in seconds has passed
+HOUSEKEEPING_UPDATE_INTERVAL = 1
+# Period in seconds at which queued Prometheus writes are checked for being due a retry
+PROMETHEUS_RETRY_CHECK_INTERVAL = 5
+# Period in seconds at which the offline backlog is checked for automatic upload
+OFFLINE_DRAIN_CHECK_INTERVAL = 30
+# Default automatic upload rate limit in KiB/s of compressed data, bursts may be up to ten seconds' worth
+OFFLINE_DRAIN_DEFAULT_RATE = 32
+# Period in seconds between retention checks, and defaults for the percentage of the data filesystem that may be
+# used, hours after which files are compressed and days after which raw stored readings are left to rollups
+RETENTION_CHECK_INTERVAL = 60
+RETENTION_DEFAULT_BUDGET = 80
+RETENTION_DEFAULT_COMPRESS_AFTER = 24
+RETENTION_DEFAULT_RAW_DAYS = 30
+
+HOUSEKEEPING_TTLS = {'location': 5, 'gpsStatus': 5, 'undervoltage': 30, 'aqUsed': 60}
+
+# 24 hours of readings at the sensor update interval, served to dashboards by the web server
+HISTORY_LENGTH = 86400
+
+# Seconds allowed for tasks to finish once cancelled at shutdown
+SHUTDOWN_TIMEOUT = 10
+
+# One immutable reading per acquisition cycle, readers must treat the dictionaries as read-only
+Snapshot = collections.namedtuple('Snapshot', ['version', 'timestamp', 'sensorData', 'debugData'])
+
+class SnapshotPublisher:
+    """ Hands out references to the most recent snapshot, replacing it wholesale on each publish """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = Snapshot(version=0, timestamp=0, sensorData={}, debugData={})
+
+    def publish(self, sensorData, debugData):
+        """ Publish new snapshot, dictionaries passed in must not be modified afterwards """
+        with self._lock:
+            self._snapshot = Snapshot(version=self._snapshot.version + 1, \
+                timestamp=time.time(), \
+                sensorData=sensorData, \
+                debugData=debugData)
+            return self._snapshot
+
+    def latest(self):
+        """ Return the most recently published snapshot """
+        return self._snapshot
+
+snapshots = SnapshotPublisher()
+consumedVersions = {}
+history = HistoryBuffer.HistoryBuffer(HISTORY_LENGTH)
+store = None
+rollups = None
+# Module and plugin readings as (timestamp, reading) tuples, held until added to the rollups
+rollupReadings = collections.deque()
+
+def newSnapshot(consumer):
+    """ Return the latest snapshot if the named consumer has not seen it yet, otherwise None """
+    snapshot = snapshots.latest()
+    if snapshot.version == consumedVersions.get(consumer, 0):
+        return None
+    consumedVersions[consumer] = snapshot.version
+    return snapshot
 
-async def websocketPush(websocket, path):
-    logger.debug("Websocket connection from {}".format(websocket.remote_address))
+async def runPeriodic(name, interval, func, *args):
+    """ Await func every interval seconds against fixed deadlines so that run time does not accumulate as drift """
+    deadline = eventLoop.time()
     while True:
-        localData = copy.deepcopy(sensorData)
-        localData.update({"debug": debugData})
-        await websocket.send(json.dumps(localData, ensure_ascii=False))
-        await asyncio.sleep(WEBSOCKET_UPDATE_INTERVAL)
-
-async def controlWebsocket(websocket, path):
+        try:
+            await func(*args)
+        except Exception as e:
+            logger.error("Periodic task {} failed, reason {}".format(name, e))
+
+        deadline += interval
+        now = eventLoop.time()
+        if deadline < now:
+            # Overran, skip the missed deadlines rather than running back to back to catch up
+            missed = int((now - deadline) // interval) + 1
+            logger.debug("Periodic task {} overran, skipping {} run(s)".format(name, missed))
+            deadline += missed * interval
+        await asyncio.sleep(deadline - now)
+
+async def websocketPush(broadcaster):
+    """ Encode each new snapshot once and hand the same message to every data websocket client """
+    snapshot = newSnapshot("websocket")
+    if snapshot is not None:
+        localData = dict(snapshot.sensorData)
+        localData.update({"debug": snapshot.debugData})
+        broadcaster.broadcast(json.dumps(localData, ensure_ascii=False))
+
+async def controlWebsocket(websocket, path=None):
     logger.debug("Websocket connection from {}".format(websocket.remote_address))
-    async for message in websocket:
-        logger.debug("Control websocket message {}".format(message))
-        message = json.loads(message)
-        if 'command' in message:
-            if message['command'] == "filecount":
-                await websocket.send(json.dumps({"result":lokiLogger.GetFileCount()}))
-
-            if message['command'] == "upload":
-                config = getLokiConfig()
-                instance = config['instance']
-                key = config['key']
-                result = lokiLogger.UploadLogFiles(instance, key)
-                await websocket.send(json.dumps({"result":result}))
+    try:
+        async for message in websocket:
+            logger.debug("Control websocket message {}".format(message))
+            message = json.loads(message)
+            if 'command' in message:
+                # File operations block, so run them off the event loop
+                if message['command'] == "filecount":
+                    result = await eventLoop.run_in_executor(ioExecutor, lokiLogger.GetFileCount)
+                    await websocket.send(json.dumps({"result":result}))
+
+                # Uploads run in the background, progress is sent to the client as they go
+                if message['command'] == "upload":
+                    config = getLokiConfig()
+                    if config is None:
+                        await websocket.send(json.dumps({"error":"No [loki] configuration"}))
+                        continue
+                    job = uploadJobs.start(websocket, lokiLogger.UploadLogFiles, config['instance'], config['key'])
+                    await websocket.send(json.dumps({"job":job}))
+
+                if message['command'] in ("attach", "cancel"):
+                    try:
+                        if message['command'] == "attach":
+                            job = uploadJobs.attach(websocket, message.get('job', None))
+                        else:
+                            job = uploadJobs.cancel(message.get('job', None))
+                        await websocket.send(json.dumps({"job":job}))
+                    except ValueError as e:
+                        await websocket.send(json.dumps({"error":str(e)}))
+
+                if message['command'] == "jobs":
+                    await websocket.send(json.dumps({"jobs":uploadJobs.getJobs()}))
+    finally:
+        uploadJobs.detach(websocket)
 
 def main():
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(loggingButton, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    GPIO.add_event_detect(loggingButton, GPIO.RISING)
-
-    buttonWatcherThreadHandle = threading.Thread(target=buttonWatcherThread, \
-        args=(), \
-        daemon=True)
-    buttonWatcherThreadHandle.name = "buttonWatcherThread"
-    buttonWatcherThreadHandle.start()
 
     global configData
     configData = getConfig()
@@ -98,7 +214,7 @@ def main():
     remoteWriteTimestamps = {'remoteWriteSuccess': 0, 'remoteWriteFail': 0}
 
     global lokiLogger
-    lokiLogger = LokiHandler.LokiHandler(lokiDataDirectory, debugEnabled)
+    lokiLogger = LokiHandler.LokiHandler(lokiDataDirectory, debugEnabled, **getSpoolConfig())
 
     debugData.update({'csvEnabled': getCsvEnabled()})
     debugData.update({'debugEnabled': debugEnabled})
@@ -123,147 +239,319 @@ def main():
     mainboard.createModules()
     time.sleep(0.05)
 
-    logger.debug("Starting sensor update thread")
-    sensorsUpdateThreadHandle = threading.Thread(target=sensorsUpdateThread, \
-        args=(sensorData, ), \
-        daemon=True)
-    sensorsUpdateThreadHandle.name = "sensorsUpdateThread"
-    sensorsUpdateThreadHandle.start()
-
-    global mqtt
-    mqttConfig = getMqttConfig()
-
-    # MQTT thread init
-    if mqttConfig is not None:
-        mqtt = MQTT.MQTT(debug=debugEnabled, \
-            configDict=getMqttConfig(), \
-            hwid=hwid['hardwareId'], \
-            loggingLevel=loggingConfig)
-
-        logger.debug("Starting MQTT update thread")
-        mqttUpdateThreadHandle = threading.Thread(target=mqttUpdateThread, \
-            args=(sensorData, ), \
-            daemon=True)
-
-        mqttUpdateThreadHandle.name = "mqttUpdateThread"
-        mqttUpdateThreadHandle.start()
-
-    global csvLoggingEnabledState
-    csvEnabled = getCsvEnabled()
-    # CSV thread init
-    if csvEnabled:
-        logger.debug("Starting CSV update thread")
-        csvUpdateThreadHandle = threading.Thread(target=csvUpdateThread, \
-            args=(debugEnabled, sensorData, hwid, loggingConfig), \
-            daemon=True)
-        csvLoggingEnabledState = csvEnabled
-        csvUpdateThreadHandle.name = "csvUpdateThread"
-        csvUpdateThreadHandle.start()
-
-
-    # Prometheus threads init
-    prometheusConfig = getPrometheusConfig()
-    if prometheusConfig is not None:
-        prometheusThreads = list()
-
-        # Start thread for each configuration present
-        for name, config in prometheusConfig.items():
-            logger.debug("Starting Prometheus update thread for config {}".format(name))
-            prometheusUpdateThreadHandle = threading.Thread(target=prometheusUpdateThread, \
-                args=(config, debugEnabled, sensorData, hwid['hardwareId'], loggingConfig), \
-                daemon=True)
-
-            prometheusUpdateThreadHandle.name = "prometheusUpdateThread_{}".format(name)
-            prometheusThreads.append(prometheusUpdateThreadHandle)
-            prometheusUpdateThreadHandle.start()
-
-        logger.debug("Started Prometheus threads: {}".format(prometheusThreads))
-
-    logger.debug("Starting web server thread")
-    webServerThreadHandle = threading.Thread(target=webServerThread, \
-        args=(debugEnabled, loggingConfig), \
-        daemon=True)
-    webServerThreadHandle.name = "webServerThread"
-    webServerThreadHandle.start()
-
-    logger.debug("Starting control websocket thread")
-    controlWebsocketThreadHandle = threading.Thread(target=controlWebsocketThread, \
-        args=(), \
-        daemon=True)
-    controlWebsocketThreadHandle.name = "controlWebsocketThread"
-    controlWebsocketThreadHandle.start()
-
-    logger.debug("Starting asyncio data websocket")
-    asyncio.run(startWebsocket())
-
-    while True:
-        pass
-
-async def startWebsocket():
-    logger.debug("Started data websocket")
-    async with websockets.serve(websocketPush, "0.0.0.0", 8765):
-        await asyncio.Future()  # run forever
-
-def controlWebsocketThread():
-    logger.debug("Started control websocket thread")
-    logger.debug("Starting asyncio control websocket")
-    asyncio.run(startControlWebsocket())
-
-
-async def startControlWebsocket():
-    logger.debug("Started control websocket")
-    async with websockets.serve(controlWebsocket, "0.0.0.0", 8766):
-        await asyncio.Future()  # run forever
+    try:
+        asyncio.run(runtime(debugEnabled, loggingConfig, hwid))
+    finally:
+        # Don't wait on workers, a hung sensor read would otherwise prevent exit
+        hardwareExecutor.shutdown(wait=False)
+        ioExecutor.shutdown(wait=False)
+        for executor in moduleExecutors.values():
+            executor.shutdown(wait=False)
+        lokiLogger.close()
+        logger.info("Stopped")
+
+async def runtime(debugEnabled, loggingLevel, hwid):
+    """ Hosts sensor polling, data sinks, websockets and the web server on a single event loop """
+    global eventLoop
+    eventLoop = asyncio.get_running_loop()
+
+    stopEvent = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        eventLoop.add_signal_handler(signum, stopEvent.set)
+    stopTask = asyncio.ensure_future(stopEvent.wait())
+
+    global csvLoggingEnabled, csvLoggingDisabled
+    csvLoggingEnabled = asyncio.Event()
+    csvLoggingDisabled = asyncio.Event()
+
+    for name in mainboard.sensorModules:
+        moduleExecutors[name] = ThreadPoolExecutor(max_workers=1, thread_name_prefix="module_{}".format(name))
+
+    # Everything started is stopped again should any later part of setup fail
+    tasks = []
+    writers = []
+    webServer = None
+    websocketServers = []
+    try:
+        global housekeeping
+        housekeeping = Housekeeping.Housekeeping(debug=debugEnabled, loggingLevel=loggingLevel)
+        housekeeping.addProbe('location', lambda: dict(mainboard.getLocation()), HOUSEKEEPING_TTLS['location'], {})
+        housekeeping.addProbe('gpsStatus', lambda: dict(mainboard.getGPSStatus()['gpsStatus']), HOUSEKEEPING_TTLS['gpsStatus'], {})
+        housekeeping.addProbe('undervoltage', mainboard.getUndervoltageStatus, HOUSEKEEPING_TTLS['undervoltage'], {})
+        housekeeping.addProbe('aqUsed', getAqUsedPercentage, HOUSEKEEPING_TTLS['aqUsed'], 0)
+
+        # Take a first reading so that sinks have data from their first run
+        await housekeepingUpdate(sensorData)
+        await asyncio.gather(*(readModule(name, getModuleTimeout(name), sensorData) for name in mainboard.sensorModules))
+        await updateSensors(sensorData)
+
+        for name in mainboard.sensorModules:
+            logger.debug("Starting {} module task, interval {}s".format(name, getModuleInterval(name)))
+            tasks.append(asyncio.ensure_future(runPeriodic("module_{}".format(name), getModuleInterval(name), \
+                readModule, name, getModuleTimeout(name), sensorData)))
+
+        logger.debug("Starting sensor update task")
+        tasks.append(asyncio.ensure_future(runPeriodic("sensors", SENSOR_UPDATE_INTERVAL, updateSensors, sensorData)))
+
+        # Nothing is read without sensor polling, whereas any other task exiting only loses what it provides
+        criticalTasks = set(tasks)
+
+        logger.debug("Starting housekeeping task")
+        tasks.append(asyncio.ensure_future(runPeriodic("housekeeping", HOUSEKEEPING_UPDATE_INTERVAL, housekeepingUpdate, sensorData)))
+
+        global mqtt
+        mqttConfig = getMqttConfig()
+
+        # MQTT task init
+        if mqttConfig is not None:
+            mqtt = MQTT.MQTT(debug=debugEnabled, \
+                configDict=getMqttConfig(), \
+                hwid=hwid['hardwareId'], \
+                loggingLevel=loggingLevel)
 
-def webServerThread(debugEnabled, loggingLevel):
-    logger.debug("Started web server thread")
-    ws = WebServer.WebServer(debug=debugEnabled, loggingLevel=loggingLevel)
-    ws.run()
-    logger.debug("Web server should be running")
-    while True:
-        pass
+            logger.debug("Starting MQTT update task")
+            tasks.append(asyncio.ensure_future(runPeriodic("mqtt", WEBSOCKET_UPDATE_INTERVAL, mqttUpdate)))
+
+        # Local store init
+        global store, rollups
+        if getStoreEnabled():
+            store = SeriesStore.SeriesStore(storeDataDirectory, debug=debugEnabled, loggingLevel=loggingLevel)
+            rollups = Rollups.Rollups(rollupDataDirectory, debug=debugEnabled, loggingLevel=loggingLevel)
+
+            logger.debug("Starting store update task")
+            tasks.append(asyncio.ensure_future(runPeriodic("store", getStoreInterval(), storeUpdate)))
+
+        # CSV task init, always started as logging may be enabled later using the button
+        logger.debug("Starting CSV logging task")
+        tasks.append(asyncio.ensure_future(csvLoggingTask(debugEnabled, hwid, loggingLevel)))
+        setCsvLoggingState(getCsvEnabled())
+
+        # Keeps CSV files, offline data and the store within the disk budget
+        retention = RetentionManager.RetentionManager(getRetentionPath(), \
+            budget=getRetentionBudget(), \
+            compressAfter=getRetentionCompressAfter() * 3600, \
+            rawRetention=getRetentionRawDays() * 86400, \
+            csvDirectory=csvDataDirectory, \
+            spool=lokiLogger.spool, \
+            store=store, \
+            rollups=rollups, \
+            debug=debugEnabled, \
+            loggingLevel=loggingLevel)
+        tasks.append(asyncio.ensure_future(runPeriodic("retention", RETENTION_CHECK_INTERVAL, retentionUpdate, retention)))
+
+        GPIO.add_event_detect(loggingButton, GPIO.RISING, \
+            callback=loggingButtonCallback, \
+            bouncetime=LOGGING_BUTTON_DEBOUNCE_MS)
+
+        # Prometheus tasks init
+        prometheusConfig = getPrometheusConfig()
+        if prometheusConfig is not None:
+            lokiEnabled = getOfflineLoggingConfig() == "auto"
+
+            # Readings are encoded once for all endpoints sharing the same labels, then sent to each when due
+            dispatcher = RemoteWriteDispatcher.RemoteWriteDispatcher(debug=debugEnabled, loggingLevel=loggingLevel)
+            for name, config in prometheusConfig.items():
+                logger.debug("Adding Prometheus endpoint for config {}".format(name))
+                writer, interval = createPrometheusWriter(name, config, debugEnabled, hwid['hardwareId'], loggingLevel)
+                writers.append(writer)
+                dispatcher.addEndpoint(name, writer, interval)
+                if writer.queue is not None:
+                    tasks.append(asyncio.ensure_future(runPeriodic("prometheus_{}_retry".format(name), \
+                        PROMETHEUS_RETRY_CHECK_INTERVAL, prometheusRetry, writer)))
+
+            if writers:
+                # Every reading is buffered for writing, not just those at the time of each write. Started first so
+                # that the first reading is buffered in time for the first write
+                tasks.append(asyncio.ensure_future(runPeriodic("prometheus_buffer", \
+                    SENSOR_UPDATE_INTERVAL, prometheusBuffer, dispatcher)))
+
+                logger.debug("Starting Prometheus update task, interval {}s".format(dispatcher.getTickInterval()))
+                tasks.append(asyncio.ensure_future(runPeriodic("prometheus", \
+                    dispatcher.getTickInterval(), prometheusUpdate, dispatcher, lokiEnabled)))
+
+        logger.debug("Starting data websocket")
+        broadcaster = WebsocketBroadcaster.WebsocketBroadcaster(debug=debugEnabled, \
+            loggingLevel=loggingLevel)
+        tasks.append(asyncio.ensure_future(runPeriodic("websocket", WEBSOCKET_UPDATE_INTERVAL, websocketPush, broadcaster)))
+        websocketServers.append(await websockets.serve(broadcaster.handler, "0.0.0.0", 8765))
+
+        logger.debug("Starting control websocket")
+        global uploadJobs
+        uploadJobs = UploadJobManager.UploadJobManager(eventLoop, ioExecutor, debug=debugEnabled, loggingLevel=loggingLevel)
+        websocketServers.append(await websockets.serve(controlWebsocket, "0.0.0.0", 8766))
+
+        # Offline data is uploaded automatically once remote writes succeed, rate limited so live writes come first
+        lokiConfig = getLokiConfig()
+        if lokiConfig is not None and getAutoUploadEnabled():
+            rate = getAutoUploadRate() * 1024
+            upload = functools.partial(lokiLogger.UploadLogFiles, lokiConfig['instance'], lokiConfig['key'], \
+                rateLimit=TokenBucket.TokenBucket(rate, rate * 10))
+            drainer = OfflineDrainer.OfflineDrainer(uploadJobs, upload, \
+                lambda: lokiLogger.GetFileCount()['filecount'], \
+                remoteWriteTimestamps, \
+                debug=debugEnabled, \
+                loggingLevel=loggingLevel)
+            logger.debug("Starting offline upload task, rate limit {:g} KiB/s".format(getAutoUploadRate()))
+            tasks.append(asyncio.ensure_future(runPeriodic("offline_drain", OFFLINE_DRAIN_CHECK_INTERVAL, drainer.check)))
+
+        # Remote read and scraping use the same labels as remote write, without a hardware ID should it be unknown
+        metricsLabels = PrometheusWriter.getStaticLabels(getFriendlyName(), \
+            hwid['hardwareId'] if isinstance(hwid, dict) else None, \
+            configData['ESDK'])
+        remoteRead = None
+        if store is not None:
+            remoteRead = RemoteRead.RemoteReadHandler(store, metricsLabels, snapshots.latest, \
+                debug=debugEnabled, loggingLevel=loggingLevel)
+
+        logger.debug("Starting web server")
+        webServer = WebServer.WebServer(debug=debugEnabled, \
+            loggingLevel=loggingLevel, \
+            eventLoop=eventLoop, \
+            history=history, \
+            rollups=rollups, \
+            store=store, \
+            executor=ioExecutor, \
+            snapshots=snapshots, \
+            metricsLabels=metricsLabels, \
+            remoteRead=remoteRead)
+        webServer.start()
+
+        # Runs until asked to stop
+        waiting = set(tasks)
+        waiting.add(stopTask)
+        while not stopTask.done():
+            done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is stopTask:
+                    continue
+                reason = "cancelled" if task.cancelled() else task.exception()
+                logger.error("Task {} exited unexpectedly, reason {}".format(task, reason))
+                if task in criticalTasks:
+                    raise RuntimeError("Sensor polling stopped")
+        logger.info("Stopping on request")
+    except Exception as e:
+        logger.error("Stopping on error, reason {}".format(e))
+        raise
+    finally:
+        GPIO.remove_event_detect(loggingButton)
+        if webServer is not None:
+            webServer.stop()
+        for server in websocketServers:
+            server.close()
+        for task in tasks + [stopTask]:
+            task.cancel()
+        done, pending = await asyncio.wait(tasks + [stopTask], timeout=SHUTDOWN_TIMEOUT)
+        if pending:
+            logger.warning("{} task(s) did not stop within {}s: {}".format(len(pending), SHUTDOWN_TIMEOUT, pending))
+        for server in websocketServers:
+            await server.wait_closed()
+        if store is not None:
+            await eventLoop.run_in_executor(ioExecutor, store.close)
+        if rollups is not None:
+            await eventLoop.run_in_executor(ioExecutor, rollups.close)
+        for writer in writers:
+            writer.close()
+
+def loggingButtonCallback(channel):
+    """ GPIO edge callback, runs on the GPIO library thread so hands over to the event loop """
+    eventLoop.call_soon_threadsafe(toggleCsvLogging)
+
+def toggleCsvLogging():
+    if csvLoggingEnabledState:
+        logger.debug("Stopping CSV logging on user request")
+    else:
+        logger.debug("Starting CSV logging on user request")
+    setCsvLoggingState(not csvLoggingEnabledState)
 
-def buttonWatcherThread():
+def setCsvLoggingState(state):
+    """ Enable or disable CSV logging, must be called on the event loop """
     global csvLoggingEnabledState
-    while True:
-        if GPIO.event_detected(loggingButton):
-            if csvLoggingEnabledState:
-                logger.debug("Stopping CSV logging on user request")
-                csvLoggingEnabledState = False
-                debugData.update({'csvEnabled': csvLoggingEnabledState})
-            elif not csvLoggingEnabledState:
-                logger.debug("Starting CSV logging on user request")
-                csvLoggingEnabledState = True
-                debugData.update({'csvEnabled': csvLoggingEnabledState})
-
-def sensorsUpdateThread(sensorDataHandle):
-    logger.debug("Started sensor update thread")
-    while True:
-        sensorDataHandle.update(mainboard.readAllModules())
-
+    csvLoggingEnabledState = state
+    debugData.update({'csvEnabled': csvLoggingEnabledState})
+    if state:
+        csvLoggingDisabled.clear()
+        csvLoggingEnabled.set()
+    else:
+        csvLoggingEnabled.clear()
+        csvLoggingDisabled.set()
+
+async def readModule(name, timeout, sensorDataHandle):
+    """ Read a single sensor module on its own worker, giving up on waiting for it after timeout seconds """
+    pending = moduleReads.get(name)
+    if pending is not None and not pending.done():
+        logger.debug("Module {} read still in progress, skipping".format(name))
+        return
+
+    future = eventLoop.run_in_executor(moduleExecutors[name], mainboard.sensorModules[name].readSensors)
+    future.add_done_callback(functools.partial(moduleReadDone, name, sensorDataHandle))
+    moduleReads[name] = future
+    # Unlike wait_for, the read carries on, and is tracked as in progress, after a timeout. Nor is a
+    # cancellation arriving as the read completes lost, which would leave the task running at shutdown.
+    # Read errors are logged by moduleReadDone
+    done, pending = await asyncio.wait({future}, timeout=timeout)
+    if pending:
+        logger.warning("Module {} read timed out after {}s".format(name, timeout))
+
+def moduleReadDone(name, sensorDataHandle, future):
+    """ Store a module reading, including one that completes after its read timed out """
+    if future.cancelled():
+        return
+
+    if future.exception() is not None:
+        logger.error("Could not read module {}, reason: {}".format(name, future.exception()))
+    elif future.result() != -1:
+        addReading(sensorDataHandle, future.result())
+
+def addReading(sensorDataHandle, reading):
+    """ Apply a new module or plugin reading, also keeping it for the rollups """
+    sensorDataHandle.update(reading)
+    # Only new readings are aggregated, as those carried forward between reads would be counted again
+    if rollups is not None:
+        rollupReadings.append((time.time(), reading))
+
+def readPlugins(sensorDataHandle):
+    """ Read any loaded ESDK plugins """
+    for plugin in mainboard.plugins:
         try:
-            rawLocation = mainboard.getLocation()
-            sensorDataHandle.update({'geohash': geohash.encode(rawLocation['lat'], rawLocation['lon'])})
-            debugData.update({'location': {'lat': rawLocation['lat'], 'lon': rawLocation['lon']}})
+            data = plugin.readSensors()
+            if data != -1:
+                addReading(sensorDataHandle, data)
         except Exception as e:
-            pass
-
-        debugData.update({'aqUsed': getAqUsedPercentage()})
-        debugData.update(mainboard.getUndervoltageStatus())
-        debugData.update(mainboard.getGPSStatus())
-        debugData.update({'remoteWriteStats': remoteWriteTimestamps})
-
-        time.sleep(1)
-
-def mqttUpdateThread(sensorData):
-    logger.debug("Started MQTT thread")
-    while True:
-        mqtt.publishMessage(json.dumps(sensorData))
-        time.sleep(WEBSOCKET_UPDATE_INTERVAL)
-
-def prometheusUpdateThread(config, debugEnabled, sensorData, hwid, loggingLevel):
-    logger.debug("Started Prometheus update thread")
-
+            logger.error("Could not read plugin {}, reason: {}".format(plugin.__class__.__name__, e))
+
+async def housekeepingUpdate(sensorDataHandle):
+    """ Refresh any expired housekeeping probes off the event loop, then apply the cached results """
+    refreshed = await eventLoop.run_in_executor(ioExecutor, housekeeping.refresh)
+    if not refreshed:
+        return
+
+    location = housekeeping.get('location')
+    if 'lat' in location and 'lon' in location:
+        sensorDataHandle.update({'geohash': housekeeping.getGeohash(location['lat'], location['lon'])})
+        debugData.update({'location': {'lat': location['lat'], 'lon': location['lon']}})
+
+    debugData.update({'aqUsed': housekeeping.get('aqUsed')})
+    debugData.update(housekeeping.get('undervoltage'))
+    debugData.update({'gpsStatus': housekeeping.get('gpsStatus')})
+
+async def updateSensors(sensorDataHandle):
+    if mainboard.plugins:
+        await eventLoop.run_in_executor(hardwareExecutor, readPlugins, sensorDataHandle)
+    debugData.update({'remoteWriteStats': dict(remoteWriteTimestamps)})
+    debugData.update({'transportStats': HttpTransport.getTransportStats()})
+
+    # Shallow copies are sufficient, module readings are replaced rather than modified between reads.
+    # Modules polled less often than this carry their latest reading forward
+    snapshot = snapshots.publish(dict(sensorDataHandle), dict(debugData))
+    history.append(snapshot.timestamp, snapshot.sensorData)
+
+async def mqttUpdate():
+    snapshot = newSnapshot("mqtt")
+    if snapshot is not None:
+        await eventLoop.run_in_executor(ioExecutor, mqtt.publishMessage, json.dumps(snapshot.sensorData))
+
+def createPrometheusWriter(name, config, debugEnabled, hwid, loggingLevel):
+    """ Returns a Prometheus writer for a configuration section, along with its update interval """
     localConfig = config
     localConfig.update({'friendlyname': getFriendlyName()})
 
@@ -281,60 +569,111 @@ def prometheusUpdateThread(config, debugEnabled, sensorData, hwid, loggingLevel)
         hwid=hwid, \
         loggingLevel=loggingLevel, \
         additionalLabels=configData['ESDK'], \
-        remoteWriteTimestamps = remoteWriteTimestamps)
-
-
-    if getOfflineLoggingConfig() == "auto":
-        lokiEnabled = True
-    else:
-        lokiEnabled = False
-
+        remoteWriteTimestamps = remoteWriteTimestamps, \
+        queuePath=queueDataDirectory + name if localConfig.get('queue', False) else None)
+
+    return writer, int(localConfig['interval'])
+
+async def prometheusBuffer(dispatcher):
+    snapshot = newSnapshot("prometheus")
+    if snapshot is not None:
+        dispatcher.addSamples(snapshot.timestamp, snapshot.sensorData)
+
+async def prometheusRetry(writer):
+    if writer.getQueuedCount():
+        await eventLoop.run_in_executor(ioExecutor, writer.drain)
+
+async def prometheusUpdate(dispatcher, lokiEnabled):
+    due = await eventLoop.run_in_executor(ioExecutor, dispatcher.tick)
+
+    # Endpoints are written to concurrently, so a slow endpoint does not hold up the others
+    results = await asyncio.gather(*(eventLoop.run_in_executor(ioExecutor, writer.writePayloads, payloads, oldest) \
+        for name, writer, payloads, oldest in due), return_exceptions=True)
+
+    failed = False
+    for (name, writer, payloads, oldest), result in zip(due, results):
+        if isinstance(result, Exception):
+            logger.error("Prometheus {} write failed, reason {}".format(name, result))
+            failed = True
+
+    # Without a queue, or should queueing itself fail, the latest reading is kept for Loki
+    if failed and lokiEnabled:
+        await eventLoop.run_in_executor(ioExecutor, writeOfflineData, snapshots.latest())
+
+def writeOfflineData(snapshot):
+    """ Stores a snapshot for later upload to Loki """
+    # Add additional data to a copy of the sensor data, snapshot dictionaries are read-only
+    sensorDataCopy = dict(snapshot.sensorData)
+    sensorDataCopy.update({'friendlyname': getFriendlyName()})
+
+    if 'project' in configData['ESDK']:
+        sensorDataCopy.update({'project': configData['ESDK']['project']})
+    if 'location' in configData['ESDK']:
+        sensorDataCopy.update({'location': configData['ESDK']['location']})
+    if 'tag' in configData['ESDK']:
+        sensorDataCopy.update({'tag': configData['ESDK']['tag']})
+
+    # Generate timestamp in nanoseconds (as per Loki documentation)
+    ts = lokiLogger.dt2ts(datetime.utcnow()) * 1000000000
+
+    lokiLogger.WriteLogFile(data=sensorDataCopy, timestamp=ts)
+
+async def storeUpdate():
+    snapshot = newSnapshot("store")
+    if snapshot is not None:
+        await eventLoop.run_in_executor(ioExecutor, store.appendReadings, snapshot.timestamp, snapshot.sensorData)
+
+    # Rollups are built from every reading since the last update, not just the latest
+    readings = [rollupReadings.popleft() for _ in range(len(rollupReadings))]
+    if readings:
+        await eventLoop.run_in_executor(ioExecutor, appendRollups, readings)
+
+def appendRollups(readings):
+    for timestamp, reading in readings:
+        rollups.appendReadings(timestamp, reading)
+
+async def retentionUpdate(retention):
+    await eventLoop.run_in_executor(ioExecutor, retention.check)
+
+async def csvLoggingTask(debugEnabled, hwid, loggingLevel):
+    logger.debug("Started CSV logging task")
     while True:
-        try:
-            writer.writeData(sensorData)
-        except Exception as e:
-            if lokiEnabled:
-                # Add additional data to sensor data dictionary
-                sensorDataCopy = copy.deepcopy(sensorData)
-                sensorDataCopy.update({'friendlyname': getFriendlyName()})
-
-                if 'project' in configData['ESDK']:
-                    sensorDataCopy.update({'project': configData['ESDK']['project']})
-                if 'location' in configData['ESDK']:
-                    sensorDataCopy.update({'location': configData['ESDK']['location']})
-                if 'tag' in configData['ESDK']:
-                    sensorDataCopy.update({'tag': configData['ESDK']['tag']})
-
-                # Generate timestamp in nanoseconds (as per Loki documentation)
-                ts = lokiLogger.dt2ts(datetime.utcnow()) * 1000000000
-
-                lokiLogger.WriteLogFile(data=sensorDataCopy, timestamp=ts)
-            else:
-                pass
-
-        time.sleep(localConfig['interval'])
+        # Sleep until logging is enabled
+        await csvLoggingEnabled.wait()
 
-def csvUpdateThread(debugEnabled, sensorData, hwid, loggingLevel):
-    logger.debug("Started CSV update thread")
-    global csvLoggingEnabledState
-    firstRun = True
-    csv = None
-    while True:
-        if csvLoggingEnabledState:
-            if firstRun == True:
-                logger.info("Starting CSV logging")
-                csv = CsvWriter.CsvWriter(debug=debugEnabled, \
+        logger.info("Starting CSV logging")
+        try:
+            csv = await eventLoop.run_in_executor(ioExecutor, functools.partial(CsvWriter.CsvWriter, \
+                debug=debugEnabled, \
                 friendlyName=getFriendlyName(), \
                 hwid=hwid['hardwareId'], \
-                loggingLevel=loggingLevel)
-                firstRun = False
-
-            csv.addRow(sensorData)
-            time.sleep(CSV_UPDATE_INTERVAL)
+                loggingLevel=loggingLevel, \
+                directory=csvDataDirectory, \
+                **getCsvConfig()))
+        except Exception as e:
+            # Left disabled until the button is pressed again, rather than retrying continuously
+            logger.error("Could not start CSV logging, reason {}".format(e))
+            setCsvLoggingState(False)
+            continue
 
-        if not csvLoggingEnabledState:
-            firstRun = True
-            csv = None
+        consumedVersions.pop("csv", None)
+        csvUpdateTask = asyncio.ensure_future(runPeriodic("csv", getCsvInterval(), csvUpdate, csv))
+        try:
+            await csvLoggingDisabled.wait()
+        finally:
+            csvUpdateTask.cancel()
+            # Write out buffered rows, including when the application is shutting down
+            try:
+                await asyncio.shield(eventLoop.run_in_executor(ioExecutor, csv.close))
+            except Exception as e:
+                logger.error("Could not close CSV file, reason {}".format(e))
+
+        logger.info("Stopped CSV logging")
+
+async def csvUpdate(csv):
+    snapshot = newSnapshot("csv")
+    if snapshot is not None:
+        await eventLoop.run_in_executor(ioExecutor, csv.addRow, snapshot.sensorData)
 
 def getDebugConfig():
     """ Return debugging configuration """
@@ -460,6 +799,55 @@ def getOfflineLoggingConfig():
     else:
         return "off"
 
+def getSpoolConfig():
+    """ Return a dictionary of offline data spool settings, as keyword arguments for LokiHandler """
+    localConfig = configData.get('local', {})
+    return {
+        'segmentSize': int(float(localConfig.get('spoolsize', 1)) * 1024 * 1024),
+        'segmentAge': int(float(localConfig.get('spoolrotate', 60)) * 60),
+        'compress': bool(localConfig.get('spoolcompress', False))
+    }
+
+def getAutoUploadEnabled():
+    """ Return whether offline data is uploaded automatically, defaults to enabled """
+    if 'local' in configData and 'autoupload' in configData['local']:
+        return configData['local']['autoupload']
+    else:
+        return True
+
+def getAutoUploadRate():
+    """ Return automatic upload rate limit in KiB/s """
+    if 'local' in configData and 'uploadrate' in configData['local']:
+        return max(float(configData['local']['uploadrate']), 1)
+    else:
+        return OFFLINE_DRAIN_DEFAULT_RATE
+
+def getRetentionPath():
+    """ Return the directory holding all local data, the budget applying to the filesystem it is on """
+    return os.path.commonpath([lokiDataDirectory, storeDataDirectory, rollupDataDirectory, queueDataDirectory, \
+        csvDataDirectory])
+
+def getRetentionBudget():
+    """ Return the highest percentage of the data filesystem that may be used before old data is evicted """
+    if 'local' in configData and 'diskbudget' in configData['local']:
+        return min(max(float(configData['local']['diskbudget']), 1), 100)
+    else:
+        return RETENTION_DEFAULT_BUDGET
+
+def getRetentionCompressAfter():
+    """ Return age in hours after which CSV files and offline data are compressed """
+    if 'local' in configData and 'compressafter' in configData['local']:
+        return float(configData['local']['compressafter'])
+    else:
+        return RETENTION_DEFAULT_COMPRESS_AFTER
+
+def getRetentionRawDays():
+    """ Return age in days after which raw stored readings are dropped in favour of rollups """
+    if 'local' in configData and 'rawretention' in configData['local']:
+        return float(configData['local']['rawretention'])
+    else:
+        return RETENTION_DEFAULT_RAW_DAYS
+
 def getLokiConfig():
     if 'loki' in configData:
         firstConfigKey = list(configData['loki'].keys())[0]
@@ -483,6 +871,57 @@ def getCsvEnabled():
     else:
         return False
 
+def getCsvInterval():
+    """ Return interval in seconds between CSV rows """
+    if 'local' in configData and 'csvinterval' in configData['local']:
+        return max(float(configData['local']['csvinterval']), SENSOR_UPDATE_INTERVAL)
+    else:
+        return CSV_UPDATE_INTERVAL
+
+def getCsvConfig():
+    """ Return a dictionary of CSV file settings, as keyword arguments for CsvWriter """
+    localConfig = configData.get('local', {})
+    rotate = localConfig.get('csvrotate', "daily")
+    if rotate not in ("daily", "size", "none"):
+        logger.warning("Invalid [local] 'csvrotate' value {}, defaulting to daily".format(rotate))
+        rotate = "daily"
+    return {
+        'flushRows': max(int(localConfig.get('csvflushrows', 10)), 1),
+        'flushInterval': float(localConfig.get('csvflushinterval', 300)),
+        'fsync': bool(localConfig.get('csvfsync', True)),
+        'rotate': rotate,
+        'maxSize': int(float(localConfig.get('csvmaxsize', 10)) * 1024 * 1024),
+        'compress': bool(localConfig.get('csvcompress', False))
+    }
+
+def getStoreEnabled():
+    """ Return local store enabled value, defaults to enabled """
+    if 'local' in configData and 'store' in configData['local']:
+        return configData['local']['store']
+    else:
+        return True
+
+def getStoreInterval():
+    """ Return local store interval in seconds """
+    if 'local' in configData and 'storeinterval' in configData['local']:
+        return max(int(configData['local']['storeinterval']), SENSOR_UPDATE_INTERVAL)
+    else:
+        return STORE_DEFAULT_UPDATE_INTERVAL
+
+def getModuleInterval(name):
+    """ Return polling interval in seconds for a sensor module """
+    if name in configData and 'interval' in configData[name]:
+        return max(float(configData[name]['interval']), 0.1)
+    else:
+        return MODULE_DEFAULT_INTERVALS.get(name, SENSOR_UPDATE_INTERVAL)
+
+def getModuleTimeout(name):
+    """ Return read timeout in seconds for a sensor module """
+    if name in configData and 'timeout' in configData[name]:
+        return float(configData[name]['timeout'])
+    else:
+        return MODULE_DEFAULT_TIMEOUT
+
 def getAppCommitHash() -> str:
     """ Try get application git commit hash """
     # Taken from https://stackoverflow.com/a/21901260
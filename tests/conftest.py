@@ -0,0 +1,19 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Test setup, making the firmware modules importable
+'''
+
+import os
+import sys
+
+TESTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE_DIRECTORY = os.path.join(os.path.dirname(TESTS_DIRECTORY), "firmware")
+
+# Stand-ins for the hardware libraries come first, so tests never touch real hardware
+STUBS_DIRECTORY = os.path.join(TESTS_DIRECTORY, "stubs")
+
+for directory in (FIRMWARE_DIRECTORY, STUBS_DIRECTORY):
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
@@ -0,0 +1,53 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Runs the application against stand-in hardware, printing the CPU time it used once settled as JSON
+
+Usage: runAq.py <config file> <data directory> <settle seconds> <measure seconds>
+'''
+
+import functools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+TESTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path[0:0] = [os.path.join(TESTS_DIRECTORY, "stubs"), os.path.join(os.path.dirname(TESTS_DIRECTORY), "firmware")]
+
+import websockets
+import aq
+import WebServer
+
+def measure(settle, period):
+    """ Wait for startup to finish, then measure CPU time used by every thread over period seconds and stop """
+    time.sleep(settle)
+    cpuStart = time.process_time()
+    wallStart = time.monotonic()
+    time.sleep(period)
+    print(json.dumps({"cpu": time.process_time() - cpuStart, "wall": time.monotonic() - wallStart}), flush=True)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+def main():
+    configFile, dataDirectory, settle, period = sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4])
+
+    aq.configFile = configFile
+    aq.lokiDataDirectory = os.path.join(dataDirectory, "offline/")
+    aq.storeDataDirectory = os.path.join(dataDirectory, "store/")
+    aq.rollupDataDirectory = os.path.join(dataDirectory, "rollup/")
+    aq.queueDataDirectory = os.path.join(dataDirectory, "wal/")
+    aq.csvDataDirectory = os.path.join(dataDirectory, "csv/")
+
+    # Listen on any free port, so as not to clash with anything already running
+    serve = websockets.serve
+    aq.websockets.serve = lambda handler, host, port, **kwargs: serve(handler, host, 0, **kwargs)
+    aq.WebServer.WebServer = functools.partial(WebServer.WebServer, port=0)
+
+    threading.Thread(target=measure, args=(settle, period), daemon=True).start()
+    aq.main()
+
+if __name__ == "__main__":
+    main()
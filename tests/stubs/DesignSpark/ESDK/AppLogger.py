@@ -0,0 +1,14 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Stand-in for the ESDK logging functions, logging to the console only
+'''
+
+import logging
+
+def getLogger(name, debug=False, loggingSetup='full'):
+    """ Returns a logger object, the file logging set up by loggingSetup is left out """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    return logger
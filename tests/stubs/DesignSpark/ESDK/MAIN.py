@@ -0,0 +1,52 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Stand-in for the ESDK main board, with sensor modules returning fixed readings
+'''
+
+class _Module:
+    def __init__(self, key, sensorType, readings):
+        self.key = key
+        self.sensorType = sensorType
+        self.readings = readings
+
+    def readSensors(self):
+        sensorData = {'sensor': self.sensorType}
+        sensorData.update(self.readings)
+        return {self.key: sensorData}
+
+class ModMAIN:
+    def __init__(self, config, debug=False, loggingLevel='full', pluginDir=None):
+        self.configDict = config
+        self.sensorData = {}
+        self.sensorModules = {}
+        self.plugins = []
+
+    def createModules(self):
+        self.sensorModules = {
+            'THV': _Module('thv', 'SHT4x', {'temperature': 21.5, 'humidity': 40.2, 'vocIndex': 100}),
+            'CO2': _Module('co2', 'SCD4x', {'co2': 420}),
+            'PM2': _Module('pm', 'SPS30', {'pm1.0': 1.2, 'pm2.5': 2.4, 'pm4.0': 3.1, 'pm10': 3.6})
+        }
+
+    def getLocation(self):
+        return {'lat': 53.7, 'lon': -1.9}
+
+    def getGPSStatus(self):
+        return {'gpsStatus': {}}
+
+    def getUndervoltageStatus(self):
+        return {'throttle_state': {'code': 0}}
+
+    def getSerialNumber(self):
+        return {'hardwareId': '10000000abcdef01'}
+
+    def getModuleVersion(self):
+        return {'moduleVersion': 'test'}
+
+    def setPower(self, vcc3=False, vcc5=False):
+        pass
+
+    def setBuzzer(self, freq=0):
+        pass
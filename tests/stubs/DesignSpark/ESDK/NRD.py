@@ -0,0 +1,6 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Stand-in for the ESDK NRD module, readings come from MAIN.ModMAIN instead
+'''
@@ -0,0 +1,3 @@
+'''
+Stand-ins for the DesignSpark ESDK library, so the firmware may be tested without the hardware
+'''
@@ -0,0 +1,29 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+'''
+Stand-in for RPi.GPIO, edge callbacks are recorded so that tests may call them
+'''
+
+BCM = 11
+IN = 1
+OUT = 0
+PUD_UP = 22
+RISING = 31
+
+callbacks = {}
+
+def setwarnings(flag):
+    pass
+
+def setmode(mode):
+    pass
+
+def setup(channel, direction, pull_up_down=None):
+    pass
+
+def add_event_detect(channel, edge, callback=None, bouncetime=None):
+    callbacks[channel] = callback
+
+def remove_event_detect(channel):
+    callbacks.pop(channel, None)
@@ -0,0 +1,183 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+import gzip
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import CsvWriter
+
+READING = {"thv": {"sensor": "SHT4x", "temperature": 21.5, "humidity": 40}, "hardwareId": "10000000abcdef01"}
+
+class FakeClock:
+    """ Stands in for datetime.utcnow and time.monotonic, only moving on when told to """
+    def __init__(self):
+        self.now = datetime(2023, 1, 1, 23, 59, 0)
+        self.monotonicNow = 1000.0
+
+    def advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+        self.monotonicNow += seconds
+
+    def monotonic(self):
+        return self.monotonicNow
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+
+    class FakeDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return clock.now
+
+    monkeypatch.setattr(CsvWriter, "datetime", FakeDatetime)
+    monkeypatch.setattr(CsvWriter.time, "monotonic", clock.monotonic)
+    return clock
+
+def makeWriter(tmp_path, **kwargs):
+    options = {"friendlyName": "test", "hwid": "10000000abcdef01", "directory": str(tmp_path), "fsync": False}
+    options.update(kwargs)
+    return CsvWriter.CsvWriter(**options)
+
+def readRows(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt') as fh:
+        return fh.read().splitlines()
+
+def test_rows_written_by_count(clock, tmp_path):
+    writer = makeWriter(tmp_path, flushRows=3)
+    writer.addRow(READING)
+    writer.addRow(READING)
+    assert os.path.getsize(writer.csvFilename) == 0
+
+    writer.addRow(READING)
+    rows = readRows(writer.csvFilename)
+    assert rows[0] == ",".join(writer.csvColumns)
+    assert len(rows) == 4
+    assert rows[1].split(",")[:3] == [str(int(clock.now.timestamp())), "21.5", "40"]
+    writer.close()
+
+def test_rows_written_by_interval(clock, tmp_path):
+    writer = makeWriter(tmp_path, flushRows=100, flushInterval=300, rotate="none")
+    writer.addRow(READING)
+    clock.advance(299)
+    writer.addRow(READING)
+    assert os.path.getsize(writer.csvFilename) == 0
+
+    clock.advance(1)
+    writer.addRow(READING)
+    assert len(readRows(writer.csvFilename)) == 4
+    writer.close()
+
+def test_fsync_on_flush(clock, tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(CsvWriter.os, "fsync", synced.append)
+    writer = makeWriter(tmp_path, flushRows=2, fsync=True)
+    writer.addRow(READING)
+    assert synced == []
+    writer.addRow(READING)
+    assert len(synced) == 1
+    writer.close()
+    assert len(synced) == 2
+
+def test_daily_rotation(clock, tmp_path):
+    writer = makeWriter(tmp_path, flushRows=100)
+    first = writer.csvFilename
+    writer.addRow(READING)
+
+    # The first reading of the next UTC day starts a new file, with the earlier rows written out
+    clock.advance(60)
+    writer.addRow(READING)
+    assert writer.csvFilename != first
+    assert os.path.basename(writer.csvFilename) == "test_10000000abcdef01_2023_01_02-00_00_00.csv"
+    assert len(readRows(first)) == 2
+    writer.close()
+    assert len(readRows(writer.csvFilename)) == 2
+
+def test_size_rotation(clock, tmp_path):
+    writer = makeWriter(tmp_path, flushRows=1, rotate="size", maxSize=500)
+    for _ in range(20):
+        writer.addRow(READING)
+        clock.advance(1)
+    writer.close()
+
+    filenames = sorted(os.listdir(str(tmp_path)))
+    assert len(filenames) > 1
+    rows = []
+    for filename in filenames:
+        fileRows = readRows(os.path.join(str(tmp_path), filename))
+        assert fileRows[0] == ",".join(writer.csvColumns)
+        rows.extend(fileRows[1:])
+    assert len(rows) == 20
+    # Files are only rotated once over the limit, so hold at most one row beyond it
+    assert all(os.path.getsize(os.path.join(str(tmp_path), filename)) < 500 + len(rows[0]) + 2 for filename in filenames)
+
+def test_no_rotation(clock, tmp_path):
+    writer = makeWriter(tmp_path, flushRows=1, rotate="none", maxSize=100)
+    for _ in range(5):
+        writer.addRow(READING)
+        clock.advance(3600)
+    writer.close()
+    assert os.listdir(str(tmp_path)) == [os.path.basename(writer.csvFilename)]
+    assert len(readRows(writer.csvFilename)) == 6
+
+def test_same_second_names_not_overwritten(clock, tmp_path):
+    writer = makeWriter(tmp_path, flushRows=1, rotate="size", maxSize=1, compress=True)
+    for _ in range(3):
+        writer.addRow(READING)
+    writer.close()
+
+    # Every row is over the limit, so each after the first starts a new file within the same second
+    assert sorted(os.listdir(str(tmp_path))) == sorted("test_10000000abcdef01_2023_01_01-23_59_00{}.csv.gz".format(suffix) \
+        for suffix in ("", "-1", "-2"))
+
+def test_compressed_on_rotation(clock, tmp_path):
+    writer = makeWriter(tmp_path, flushRows=100, compress=True)
+    first = writer.csvFilename
+    writer.addRow(READING)
+    clock.advance(60)
+    writer.addRow(READING)
+
+    # Only finished files are compressed
+    assert not os.path.exists(first)
+    assert len(readRows(first + ".gz")) == 2
+    assert os.path.exists(writer.csvFilename)
+    assert not any(filename.endswith(".tmp") for filename in os.listdir(str(tmp_path)))
+    writer.close()
+    assert len(readRows(writer.csvFilename + ".gz")) == 2
+
+def test_rows_after_close_ignored(clock, tmp_path):
+    writer = makeWriter(tmp_path, flushRows=100)
+    writer.addRow(READING)
+    writer.close()
+    writer.addRow(READING)
+    writer.close()
+    assert len(readRows(writer.csvFilename)) == 2
+
+def test_directory_created(clock, tmp_path):
+    writer = makeWriter(tmp_path / "data" / "csv", flushRows=1)
+    writer.addRow(READING)
+    writer.close()
+    assert len(readRows(writer.csvFilename)) == 2
+
+def test_failed_compression_keeps_logging(clock, tmp_path, monkeypatch):
+    writer = makeWriter(tmp_path, flushRows=100, compress=True)
+    first = writer.csvFilename
+    writer.addRow(READING)
+
+    def failingOpen(*args, **kwargs):
+        raise OSError(28, "No space left on device")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(CsvWriter.gzip, "open", failingOpen)
+        clock.advance(60)
+        writer.addRow(READING)
+        assert len(readRows(first)) == 2
+
+        # The row that found rotation due is lost with the failure, but later rows are written to the new file
+        writer.addRow(READING)
+    writer.close()
+    assert len(readRows(writer.csvFilename + ".gz")) == 2
@@ -0,0 +1,190 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+import json
+import os
+
+import LokiSpool
+
+# Nanosecond timestamps, as used by Loki
+START = 1672531200 * 1000000000
+SECOND = 1000000000
+
+def fill(spool, count, first=0, interval=SECOND):
+    for index in range(first, first + count):
+        spool.append(START + index * interval, {"index": index})
+
+def readIndexes(records):
+    return [data["index"] for position, timestamp, data in records]
+
+def segmentFiles(path):
+    return sorted(filename for filename in os.listdir(path) if filename != LokiSpool.CHECKPOINT_FILE)
+
+def test_read_does_not_consume(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    fill(spool, 5)
+
+    assert readIndexes(spool.read(3)) == [0, 1, 2]
+    assert readIndexes(spool.read(10)) == [0, 1, 2, 3, 4]
+    assert spool.getStats()['records'] == 5
+    spool.close()
+
+def test_ack_and_checkpoint_survive_restart(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    fill(spool, 5)
+    records = spool.read(2)
+    spool.ack(records[-1][0])
+    assert spool.getStats()['records'] == 3
+    spool.close()
+
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    assert spool.getStats()['records'] == 3
+    assert readIndexes(spool.read(10)) == [2, 3, 4]
+    spool.close()
+
+def test_ack_all_empties_active_segment(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    fill(spool, 3)
+    spool.ack(spool.read(10)[-1][0])
+    assert spool.getStats() == {"records": 0, "bytes": 0, "segments": 1}
+
+    # Records appended afterwards are read from the start of the emptied segment
+    fill(spool, 2, first=3)
+    assert readIndexes(spool.read(10)) == [3, 4]
+    spool.close()
+
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    assert readIndexes(spool.read(10)) == [3, 4]
+    spool.close()
+
+def test_rotation_by_size_and_age(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path), segmentSize=200, segmentAge=3600)
+    fill(spool, 10)
+    sizeSegments = spool.getStats()['segments']
+    assert sizeSegments > 1
+
+    # A record an hour after the first in the active segment starts a new one, whatever its size
+    spool.close()
+    spool = LokiSpool.LokiSpool(str(tmp_path), segmentSize=1024 * 1024, segmentAge=3600)
+    fill(spool, 1, first=100)
+    assert spool.getStats()['segments'] == sizeSegments
+    fill(spool, 1, first=4000)
+    assert spool.getStats()['segments'] == sizeSegments + 1
+    assert readIndexes(spool.read(20)) == list(range(10)) + [100, 4000]
+    spool.close()
+
+def test_ack_across_segments_removes_finished(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path), segmentSize=200)
+    fill(spool, 10)
+    records = spool.read(10)
+    segments = sorted(set(position[0] for position, timestamp, data in records))
+
+    # Acknowledge up to part way through the second segment
+    second = [record for record in records if record[0][0] == segments[1]]
+    spool.ack(second[0][0])
+    assert "{:08d}{}".format(segments[0], LokiSpool.SEGMENT_EXTENSION) not in segmentFiles(str(tmp_path))
+    remaining = 10 - records.index(second[0]) - 1
+    assert spool.getStats()['records'] == remaining
+    spool.close()
+
+    spool = LokiSpool.LokiSpool(str(tmp_path), segmentSize=200)
+    assert readIndexes(spool.read(20)) == list(range(10 - remaining, 10))
+    spool.close()
+
+def test_compressed_segments(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path), segmentSize=200, compress=True)
+    fill(spool, 10)
+    assert any(filename.endswith(LokiSpool.COMPRESSED_EXTENSION) for filename in segmentFiles(str(tmp_path)))
+
+    # The checkpoint is kept part way through a compressed segment
+    spool.ack(spool.read(1)[0][0])
+    spool.close()
+
+    spool = LokiSpool.LokiSpool(str(tmp_path), segmentSize=200, compress=True)
+    assert spool.getStats()['records'] == 9
+    assert readIndexes(spool.read(20)) == list(range(1, 10))
+    spool.close()
+
+def test_torn_tail_truncated(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    fill(spool, 2)
+    spool.close()
+
+    segmentPath = os.path.join(str(tmp_path), segmentFiles(str(tmp_path))[-1])
+    with open(segmentPath, 'ab') as fh:
+        fh.write(b'{"ts": 16725312')
+
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    assert spool.getStats()['records'] == 2
+    fill(spool, 1, first=2)
+    assert readIndexes(spool.read(10)) == [0, 1, 2]
+    spool.close()
+
+def test_unreadable_record_returned_as_none(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    fill(spool, 1)
+    spool.close()
+
+    segmentPath = os.path.join(str(tmp_path), segmentFiles(str(tmp_path))[-1])
+    with open(segmentPath, 'ab') as fh:
+        fh.write(b'not json\n')
+
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    fill(spool, 1, first=1)
+    records = spool.read(10)
+    assert [data for position, timestamp, data in records] == [{"index": 0}, None, {"index": 1}]
+
+    # Unreadable records are acknowledged like any other, so do not hold up the rest
+    spool.ack(records[1][0])
+    assert readIndexes(spool.read(10)) == [1]
+    spool.close()
+
+def test_legacy_files_migrated(tmp_path):
+    for index in (2, 0, 1):
+        with open(os.path.join(str(tmp_path), "{}.json".format(START + index * SECOND)), 'w') as fh:
+            json.dump({"index": index}, fh)
+
+    spool = LokiSpool.LokiSpool(str(tmp_path))
+    records = spool.read(10)
+    assert readIndexes(records) == [0, 1, 2]
+    assert [timestamp for position, timestamp, data in records] == [START, START + SECOND, START + 2 * SECOND]
+    assert not any(filename.endswith(LokiSpool.LEGACY_EXTENSION) for filename in os.listdir(str(tmp_path)))
+    spool.close()
+
+def test_remove_segment_counts_dropped_records(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path), segmentSize=200)
+    fill(spool, 10)
+    spool.ack(spool.read(1)[0][0])
+
+    finished = spool.getFinishedSegments()
+    segment, path, compressed = finished[0]
+    dropped = spool.removeSegment(segment)
+    assert dropped > 0
+    assert spool.getStats()['records'] == 9 - dropped
+    assert readIndexes(spool.read(20)) == list(range(10 - spool.getStats()['records'], 10))
+
+    # The active segment is never removed
+    assert spool.removeSegment(spool.activeSegment) == 0
+    spool.close()
+
+def test_ack_after_segment_removed(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path), segmentSize=200)
+    fill(spool, 10)
+    records = spool.read(10)
+    first, path, compressed = spool.getFinishedSegments()[0]
+    second = spool.getFinishedSegments()[1][0]
+
+    # Retention removes segments while an upload of their records is still in flight
+    dropped = spool.removeSegment(first)
+    inFirst = [record for record in records if record[0][0] == first]
+    spool.ack(inFirst[-1][0])
+    assert spool.getStats()['records'] == 10 - dropped
+
+    spool.removeSegment(second)
+    spool.ack(records[-1][0])
+    assert spool.getStats()['records'] == 0
+    spool.close()
+
+    spool = LokiSpool.LokiSpool(str(tmp_path), segmentSize=200)
+    assert spool.read(10) == []
+    spool.close()
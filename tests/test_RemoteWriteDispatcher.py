@@ -0,0 +1,74 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+import pytest
+
+pytest.importorskip("google.protobuf")
+snappy = pytest.importorskip("snappy")
+
+import prometheus_pb2
+import RemoteWriteDispatcher
+
+START = 1672531200
+
+class FakeWriter:
+    """ Stands in for PrometheusWriter, which the dispatcher only takes settings from """
+    def __init__(self, aggregates=False):
+        self.staticLabels = {"friendlyname": "test", "hwid": "10000000abcdef01"}
+        self.maxPayload = 1024 * 1024
+        self.aggregates = aggregates
+
+def addSamples(dispatcher, first, count):
+    for second in range(first, first + count):
+        dispatcher.addSamples(START + second, {"thv": {"sensor": "SHT4x", "temperature": float(second)}})
+
+def decode(payloads):
+    """ Returns the samples of every series in a list of compressed requests, keyed on metric name """
+    series = {}
+    for payload in payloads:
+        request = prometheus_pb2.WriteRequest()
+        request.ParseFromString(snappy.decompress(payload))
+        for timeseries in request.timeseries:
+            name = next(label.value for label in timeseries.labels if label.name == "__name__")
+            series.setdefault(name, []).extend((sample.timestamp, sample.value) for sample in timeseries.samples)
+    return series
+
+def test_every_sample_sent_to_each_endpoint():
+    dispatcher = RemoteWriteDispatcher.RemoteWriteDispatcher()
+    dispatcher.addEndpoint("fast", FakeWriter(), 60)
+    dispatcher.addEndpoint("slow", FakeWriter(), 180)
+    assert dispatcher.getTickInterval() == 60
+
+    # The slow endpoint is due on the first tick and every third after, so sends the last samples on the seventh
+    sent = {"fast": [], "slow": []}
+    for tick in range(7):
+        if tick < 6:
+            addSamples(dispatcher, tick * 60, 60)
+        for name, writer, payloads, oldest in dispatcher.tick():
+            sent[name].extend(decode(payloads)["temperature"])
+
+    expected = [((START + second) * 1000, float(second)) for second in range(360)]
+    assert sent["fast"] == expected
+    assert sent["slow"] == expected
+
+def test_shared_requests_compressed_once():
+    dispatcher = RemoteWriteDispatcher.RemoteWriteDispatcher()
+    dispatcher.addEndpoint("first", FakeWriter(), 60)
+    dispatcher.addEndpoint("second", FakeWriter(), 60)
+    addSamples(dispatcher, 0, 60)
+    (firstName, firstWriter, firstPayloads, oldest), (secondName, secondWriter, secondPayloads, oldest) = dispatcher.tick()
+    assert [id(payload) for payload in firstPayloads] == [id(payload) for payload in secondPayloads]
+
+def test_aggregates_sent_to_their_own_endpoint():
+    dispatcher = RemoteWriteDispatcher.RemoteWriteDispatcher()
+    dispatcher.addEndpoint("fast", FakeWriter(aggregates=True), 60)
+    dispatcher.addEndpoint("slow", FakeWriter(aggregates=True), 120)
+    dispatcher.tick()
+
+    # Both endpoints are due together, each with statistics of its own interval
+    for tick in range(20):
+        addSamples(dispatcher, tick * 60, 60)
+        due = {name: decode(payloads) for name, writer, payloads, oldest in dispatcher.tick()}
+        assert [value for timestamp, value in due["fast"]["temperature_count"]] == [60]
+        if "slow" in due:
+            assert [value for timestamp, value in due["slow"]["temperature_count"]] == [120]
@@ -0,0 +1,105 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+import math
+import random
+import timeit
+
+import pytest
+
+pytest.importorskip("google.protobuf")
+
+import prometheus_pb2
+import RemoteWriteEncoder
+from google.protobuf.internal import api_implementation
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+LABELS = [("__name__", "pm2_5"), ("friendlyname", "test"), ("hwid", "10000000abcdef01"), ("sensor", "SPS30")]
+
+def reference(batch):
+    """ Encodes a batch of (labels, samples) through the generic protobuf API """
+    request = prometheus_pb2.WriteRequest()
+    for labels, samples in batch:
+        series = request.timeseries.add()
+        for name, value in labels:
+            label = series.labels.add()
+            label.name = name
+            label.value = value
+        for timestamp, value in samples:
+            sample = series.samples.add()
+            sample.value = value
+            sample.timestamp = timestamp
+    return request.SerializeToString()
+
+def encode(batch):
+    return RemoteWriteEncoder.RemoteWriteEncoder().encode( \
+        [(RemoteWriteEncoder.encodeLabels(labels), samples) for labels, samples in batch])
+
+@pytest.mark.parametrize("value", [0.0, -0.0, 1.5, -273.15, math.nan, math.inf, -math.inf, 5e-324, 1.7976931348623157e308])
+def test_sample_values(value):
+    batch = [(LABELS, [(1672531200000, value)])]
+    assert encode(batch) == reference(batch)
+
+@pytest.mark.parametrize("timestamp", [0, 1, 127, 128, 1672531200000, -1, INT64_MIN, INT64_MAX])
+def test_sample_timestamps(timestamp):
+    batch = [(LABELS, [(timestamp, 21.5)])]
+    assert encode(batch) == reference(batch)
+
+def test_non_ascii_labels():
+    batch = [([("__name__", "temperature"), ("friendlyname", "Ätherstraße"), ("location", "東京"), ("tag", "🌡")], \
+        [(1672531200000, 21.5)])]
+    assert encode(batch) == reference(batch)
+
+def test_empty_labels_and_series():
+    # Empty names and values are left out by protobuf, as are series with no samples
+    batch = [([("", "value"), ("name", "")], [(1672531200000, 1.0)]), (LABELS, [])]
+    assert encode(batch) == reference(batch)
+
+def test_long_lengths():
+    # Lengths of 128 bytes and over take more than one byte to encode
+    batch = [([("__name__", "a" * 300)], [(timestamp, float(timestamp)) for timestamp in range(200)])]
+    assert encode(batch) == reference(batch)
+
+def test_encoder_reuse():
+    encoder = RemoteWriteEncoder.RemoteWriteEncoder()
+    labels = RemoteWriteEncoder.encodeLabels(LABELS)
+    first = encoder.encode([(labels, [(1, 1.0), (2, 2.0)])])
+    second = encoder.encode([(labels, [(3, 3.0)])])
+    assert first == reference([(LABELS, [(1, 1.0), (2, 2.0)])])
+    assert second == reference([(LABELS, [(3, 3.0)])])
+
+def test_randomised_batches():
+    generator = random.Random(0)
+    special = [0.0, -0.0, math.nan, math.inf, -math.inf]
+    for _ in range(200):
+        batch = []
+        for _ in range(generator.randint(0, 5)):
+            labels = sorted((generator.choice(["__name__", "hwid", "sensor", "städte"]) + str(index), \
+                generator.choice(["", "x", "€uro", "a" * generator.randint(0, 200)])) for index in range(generator.randint(0, 4)))
+            samples = [(generator.choice([generator.randint(INT64_MIN, INT64_MAX), generator.randint(0, 2 ** 42)]), \
+                generator.choice(special + [generator.uniform(-1e6, 1e6)])) for _ in range(generator.randint(0, 10))]
+            batch.append((labels, samples))
+        assert encode(batch) == reference(batch)
+
+def test_read_response():
+    results = [encode([(LABELS, [(1672531200000, 1.0)])]), encode([])]
+    response = prometheus_pb2.ReadResponse()
+    for result in results:
+        response.results.add().ParseFromString(result)
+    assert RemoteWriteEncoder.encodeReadResponse(results) == response.SerializeToString()
+
+@pytest.mark.skipif(api_implementation.Type() != "python", \
+    reason="The encoder replaces the pure Python protobuf backend used on the device")
+def test_benchmark():
+    """ Encoding 15 series of 120 samples, as for a two minute write, with labels encoded once per series """
+    batch = [([("__name__", "metric{}".format(index))] + LABELS[1:], \
+        [(1672531200000 + second * 1000, second / 10) for second in range(120)]) for index in range(15)]
+    encoder = RemoteWriteEncoder.RemoteWriteEncoder()
+    templates = [(RemoteWriteEncoder.encodeLabels(labels), samples) for labels, samples in batch]
+
+    encoderTime = min(timeit.repeat(lambda: encoder.encode(templates), number=5, repeat=3))
+    referenceTime = min(timeit.repeat(lambda: reference(batch), number=5, repeat=3))
+    assert encoderTime < referenceTime, "Encoder {:.1f} ms, generic protobuf {:.1f} ms per request".format( \
+        encoderTime / 5 * 1000, referenceTime / 5 * 1000)
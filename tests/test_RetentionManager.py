@@ -0,0 +1,144 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+import gzip
+import os
+import time
+
+import pytest
+
+import CsvWriter
+import LokiSpool
+import RetentionManager
+import Rollups
+import SeriesStore
+
+DAY = 86400
+
+def setAge(path, age):
+    modified = time.time() - age
+    os.utime(path, (modified, modified))
+
+def makeFile(path, age, content=b"timestamp,temperature\n1,21.5\n"):
+    with open(path, 'wb') as fh:
+        fh.write(content)
+    setAge(path, age)
+    return path
+
+def makeManager(tmp_path, usage=None, **kwargs):
+    """ Returns a manager of a csv directory and any other parts given, reporting disk usage from usage() """
+    csvDirectory = tmp_path / "csv"
+    csvDirectory.mkdir(exist_ok=True)
+    options = {"budget": 80, "compressAfter": DAY, "rawRetention": 30 * DAY, "csvDirectory": str(csvDirectory)}
+    options.update(kwargs)
+    manager = RetentionManager.RetentionManager(str(tmp_path), **options)
+    if usage is not None:
+        manager.getUsedPercentage = usage
+    return manager
+
+def test_compresses_old_csv_files(tmp_path):
+    manager = makeManager(tmp_path, usage=lambda: 0)
+    old = makeFile(str(tmp_path / "csv" / "old.csv"), 2 * DAY)
+    makeFile(str(tmp_path / "csv" / "older.csv"), 3 * DAY)
+    makeFile(str(tmp_path / "csv" / "new.csv"), 0)
+    modified = os.path.getmtime(old)
+
+    # One file per check, oldest first
+    assert manager.check()['compressed'] == 1
+    assert os.path.exists(str(tmp_path / "csv" / "older.csv.gz"))
+    assert manager.check()['compressed'] == 1
+    assert manager.check()['compressed'] == 0
+
+    assert sorted(os.listdir(str(tmp_path / "csv"))) == ["new.csv", "old.csv.gz", "older.csv.gz"]
+    with gzip.open(old + ".gz", 'rb') as fh:
+        assert fh.read() == b"timestamp,temperature\n1,21.5\n"
+    # Compressed files keep their place in eviction order
+    assert os.path.getmtime(old + ".gz") == pytest.approx(modified)
+
+def test_existing_compressed_file_not_overwritten(tmp_path):
+    manager = makeManager(tmp_path, usage=lambda: 0)
+    makeFile(str(tmp_path / "csv" / "old.csv"), 2 * DAY)
+    makeFile(str(tmp_path / "csv" / "old.csv.gz"), 2 * DAY, b"existing")
+    makeFile(str(tmp_path / "csv" / "new.csv"), 0)
+
+    assert manager.check()['compressed'] == 0
+    assert manager.check()['compressed'] == 0
+    with open(str(tmp_path / "csv" / "old.csv.gz"), 'rb') as fh:
+        assert fh.read() == b"existing"
+    assert os.path.exists(str(tmp_path / "csv" / "old.csv"))
+
+def test_file_being_written_is_left_alone(tmp_path, monkeypatch):
+    manager = makeManager(tmp_path, usage=lambda: 100)
+    writer = CsvWriter.CsvWriter(directory=str(tmp_path / "csv"), rotate="none", flushRows=1)
+    writer.addRow({"thv": {"sensor": "SHT4x", "temperature": 21.5}})
+    manager.check()
+
+    # Appending leaves the directory unchanged, so the file must not be taken as inactive however old
+    writer.addRow({"thv": {"sensor": "SHT4x", "temperature": 22.5}})
+    realTime = time.time
+    monkeypatch.setattr(RetentionManager.time, "time", lambda: realTime() + DAY + 3600)
+    assert manager.check() == {"compressed": 0, "downsampled": 0, "evicted": 0}
+
+    writer.addRow({"thv": {"sensor": "SHT4x", "temperature": 23.5}})
+    writer.close()
+    assert os.listdir(str(tmp_path / "csv")) == [os.path.basename(writer.csvFilename)]
+    with open(writer.csvFilename) as fh:
+        assert [line.split(',')[1] for line in fh.read().splitlines()[1:]] == ["21.5", "22.5", "23.5"]
+
+def test_evicts_oldest_first_until_within_budget(tmp_path):
+    spool = LokiSpool.LokiSpool(str(tmp_path / "offline"), segmentSize=100)
+    for index in range(3):
+        spool.append((1672531200 + index) * 1000000000, {"index": index})
+    store = SeriesStore.SeriesStore(str(tmp_path / "store"), segmentSize=SeriesStore.BLOCK_SIZE)
+    for index in range(2 * SeriesStore.BLOCK_SIZE // SeriesStore.RAW_RECORD.size):
+        store.append("thv.temperature", 1672531200000 + index * 1000, 21.5)
+    store.flush()
+
+    # Interleave the ages of the different kinds of file
+    ages = {}
+    for (segment, path, compressed), age in zip(spool.getFinishedSegments(), (10 * DAY, 7 * DAY)):
+        ages[path] = age
+    first, path = store.getSegments("thv.temperature")[0]
+    ages[path] = 8 * DAY
+    for path, age in ages.items():
+        setAge(path, age)
+    (tmp_path / "csv").mkdir()
+    for name, age in (("a.csv.gz", 9 * DAY), ("b.csv.gz", 5 * DAY), ("c.csv", DAY)):
+        ages[makeFile(str(tmp_path / "csv" / name), age)] = age
+    makeFile(str(tmp_path / "csv" / "active.csv"), 0)
+
+    remaining = lambda: [path for path in ages if os.path.exists(path)]
+    manager = makeManager(tmp_path, usage=lambda: 90 if len(remaining()) > 3 else 50, spool=spool, store=store, \
+        compressAfter=30 * DAY)
+
+    assert manager.check()['evicted'] == len(ages) - 3
+    assert sorted(remaining()) == sorted(sorted(ages, key=ages.get)[:3])
+    assert manager.check()['evicted'] == 0
+    assert os.path.exists(str(tmp_path / "csv" / "active.csv"))
+    spool.close()
+    store.close()
+
+def test_drops_raw_segments_past_retention(tmp_path):
+    store = SeriesStore.SeriesStore(str(tmp_path / "store"), segmentSize=SeriesStore.BLOCK_SIZE)
+    rollups = Rollups.Rollups(str(tmp_path / "rollup"))
+    recordsPerSegment = SeriesStore.BLOCK_SIZE // SeriesStore.RAW_RECORD.size
+    start = int((time.time() - 40 * DAY) * 1000)
+    for index in range(3 * recordsPerSegment):
+        store.append("thv.temperature", start + index * 1000, 21.5)
+    store.append("thv.temperature", int(time.time() * 1000), 21.5)
+    store.flush()
+    assert len(store.getSegments("thv.temperature")) == 3
+
+    manager = makeManager(tmp_path, usage=lambda: 0, store=store, rollups=rollups)
+    # The newest sealed segment ends where the active one starts, so is kept as it holds recent data
+    assert manager.check()['downsampled'] == 2
+    assert len(store.getSegments("thv.temperature")) == 1
+    store.close()
+    rollups.close()
+
+def test_nothing_left_to_evict_warns_once(tmp_path, caplog):
+    manager = makeManager(tmp_path, usage=lambda: 100)
+    makeFile(str(tmp_path / "csv" / "active.csv"), 0)
+    manager.check()
+    manager.check()
+    assert len([record for record in caplog.records if "nothing left to evict" in record.getMessage()]) == 1
@@ -0,0 +1,41 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+import math
+
+import pytest
+
+import Rollups
+
+# Start of an hour, in seconds
+START = 1672531200
+
+def test_each_reading_counted_once(tmp_path):
+    rollups = Rollups.Rollups(str(tmp_path))
+    # A module read every five seconds gives twelve readings a minute
+    for index in range(24):
+        rollups.appendReadings(START + index * 5, {"co2": {"sensor": "SCD41", "co2": 400 + index}})
+
+    rows = rollups.query("co2.co2", START * 1000, (START + 120) * 1000, "1m")
+    assert [(start, count) for start, low, high, mean, count in rows] == [(START * 1000, 12), ((START + 60) * 1000, 12)]
+    assert rows[0][1:4] == (400, 411, pytest.approx(405.5))
+    rollups.close()
+
+def test_other_keys_and_missing_values_skipped(tmp_path):
+    rollups = Rollups.Rollups(str(tmp_path))
+    rollups.appendReadings(START, {"hardwareId": "10000000abcdef01", "geohash": "gcw2", \
+        "pm": {"sensor": "SPS30", "pm2.5": math.nan, "pm10": 3.0, "status": "ok"}})
+    assert rollups.getSeriesNames() == ["pm.pm10"]
+    rollups.close()
+
+def test_buckets_carry_up_to_coarser_tiers(tmp_path):
+    rollups = Rollups.Rollups(str(tmp_path))
+    for minute in range(16):
+        rollups.appendReadings(START + minute * 60, {"thv": {"sensor": "SHT4x", "temperature": float(minute)}})
+    rollups.close()
+
+    rollups = Rollups.Rollups(str(tmp_path))
+    rows = rollups.query("thv.temperature", START * 1000, (START + 3600) * 1000, "15m")
+    assert [(start, low, high, count) for start, low, high, mean, count in rows] == \
+        [(START * 1000, 0, 14, 15), ((START + 900) * 1000, 15, 15, 1)]
+    rollups.close()
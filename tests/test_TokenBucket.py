@@ -0,0 +1,87 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+import threading
+
+import pytest
+
+import TokenBucket
+
+class FakeClock:
+    """ Stands in for time.monotonic and time.sleep, sleeping only moves the clock on """
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(TokenBucket.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(TokenBucket.time, "sleep", clock.sleep)
+    return clock
+
+def test_burst_within_capacity(clock):
+    bucket = TokenBucket.TokenBucket(100, 1000)
+    bucket.consume(600)
+    bucket.consume(400)
+    assert clock.sleeps == []
+
+def test_waits_to_repay_debt(clock):
+    bucket = TokenBucket.TokenBucket(100, 1000)
+    bucket.consume(1000)
+    bucket.consume(250)
+    assert clock.sleeps == [pytest.approx(2.5)]
+
+def test_amount_larger_than_capacity(clock):
+    bucket = TokenBucket.TokenBucket(100, 1000)
+    bucket.consume(3000)
+    assert clock.sleeps == [pytest.approx(20)]
+
+def test_refills_over_time(clock):
+    bucket = TokenBucket.TokenBucket(100, 1000)
+    bucket.consume(1000)
+    clock.now += 5
+    bucket.consume(500)
+    assert clock.sleeps == []
+
+    # Time idle beyond a full bucket is not saved up
+    clock.now += 3600
+    bucket.consume(1500)
+    assert clock.sleeps == [pytest.approx(5)]
+
+def test_average_rate(clock):
+    bucket = TokenBucket.TokenBucket(100, 1000)
+    start = clock.now
+    for _ in range(100):
+        bucket.consume(300)
+    # Everything beyond the initial burst is sent at the rate
+    assert clock.now - start == pytest.approx((100 * 300 - 1000) / 100)
+
+def test_cancelled_wait(clock):
+    class FakeEvent:
+        def __init__(self):
+            self.waits = []
+
+        def wait(self, timeout):
+            self.waits.append(timeout)
+            return True
+
+    bucket = TokenBucket.TokenBucket(100, 1000)
+    cancelled = FakeEvent()
+    bucket.consume(1500, cancelled)
+    assert cancelled.waits == [pytest.approx(5)]
+    assert clock.sleeps == []
+
+def test_cancel_ends_wait_early():
+    bucket = TokenBucket.TokenBucket(1, 1)
+    cancelled = threading.Event()
+    cancelled.set()
+    # Would wait an hour if not cancelled
+    bucket.consume(3601, cancelled)
@@ -0,0 +1,124 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+import os
+import time
+
+import WriteAheadQueue
+
+def now():
+    return int(time.time() * 1000)
+
+def drain(queue):
+    """ Returns every payload left in the queue, acknowledging each """
+    payloads = []
+    while True:
+        record = queue.peek()
+        if record is None:
+            return payloads
+        position, timestamp, payload = record
+        payloads.append(payload)
+        queue.ack(position)
+
+def segmentFiles(path):
+    return sorted(filename for filename in os.listdir(path) if filename.endswith(WriteAheadQueue.SEGMENT_EXTENSION))
+
+def test_fifo_order(tmp_path):
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path))
+    for index in range(5):
+        queue.put(b"payload%d" % index, now())
+    assert queue.getCount() == 5
+
+    # Peeking again without acknowledging returns the same record
+    assert queue.peek()[2] == b"payload0"
+    assert queue.peek()[2] == b"payload0"
+
+    assert drain(queue) == [b"payload%d" % index for index in range(5)]
+    assert queue.getCount() == 0
+    queue.close()
+
+def test_recovery_resumes_after_last_ack(tmp_path):
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path))
+    for index in range(4):
+        queue.put(b"payload%d" % index, now())
+    position, timestamp, payload = queue.peek()
+    queue.ack(position)
+    # Read but not acknowledged, so replayed after a restart
+    queue.peek()
+    queue.close()
+
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path))
+    assert queue.getCount() == 3
+    assert drain(queue) == [b"payload1", b"payload2", b"payload3"]
+    queue.close()
+
+def test_recovery_truncates_torn_record(tmp_path):
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path))
+    queue.put(b"complete", now())
+    queue.put(b"torn record", now())
+    queue.close()
+
+    segmentPath = os.path.join(str(tmp_path), segmentFiles(str(tmp_path))[-1])
+    os.truncate(segmentPath, os.path.getsize(segmentPath) - 3)
+
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path))
+    assert queue.getCount() == 1
+    # Records written after recovery follow on from the last good one
+    queue.put(b"after", now())
+    assert drain(queue) == [b"complete", b"after"]
+    queue.close()
+
+def test_recovery_truncates_corrupt_record(tmp_path):
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path))
+    queue.put(b"complete", now())
+    queue.put(b"corrupted", now())
+    queue.close()
+
+    segmentPath = os.path.join(str(tmp_path), segmentFiles(str(tmp_path))[-1])
+    with open(segmentPath, 'r+b') as fh:
+        fh.seek(-1, os.SEEK_END)
+        fh.write(b"X")
+
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path))
+    assert drain(queue) == [b"complete"]
+    queue.close()
+
+def test_segments_removed_once_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(WriteAheadQueue, "SEGMENT_SIZE", 100)
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path))
+    payloads = [bytes([index]) * 60 for index in range(6)]
+    for payload in payloads:
+        queue.put(payload, now())
+    # Segments are rotated once over their size, so hold two records each
+    assert len(segmentFiles(str(tmp_path))) == 3
+
+    queue.close()
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path))
+    assert drain(queue) == payloads
+    assert len(segmentFiles(str(tmp_path))) == 1
+    queue.close()
+
+def test_size_cap_drops_oldest(tmp_path, monkeypatch):
+    monkeypatch.setattr(WriteAheadQueue, "SEGMENT_SIZE", 100)
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path), maxBytes=250)
+    payloads = [bytes([index]) * 60 for index in range(6)]
+    for payload in payloads:
+        queue.put(payload, now())
+
+    remaining = drain(queue)
+    assert remaining == payloads[-len(remaining):]
+    assert len(remaining) < len(payloads)
+    queue.close()
+
+def test_age_cap_skips_old_records(tmp_path):
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path), maxAge=60)
+    queue.put(b"old", now() - 120 * 1000)
+    queue.put(b"new", now())
+    assert drain(queue) == [b"new"]
+
+    # Skipped records stay skipped after a restart
+    queue.close()
+    queue = WriteAheadQueue.WriteAheadQueue(str(tmp_path), maxAge=60)
+    assert queue.getCount() == 0
+    assert queue.peek() is None
+    queue.close()
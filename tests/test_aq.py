@@ -0,0 +1,49 @@
+# Copyright (c) 2023 RS Components Ltd
+# SPDX-License-Identifier: MIT License
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from tests.conftest import FIRMWARE_DIRECTORY, TESTS_DIRECTORY
+
+# Seconds allowed for startup, and then measured while idle
+SETTLE_TIME = 4
+MEASURE_TIME = 5
+
+# Highest share of one core the application may use while idle, a busy-wait loop would use all of it
+MAX_IDLE_CPU = 0.1
+
+CONFIG = '''
+[ESDK]
+friendlyname = "test"
+location = "lab"
+latitude = 53.7
+longitude = -1.9
+debug = false
+logging = "off"
+
+[local]
+csv = false
+logging = "off"
+'''
+
+def test_idle_cpu(tmp_path):
+    # The application itself is run, so needs its dependencies other than the hardware libraries
+    for module in ("paho.mqtt.client", "requests", "snappy", "toml", "twisted", "websockets"):
+        pytest.importorskip(module)
+
+    configFile = tmp_path / "aq.toml"
+    configFile.write_text(CONFIG)
+
+    # The web server serves the dashboard relative to the firmware directory
+    result = subprocess.run([sys.executable, os.path.join(TESTS_DIRECTORY, "runAq.py"), str(configFile), \
+        str(tmp_path), str(SETTLE_TIME), str(MEASURE_TIME)], \
+        cwd=FIRMWARE_DIRECTORY, capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 0, result.stderr
+    usage = json.loads(result.stdout.strip().splitlines()[-1])
+    assert usage['cpu'] / usage['wall'] < MAX_IDLE_CPU, result.stderr